@@ -1,43 +1,503 @@
 import os
+import sys
+import random
+import logging
+import contextlib
+import contextvars
 import requests
+from requests.adapters import HTTPAdapter
+from email.utils import parsedate_to_datetime
 import json
 import base64
-from flask import Flask, request, jsonify, send_from_directory, redirect, Response, render_template_string
+import hashlib
+import itertools
+import functools
+import math
+from urllib.parse import urlparse
+from flask import Flask, request, jsonify, send_from_directory, send_file, redirect, Response, render_template_string, stream_with_context
 from flask_cors import CORS
-import traceback
+from werkzeug.middleware.proxy_fix import ProxyFix
 import time
 import uuid
 import threading
+import queue
+import asyncio
+import sqlite3
+from collections import deque, OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from PIL import Image
+from PIL import Image, ImageOps
 import io
 
+try:
+    import httpx
+except ImportError:  # only needed for UPSTREAM_IO_MODE=async
+    httpx = None
+
+try:
+    import prometheus_client
+    from prometheus_client import multiprocess
+except ImportError:  # /metrics is unavailable without prometheus_client
+    prometheus_client = None
+
 app = Flask(__name__, static_folder='.', static_url_path='')
 CORS(app)
 
+# Logging: LOG_LEVEL applies to every fallora.* logger, LOG_LEVELS overrides single
+# loggers, e.g. "fallora.http=DEBUG,fallora.analysis=WARNING,werkzeug=ERROR"
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_LEVELS = os.environ.get("LOG_LEVELS", "")
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "json").lower()  # json or text
+# Request/response bodies contain user prompts, so they are only logged when enabled,
+# at DEBUG level, for a sample of calls
+LOG_PAYLOADS = os.environ.get("LOG_PAYLOADS", "0") == "1"
+LOG_PAYLOAD_SAMPLE_RATE = float(os.environ.get("LOG_PAYLOAD_SAMPLE_RATE", "0.1"))
+
+# Correlation ids (request_id, job_id, batch_id) attached to every log record
+LOG_CONTEXT = contextvars.ContextVar('log_context', default={})
+
+@contextlib.contextmanager
+def log_context(**fields):
+    """Add correlation fields to log records emitted inside the block"""
+    token = LOG_CONTEXT.set({**LOG_CONTEXT.get(), **fields})
+    try:
+        yield
+    finally:
+        LOG_CONTEXT.reset(token)
+
+def job_log_context(func):
+    """Decorator: log everything func does under its job_id argument"""
+    @functools.wraps(func)
+    def wrapper(job_id, *args, **kwargs):
+        with log_context(job_id=job_id):
+            return func(job_id, *args, **kwargs)
+    return wrapper
+
+class LogContextFilter(logging.Filter):
+    def filter(self, record):
+        record.context = LOG_CONTEXT.get()
+        return True
+
+class JsonLogFormatter(logging.Formatter):
+    """One JSON object per line; fields passed as extra={'fields': {...}} are merged in"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage()
+        }
+        entry.update(getattr(record, 'context', {}))
+        entry.update(getattr(record, 'fields', {}))
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+class TextLogFormatter(logging.Formatter):
+    def format(self, record):
+        record.context_text = ''.join(f" {key}={value}" for key, value in getattr(record, 'context', {}).items())
+        message = super().format(record)
+        fields = getattr(record, 'fields', None)
+        if fields:
+            message += ' ' + json.dumps(fields, default=str)
+        return message
+
+def configure_logging():
+    handler = logging.StreamHandler(sys.stderr)
+    handler.addFilter(LogContextFilter())
+    if LOG_FORMAT == 'text':
+        handler.setFormatter(TextLogFormatter('%(asctime)s %(levelname)s %(name)s%(context_text)s: %(message)s'))
+    else:
+        handler.setFormatter(JsonLogFormatter())
+    root = logging.getLogger()
+    root.handlers = [handler]
+    root.setLevel(logging.WARNING)
+    logging.getLogger('fallora').setLevel(LOG_LEVEL)
+    for override in LOG_LEVELS.split(','):
+        name, _, level = override.partition('=')
+        if name.strip() and level.strip():
+            logging.getLogger(name.strip()).setLevel(level.strip().upper())
+
+configure_logging()
+log = logging.getLogger('fallora')
+job_log = logging.getLogger('fallora.jobs')
+http_log = logging.getLogger('fallora.http')
+storage_log = logging.getLogger('fallora.storage')
+analysis_log = logging.getLogger('fallora.analysis')
+
+@app.before_request
+def assign_request_id():
+    # Reuse the proxy's id when there is one so logs can be joined across hops
+    request_id = (request.headers.get('X-Request-ID') or uuid.uuid4().hex)[:64]
+    LOG_CONTEXT.set({'request_id': request_id})
+
+@app.after_request
+def add_request_id_header(response):
+    request_id = LOG_CONTEXT.get().get('request_id')
+    if request_id:
+        response.headers['X-Request-ID'] = request_id
+    return response
+
+# Tracing: spans are kept per job (shown in the job status response) and, when a
+# destination is configured, exported as OTLP/JSON to a file and/or a collector
+TRACING_ENABLED = os.environ.get("TRACING_ENABLED", "1") == "1"
+TRACE_EXPORT_PATH = os.environ.get("TRACE_EXPORT_PATH")  # JSON lines, OTLP ExportTraceServiceRequest per line
+TRACE_OTLP_ENDPOINT = os.environ.get("TRACE_OTLP_ENDPOINT")  # e.g. http://otel-collector:4318/v1/traces
+TRACE_MAX_JOBS = int(os.environ.get("TRACE_MAX_JOBS", "1000"))  # jobs whose spans are kept in memory
+TRACE_MAX_SPANS_PER_JOB = int(os.environ.get("TRACE_MAX_SPANS_PER_JOB", "50"))
+
+CURRENT_SPAN = contextvars.ContextVar('current_span', default=None)
+
+class Span:
+    """One timed operation, identified like an OpenTelemetry span"""
+
+    __slots__ = ('name', 'trace_id', 'span_id', 'parent_id', 'start_ns', 'end_ns', 'attributes', 'error')
+
+    def __init__(self, name, parent=None, attributes=None, start_ns=None):
+        self.name = name
+        self.trace_id = parent.trace_id if parent else uuid.uuid4().hex
+        self.span_id = uuid.uuid4().hex[:16]
+        self.parent_id = parent.span_id if parent else None
+        self.start_ns = start_ns or time.time_ns()
+        self.end_ns = None
+        self.attributes = dict(attributes or {})
+        self.error = None
+
+    def set_attribute(self, key, value):
+        self.attributes[key] = value
+
+    def summary(self):
+        """Compact form for the job status response"""
+        entry = {
+            'name': self.name,
+            'start': datetime.fromtimestamp(self.start_ns / 1e9).isoformat(timespec='milliseconds'),
+            'duration_ms': round((self.end_ns - self.start_ns) / 1e6, 1)
+        }
+        if self.error:
+            entry['error'] = self.error
+        return entry
+
+    def to_otlp(self):
+        span = {
+            'traceId': self.trace_id,
+            'spanId': self.span_id,
+            'name': self.name,
+            'kind': 1,  # SPAN_KIND_INTERNAL
+            'startTimeUnixNano': str(self.start_ns),
+            'endTimeUnixNano': str(self.end_ns),
+            'attributes': [
+                {'key': key, 'value': {'stringValue': str(value)}}
+                for key, value in self.attributes.items()
+            ],
+            'status': {'code': 2, 'message': self.error} if self.error else {'code': 1}
+        }
+        if self.parent_id:
+            span['parentSpanId'] = self.parent_id
+        return span
+
+class SpanExporter:
+    """Ships finished spans from a background thread in OTLP/JSON batches.
+
+    Each batch is appended to TRACE_EXPORT_PATH as one line (the format of the
+    collector's file exporter) and/or POSTed to TRACE_OTLP_ENDPOINT. Spans are
+    dropped rather than blocking a request when the buffer is full.
+    """
+
+    def __init__(self, path, endpoint, batch_size=200, flush_interval=2.0):
+        self.path = path
+        self.endpoint = endpoint
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue = queue.Queue(maxsize=10000)
+        self._thread = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.path or self.endpoint)
+
+    def export(self, span):
+        if self._thread is None:
+            with self._lock:
+                if self._thread is None:
+                    self._thread = threading.Thread(target=self._loop, name='span-exporter', daemon=True)
+                    self._thread.start()
+        try:
+            self._queue.put_nowait(span)
+        except queue.Full:
+            pass
+
+    def _loop(self):
+        while True:
+            batch = [self._queue.get()]
+            deadline = time.monotonic() + self.flush_interval
+            while len(batch) < self.batch_size and time.monotonic() < deadline:
+                try:
+                    batch.append(self._queue.get(timeout=max(0, deadline - time.monotonic())))
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except Exception as e:
+                logging.getLogger('fallora.tracing').warning("Span export failed: %s", e)
+
+    def _write(self, batch):
+        request_body = {'resourceSpans': [{
+            'resource': {'attributes': [{'key': 'service.name', 'value': {'stringValue': 'fallora'}}]},
+            'scopeSpans': [{'scope': {'name': 'fallora'}, 'spans': [span.to_otlp() for span in batch]}]
+        }]}
+        if self.path:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(request_body) + '\n')
+        if self.endpoint:
+            requests.post(self.endpoint, json=request_body, timeout=5)
+
+class Tracer:
+    """Creates spans under the current one and keeps recent spans per job.
+
+    Spans opened while a job_id is in the log context carry it as an attribute;
+    their summaries are kept (for up to max_jobs jobs) so the job status can
+    show where the time went.
+    """
+
+    def __init__(self, enabled, exporter, max_jobs, max_spans_per_job):
+        self.enabled = enabled
+        self.exporter = exporter
+        self.max_jobs = max_jobs
+        self.max_spans_per_job = max_spans_per_job
+        self._job_spans = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _new_span(self, name, attributes, start_ns=None):
+        fields = LOG_CONTEXT.get()
+        attributes = {**{key: fields[key] for key in ('job_id', 'request_id') if key in fields}, **attributes}
+        return Span(name, CURRENT_SPAN.get(), attributes, start_ns)
+
+    @contextlib.contextmanager
+    def span(self, name, **attributes):
+        if not self.enabled:
+            yield None
+            return
+        span = self._new_span(name, attributes)
+        token = CURRENT_SPAN.set(span)
+        try:
+            yield span
+        except BaseException as e:
+            span.error = f"{type(e).__name__}: {e}"
+            raise
+        finally:
+            CURRENT_SPAN.reset(token)
+            self._finish(span)
+
+    def record(self, name, start_ns, end_ns=None, **attributes):
+        """Record an already finished stage as a child of the current span"""
+        if not self.enabled:
+            return
+        span = self._new_span(name, attributes, start_ns)
+        self._finish(span, end_ns)
+
+    def traced(self, name):
+        """Decorator: run the function inside a span"""
+        def decorator(func):
+            @functools.wraps(func)
+            def wrapper(*args, **kwargs):
+                with self.span(name):
+                    return func(*args, **kwargs)
+            return wrapper
+        return decorator
+
+    def _finish(self, span, end_ns=None):
+        span.end_ns = end_ns or time.time_ns()
+        job_id = span.attributes.get('job_id')
+        if job_id:
+            with self._lock:
+                spans = self._job_spans.pop(job_id, [])
+                if len(spans) < self.max_spans_per_job:
+                    spans.append(span.summary())
+                self._job_spans[job_id] = spans
+                while len(self._job_spans) > self.max_jobs:
+                    self._job_spans.popitem(last=False)
+        if self.exporter.enabled:
+            self.exporter.export(span)
+
+    def job_spans(self, job_id):
+        with self._lock:
+            return sorted(self._job_spans.get(job_id, []), key=lambda span: span['start'])
+
+def current_span():
+    return CURRENT_SPAN.get()
+
+TRACER = Tracer(TRACING_ENABLED, SpanExporter(TRACE_EXPORT_PATH, TRACE_OTLP_ENDPOINT), TRACE_MAX_JOBS, TRACE_MAX_SPANS_PER_JOB)
+
+def log_payload(logger, message, payload):
+    """Log a request or response body if LOG_PAYLOADS is on and this call is sampled"""
+    if not LOG_PAYLOADS or not logger.isEnabledFor(logging.DEBUG):
+        return
+    if random.random() >= LOG_PAYLOAD_SAMPLE_RATE:
+        return
+    logger.debug(message, extra={'fields': {'payload': payload}})
+
 # fal.ai API configuration
 FAL_KEY = os.environ.get("FAL_KEY")
 if not FAL_KEY:
-    print("ERROR: FAL_KEY environment variable not set!")
+    log.error("FAL_KEY environment variable not set!")
 
 # Civitai API configuration
 CIVITAI_TOKEN = os.environ.get("CIVITAI_TOKEN")
+CIVITAI_BASE_URL = os.environ.get("CIVITAI_BASE_URL", "https://civitai.com").rstrip('/')
 if not CIVITAI_TOKEN:
-    print("WARNING: CIVITAI_TOKEN environment variable not set - Civitai LoRAs will not be available")
+    log.warning("CIVITAI_TOKEN environment variable not set - Civitai LoRAs will not be available")
 
 # z.ai API configuration
 Z_AI_API_KEY = os.environ.get("Z_AI_API_KEY")
 Z_AI_BASE_URL = os.environ.get("Z_AI_BASE_URL", "https://api.z.ai/api/paas/v4")
 Z_AI_MODEL = os.environ.get("Z_AI_MODEL", "glm-4.5v")
 if not Z_AI_API_KEY:
-    print("WARNING: Z_AI_API_KEY environment variable not set - AI image analysis will not be available")
+    log.warning("Z_AI_API_KEY environment variable not set - AI image analysis will not be available")
 
 # Reference image configuration
 REFERENCE_IMAGE_DIR = os.environ.get("REFERENCE_IMAGE_DIR", "/tmp/fallora_uploads")
 MAX_REFERENCE_IMAGE_SIZE = int(os.environ.get("MAX_REFERENCE_IMAGE_SIZE", "10485760"))  # 10MB
+# Public origin of this app; fal.ai fetches uploaded reference images from here
+PUBLIC_BASE_URL = os.environ.get("PUBLIC_BASE_URL", "https://fallora.gemneye.info").rstrip('/')
+
+# Generation worker pool configuration
+GENERATION_WORKERS = int(os.environ.get("GENERATION_WORKERS", "4"))
+GENERATION_QUEUE_SIZE = int(os.environ.get("GENERATION_QUEUE_SIZE", "50"))
+MAX_ACTIVE_JOBS_PER_CLIENT = int(os.environ.get("MAX_ACTIVE_JOBS_PER_CLIENT", "2"))
+MAX_QUEUED_JOBS_PER_CLIENT = int(os.environ.get("MAX_QUEUED_JOBS_PER_CLIENT", "10"))
+# Reverse proxies in front of the app. Clients are identified by the X-Forwarded-For hop the
+# outermost trusted proxy appended; earlier hops are client-supplied. 0 ignores the header
+TRUSTED_PROXY_COUNT = int(os.environ.get("TRUSTED_PROXY_COUNT", "1"))
+if TRUSTED_PROXY_COUNT > 0:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXY_COUNT, x_proto=0)
+# Extra threads allowed to finish a cancelled job's fal.ai call while a replacement takes its slot
+GENERATION_MAX_RETIRED_WORKERS = int(os.environ.get("GENERATION_MAX_RETIRED_WORKERS", str(GENERATION_WORKERS)))
+
+# Outbound HTTP client configuration (shared by the fal.ai, z.ai and media clients)
+HTTP_POOL_SIZE = int(os.environ.get("HTTP_POOL_SIZE", "20"))
+HTTP_CONNECT_TIMEOUT = float(os.environ.get("HTTP_CONNECT_TIMEOUT", "5"))
+HTTP_MAX_RETRIES = int(os.environ.get("HTTP_MAX_RETRIES", "3"))
+HTTP_RETRY_BACKOFF = float(os.environ.get("HTTP_RETRY_BACKOFF", "0.5"))
+HTTP_RETRY_MAX_BACKOFF = float(os.environ.get("HTTP_RETRY_MAX_BACKOFF", "30"))
+
+# Adaptive upstream limiters: fal.ai, each fal.ai endpoint and z.ai get a token bucket plus a
+# concurrency limit that is cut on 429/503/timeouts and grows back on success. The maxima are
+# account-wide, so they are split across UPSTREAM_LIMIT_SHARDS processes (set by gunicorn.conf.py)
+UPSTREAM_LIMITER_ENABLED = os.environ.get("UPSTREAM_LIMITER_ENABLED", "1") == "1"
+UPSTREAM_LIMIT_SHARDS = max(1, int(os.environ.get("UPSTREAM_LIMIT_SHARDS", "1")))
+FAL_MAX_CONCURRENCY = int(os.environ.get("FAL_MAX_CONCURRENCY", "20"))
+FAL_ENDPOINT_MAX_CONCURRENCY = int(os.environ.get("FAL_ENDPOINT_MAX_CONCURRENCY", "10"))
+FAL_RATE_LIMIT = float(os.environ.get("FAL_RATE_LIMIT", "10"))  # new requests per second, 0 disables
+ZAI_MAX_CONCURRENCY = int(os.environ.get("ZAI_MAX_CONCURRENCY", "5"))
+ZAI_RATE_LIMIT = float(os.environ.get("ZAI_RATE_LIMIT", "2"))
+UPSTREAM_MIN_CONCURRENCY = int(os.environ.get("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_LIMIT_DECREASE_FACTOR = float(os.environ.get("UPSTREAM_LIMIT_DECREASE_FACTOR", "0.5"))
+UPSTREAM_LIMIT_WAIT_SECONDS = float(os.environ.get("UPSTREAM_LIMIT_WAIT_SECONDS", "60"))
+
+# Circuit breakers per fal.ai endpoint and for z.ai: open once CIRCUIT_FAILURE_RATE of at least
+# CIRCUIT_MIN_CALLS calls in the last CIRCUIT_WINDOW_SECONDS failed (5xx, timeout, connection error),
+# refuse calls for CIRCUIT_OPEN_SECONDS, then let one probe call decide whether to close again
+CIRCUIT_BREAKER_ENABLED = os.environ.get("CIRCUIT_BREAKER_ENABLED", "1") == "1"
+CIRCUIT_FAILURE_RATE = float(os.environ.get("CIRCUIT_FAILURE_RATE", "0.5"))
+CIRCUIT_MIN_CALLS = int(os.environ.get("CIRCUIT_MIN_CALLS", "5"))
+CIRCUIT_WINDOW_SECONDS = float(os.environ.get("CIRCUIT_WINDOW_SECONDS", "120"))
+CIRCUIT_OPEN_SECONDS = float(os.environ.get("CIRCUIT_OPEN_SECONDS", "30"))
+
+# Upstream I/O mode: "threads" blocks a thread per upstream call, "async" runs fal.ai
+# generation calls on a shared asyncio event loop so waiting on them does not hold a worker
+UPSTREAM_IO_MODE = os.environ.get("UPSTREAM_IO_MODE", "threads").lower()
+ASYNC_MAX_INFLIGHT = int(os.environ.get("ASYNC_MAX_INFLIGHT", "1000"))  # upstream calls in flight on the loop
+ASYNC_POOL_SIZE = int(os.environ.get("ASYNC_POOL_SIZE", "100"))  # connections per upstream
+
+# fal.ai execution mode: "sync" holds the request open on fal.run, "queue" submits to
+# queue.fal.run and resolves results with a shared poller
+FAL_EXECUTION_MODE = os.environ.get("FAL_EXECUTION_MODE", "sync").lower()
+FAL_RUN_BASE_URL = os.environ.get("FAL_RUN_BASE_URL", "https://fal.run").rstrip('/')
+FAL_QUEUE_BASE_URL = os.environ.get("FAL_QUEUE_BASE_URL", "https://queue.fal.run")
+FAL_POLL_INTERVAL = float(os.environ.get("FAL_POLL_INTERVAL", "2"))
+FAL_POLL_CONCURRENCY = int(os.environ.get("FAL_POLL_CONCURRENCY", "4"))
+FAL_WEBHOOK_URL = os.environ.get("FAL_WEBHOOK_URL")  # e.g. https://fallora.gemneye.info/api/fal-webhook
+
+# Result cache for repeated generations with an explicit seed (0 entries disables it)
+RESULT_CACHE_MAX_ENTRIES = int(os.environ.get("RESULT_CACHE_MAX_ENTRIES", "500"))
+RESULT_CACHE_TTL_SECONDS = int(os.environ.get("RESULT_CACHE_TTL_SECONDS", "21600"))  # 6 hours
+
+# z.ai analysis cache (0 entries disables caching; concurrent duplicates are still coalesced)
+ANALYSIS_CACHE_MAX_ENTRIES = int(os.environ.get("ANALYSIS_CACHE_MAX_ENTRIES", "256"))
+ANALYSIS_CACHE_TTL_SECONDS = int(os.environ.get("ANALYSIS_CACHE_TTL_SECONDS", "3600"))
+
+# Reference images are downscaled and re-encoded before being sent to z.ai
+ANALYSIS_MAX_EDGE = int(os.environ.get("ANALYSIS_MAX_EDGE", "1536"))
+ANALYSIS_IMAGE_FORMAT = os.environ.get("ANALYSIS_IMAGE_FORMAT", "JPEG").upper()  # JPEG or WEBP
+ANALYSIS_IMAGE_QUALITY = int(os.environ.get("ANALYSIS_IMAGE_QUALITY", "85"))
+
+# Batch generation configuration
+BATCH_MAX_JOBS = int(os.environ.get("BATCH_MAX_JOBS", "64"))          # images per batch
+BATCH_MAX_CONCURRENCY = int(os.environ.get("BATCH_MAX_CONCURRENCY", "2"))  # child jobs queued or running at once
+BATCH_MAX_NUM_IMAGES = int(os.environ.get("BATCH_MAX_NUM_IMAGES", "4"))    # fal.ai num_images cap per request
+
+# Server-Sent Events configuration for job status streams
+SSE_KEEPALIVE_SECONDS = float(os.environ.get("SSE_KEEPALIVE_SECONDS", "15"))
+SSE_MAX_STREAM_SECONDS = float(os.environ.get("SSE_MAX_STREAM_SECONDS", "600"))
+SSE_MAX_JOBS_PER_STREAM = int(os.environ.get("SSE_MAX_JOBS_PER_STREAM", "50"))
+# Each open stream holds a request thread, so streams beyond this many per process get a 503
+# (the web UI then polls); gunicorn.conf.py adds this many threads on top of GUNICORN_THREADS
+SSE_MAX_STREAMS = int(os.environ.get("SSE_MAX_STREAMS", "16"))
+
+# Job store configuration ("memory" or "sqlite")
+JOB_STORE_BACKEND = os.environ.get("JOB_STORE_BACKEND", "memory").lower()
+JOB_STORE_PATH = os.environ.get("JOB_STORE_PATH", "/tmp/fallora_jobs.db")
+JOB_TTL_SECONDS = int(os.environ.get("JOB_TTL_SECONDS", "86400"))  # 24 hours
+JOB_STORE_MAX_JOBS = int(os.environ.get("JOB_STORE_MAX_JOBS", "5000"))
+JOB_STORE_MAX_BYTES = int(os.environ.get("JOB_STORE_MAX_BYTES", "52428800"))  # 50MB
+
+# Job watchdog: fails jobs that run past their model's deadline and takes over jobs
+# left pending/processing by a process that exited
+JOB_WATCHDOG_INTERVAL = float(os.environ.get("JOB_WATCHDOG_INTERVAL", "15"))
+JOB_DEADLINE_DEFAULT_SECONDS = float(os.environ.get("JOB_DEADLINE_DEFAULT_SECONDS", "600"))  # until enough latency samples
+JOB_DEADLINE_MIN_SECONDS = float(os.environ.get("JOB_DEADLINE_MIN_SECONDS", "120"))
+JOB_DEADLINE_MAX_SECONDS = float(os.environ.get("JOB_DEADLINE_MAX_SECONDS", "1800"))
+JOB_DEADLINE_MULTIPLIER = float(os.environ.get("JOB_DEADLINE_MULTIPLIER", "3"))  # times the p99 fal.ai latency
+JOB_DEADLINE_MIN_SAMPLES = int(os.environ.get("JOB_DEADLINE_MIN_SAMPLES", "20"))
+JOB_RECOVERY_MODE = os.environ.get("JOB_RECOVERY_MODE", "requeue").lower()  # "requeue" or "fail"
+JOB_RECOVERY_MAX_AGE_SECONDS = float(os.environ.get("JOB_RECOVERY_MAX_AGE_SECONDS", "900"))  # older orphans are failed
+
+UPLOAD_CHUNK_SIZE = int(os.environ.get("UPLOAD_CHUNK_SIZE", "65536"))
+
+# Reference image garbage collection
+REFERENCE_MAX_BYTES = int(os.environ.get("REFERENCE_MAX_BYTES", "2147483648"))  # 2GB
+REFERENCE_MAX_AGE_SECONDS = int(os.environ.get("REFERENCE_MAX_AGE_SECONDS", "604800"))  # 7 days
+REFERENCE_GC_INTERVAL = int(os.environ.get("REFERENCE_GC_INTERVAL", "300"))
+
+# Reference image HTTP caching; stored files never change, so they can be cached for a year
+REFERENCE_CACHE_MAX_AGE = int(os.environ.get("REFERENCE_CACHE_MAX_AGE", "31536000"))
+REFERENCE_THUMBNAIL_WIDTHS = [int(w) for w in os.environ.get("REFERENCE_THUMBNAIL_WIDTHS", "128,256,512").split(',') if w.strip()]
+
+# Local mirror of generated images served by /api/download
+RESULT_MIRROR_DIR = os.environ.get("RESULT_MIRROR_DIR", "/tmp/fallora_results")
+RESULT_MIRROR_MAX_BYTES = int(os.environ.get("RESULT_MIRROR_MAX_BYTES", "1073741824"))  # 1GB
+RESULT_MIRROR_WORKERS = int(os.environ.get("RESULT_MIRROR_WORKERS", "2"))
+# Browser cache lifetime of /api/download responses served from the mirror
+RESULT_DOWNLOAD_MAX_AGE = int(os.environ.get("RESULT_DOWNLOAD_MAX_AGE", "86400"))
+DOWNLOAD_CHUNK_SIZE = int(os.environ.get("DOWNLOAD_CHUNK_SIZE", "262144"))
+DOWNLOAD_ALLOWED_HOSTS = [
+    host.strip().lower()
+    for host in os.environ.get("DOWNLOAD_ALLOWED_HOSTS", "fal.media,*.fal.media,fal.run,*.fal.run").split(',')
+    if host.strip()
+]
+
+# Reference crop configuration
+CROP_JPEG_QUALITY = int(os.environ.get("CROP_JPEG_QUALITY", "95"))
+CROP_SOURCE_CACHE_MAX_PIXELS = int(os.environ.get("CROP_SOURCE_CACHE_MAX_PIXELS", "32000000"))  # ~96MB of RGB
 
 # Create upload directory if it doesn't exist
 os.makedirs(REFERENCE_IMAGE_DIR, exist_ok=True)
+os.makedirs(RESULT_MIRROR_DIR, exist_ok=True)
+
+# Reject oversized request bodies before they are parsed (1MB headroom for multipart overhead)
+app.config['MAX_CONTENT_LENGTH'] = MAX_REFERENCE_IMAGE_SIZE + 1048576
 
 # Civitai curated LoRA models organized by base model compatibility
 CIVITAI_LORAS = {
@@ -92,438 +552,2739 @@ BASE_MODEL_TO_CIVITAI = {
 
 # fal.ai LoRA endpoints
 FAL_ENDPOINTS = {
-    "fal-ai/flux-lora": "https://fal.run/fal-ai/flux-lora",
-    "fal-ai/flux-kontext-lora": "https://fal.run/fal-ai/flux-kontext-lora/text-to-image",
-    "fal-ai/wan/v2.2-a14b/text-to-image/lora": "https://fal.run/fal-ai/wan/v2.2-a14b/text-to-image/lora",
-    "fal-ai/qwen-image": "https://fal.run/fal-ai/qwen-image",
-    "fal-ai/flux-pro/v1/depth": "https://fal.run/fal-ai/flux-pro/v1/depth",
-    "fal-ai/flux-general": "https://fal.run/fal-ai/flux-general",
-    "fal-ai/flux-control-lora-depth": "https://fal.run/fal-ai/flux-control-lora-depth/image-to-image"
+    "fal-ai/flux-lora": f"{FAL_RUN_BASE_URL}/fal-ai/flux-lora",
+    "fal-ai/flux-kontext-lora": f"{FAL_RUN_BASE_URL}/fal-ai/flux-kontext-lora/text-to-image",
+    "fal-ai/wan/v2.2-a14b/text-to-image/lora": f"{FAL_RUN_BASE_URL}/fal-ai/wan/v2.2-a14b/text-to-image/lora",
+    "fal-ai/qwen-image": f"{FAL_RUN_BASE_URL}/fal-ai/qwen-image",
+    "fal-ai/flux-pro/v1/depth": f"{FAL_RUN_BASE_URL}/fal-ai/flux-pro/v1/depth",
+    "fal-ai/flux-general": f"{FAL_RUN_BASE_URL}/fal-ai/flux-general",
+    "fal-ai/flux-control-lora-depth": f"{FAL_RUN_BASE_URL}/fal-ai/flux-control-lora-depth/image-to-image"
 }
 
-# In-memory job store for async image generation
-JOB_STORE = {}
-JOB_LOCK = threading.Lock()
+# Per-model generation settings; every FAL_ENDPOINTS entry gets a ModelAdapter built from these
+FLUX_PAYLOAD_DEFAULTS = {
+    "num_inference_steps": 30,  # Flux default
+    "guidance_scale": 3.5,      # Flux default
+    "num_images": 1,
+    "enable_safety_checker": False,
+    "has_nsfw_concepts": True
+}
+DEPTH_PAYLOAD_DEFAULTS = dict(FLUX_PAYLOAD_DEFAULTS, guidance_scale=3.5, num_inference_steps=28)
 
-def clean_ai_prompt(raw_prompt):
-    """Clean up AI-generated prompt by removing artifacts and box markers"""
-    import re
+MODEL_ADAPTER_SETTINGS = {
+    "fal-ai/flux-lora": {
+        # Reference image mode switches to FLUX Control LoRA Depth
+        'reference_model': "fal-ai/flux-control-lora-depth"
+    },
+    "fal-ai/flux-kontext-lora": {
+        'reference_model': "fal-ai/flux-control-lora-depth"
+    },
+    "fal-ai/wan/v2.2-a14b/text-to-image/lora": {
+        # wan defaults per fal.ai docs; LoRAs come as a high/low transformer pair
+        'defaults': {
+            "num_inference_steps": 27,
+            "guidance_scale": 3.5,
+            "guidance_scale_2": 4,
+            "shift": 2,
+            "enable_safety_checker": False
+        },
+        'lora_rule': 'wan_pair',
+        'result_field': 'image'  # wan returns a single 'image' object
+    },
+    "fal-ai/qwen-image": {
+        'defaults': dict(FLUX_PAYLOAD_DEFAULTS, guidance_scale=2.5, num_inference_steps=50)
+    },
+    "fal-ai/flux-pro/v1/depth": {
+        # Legacy support - FLUX Pro depth does NOT support LoRAs
+        'defaults': DEPTH_PAYLOAD_DEFAULTS,
+        'send_loras': False,
+        'reference_fields': ("control_image_url",)
+    },
+    "fal-ai/flux-general": {
+        'send_loras': False
+    },
+    "fal-ai/flux-control-lora-depth": {
+        # Color reference and depth control image are the same upload
+        'defaults': DEPTH_PAYLOAD_DEFAULTS,
+        'reference_fields': ("image_url", "control_lora_image_url"),
+        'reference_defaults': {"control_lora_strength": 0.8, "strength": 0.85}
+    }
+}
 
-    # Remove box markers
-    cleaned = re.sub(r'<\|begin_of_box\|>|<\|end_of_box\|>', '', raw_prompt)
+class GenerationRequestError(Exception):
+    """A generation request that can never succeed; rejected with a 400 at submit time"""
 
-    # Remove any remaining template brackets with content like [Subject: details]
-    cleaned = re.sub(r'\[([^\]]+)\]', r'\1', cleaned)
+def validate_loras(loras):
+    """Check the shape of a request's loras: a list of objects with a string model and numeric weight"""
+    if not isinstance(loras, list):
+        raise GenerationRequestError('loras must be a list.')
+    for lora in loras:
+        if not isinstance(lora, dict):
+            raise GenerationRequestError('Each LoRA must be an object with a model.')
+        if not isinstance(lora.get('model', ''), (str, type(None))):
+            raise GenerationRequestError('LoRA model must be a string.')
+        weight = lora.get('weight', 1.0)
+        if isinstance(weight, bool) or not isinstance(weight, (int, float)):
+            raise GenerationRequestError(f'Invalid weight value for LoRA: {lora.get("model") or "unknown"}')
 
-    # Clean up extra whitespace
-    cleaned = ' '.join(cleaned.split())
+class ModelAdapter:
+    """Turns a generation request into a fal.ai payload for one model and reads its result"""
 
-    return cleaned.strip()
+    def __init__(self, model, endpoint_url, defaults=FLUX_PAYLOAD_DEFAULTS, lora_rule='weighted',
+                 send_loras=True, reference_fields=(), reference_defaults=None, reference_model=None,
+                 civitai_categories=(), result_field='images'):
+        self.model = model
+        self.endpoint_url = endpoint_url
+        self.defaults = defaults
+        self.lora_rule = lora_rule
+        self.send_loras = send_loras
+        self.reference_fields = reference_fields
+        self.reference_defaults = reference_defaults or {}
+        self.reference_model = reference_model
+        self.civitai_categories = civitai_categories
+        self.result_field = result_field
 
-def process_image_generation(job_id, base_model, loras, prompt, resolution, seed, negative_prompt, reference_image_url=None):
-    """Background function to process image generation"""
-    try:
-        with JOB_LOCK:
-            JOB_STORE[job_id]['status'] = 'processing'
-            JOB_STORE[job_id]['updated_at'] = datetime.now()
-        
-        # This is the same logic from the original generate_image function
-        # but extracted into a background function
-        
-        # Check if we have at least one valid LoRA with proper weight validation
+    @property
+    def supports_num_images(self):
+        """Whether one request can return several images via num_images"""
+        return self.result_field == 'images'
+
+    def _civitai_url(self, lora):
+        civitai_name = lora.get("civitai_name", "")
+        # Determine which category to look in based on is_style flag
+        category = "style" if lora.get("is_style", False) else "flux"
+        if category not in self.civitai_categories:
+            raise GenerationRequestError(f'{category.title()} LoRAs not supported for {self.model}')
+        if civitai_name in CIVITAI_LORAS.get(category, {}) and CIVITAI_TOKEN:
+            model_id = CIVITAI_LORAS[category][civitai_name]
+            return f"{CIVITAI_BASE_URL}/api/download/models/{model_id}?token={CIVITAI_TOKEN}"
+        raise GenerationRequestError(f'Civitai LoRA not available for {self.model}: {civitai_name}')
+
+    def resolve_loras(self, loras):
+        """Validate the requested LoRAs and convert them to fal.ai's format"""
         valid_loras = []
-        if base_model == "fal-ai/wan/v2.2-a14b/text-to-image/lora":
-            for lora in loras:
-                if lora.get("model", "").strip():
-                    lora_path = lora["model"].strip()
-                    
-                    # Handle Civitai LoRAs
-                    if lora.get("is_civitai", False):
-                        civitai_name = lora.get("civitai_name", "")
-                        is_style = lora.get("is_style", False)
-                        
-                        # Determine which category to look in based on is_style flag
-                        category = "style" if is_style else "flux"
-                        
-                        # Check if this category is supported for this base model
-                        civitai_categories = BASE_MODEL_TO_CIVITAI.get(base_model, [])
-                        if category not in civitai_categories:
-                            raise Exception(f'{category.title()} LoRAs not supported for {base_model}')
-                        
-                        # Get the model ID from the specific category
-                        if civitai_name in CIVITAI_LORAS.get(category, {}) and CIVITAI_TOKEN:
-                            model_id = CIVITAI_LORAS[category][civitai_name]
-                            lora_path = f"https://civitai.com/api/download/models/{model_id}?token={CIVITAI_TOKEN}"
-                        else:
-                            raise Exception(f'Civitai LoRA not available for {base_model}: {civitai_name}')
-                    
-                    valid_loras.append({
-                        "path": lora_path,
-                        "scale": 1,
-                        "transformer": lora["transformer"]
-                    })
-        else:
-            for lora in loras:
-                if lora.get("model", "").strip():
-                    weight = lora.get("weight", 1.0)
-                    lora_path = lora["model"].strip()
-                    
-                    # Handle Civitai LoRAs
-                    if lora.get("is_civitai", False):
-                        civitai_name = lora.get("civitai_name", "")
-                        is_style = lora.get("is_style", False)
-                        
-                        # Determine which category to look in based on is_style flag
-                        category = "style" if is_style else "flux"
-                        
-                        # Check if this category is supported for this base model
-                        civitai_categories = BASE_MODEL_TO_CIVITAI.get(base_model, [])
-                        if category not in civitai_categories:
-                            raise Exception(f'{category.title()} LoRAs not supported for {base_model}')
-                        
-                        # Get the model ID from the specific category
-                        if civitai_name in CIVITAI_LORAS.get(category, {}) and CIVITAI_TOKEN:
-                            model_id = CIVITAI_LORAS[category][civitai_name]
-                            lora_path = f"https://civitai.com/api/download/models/{model_id}?token={CIVITAI_TOKEN}"
-                        else:
-                            raise Exception(f'Civitai LoRA not available for {base_model}: {civitai_name}')
-                    
-                    # Ensure weight is a number between 0 and 2
-                    try:
-                        weight = float(weight)
-                        weight = max(0.0, min(2.0, weight))
-                        # Round to hundredths place
-                        weight = round(weight, 2)
-                        valid_loras.append({
-                            "path": lora_path,
-                            "scale": weight
-                        })
-                    except (ValueError, TypeError):
-                        raise Exception(f'Invalid weight value for LoRA: {lora.get("model", "unknown")}')
-                    
+        for lora in loras:
+            lora_path = (lora.get("model") or "").strip()
+            if not lora_path:
+                continue
+            if lora.get("is_civitai", False):
+                lora_path = self._civitai_url(lora)
+
+            if self.lora_rule == 'wan_pair':
+                valid_loras.append({"path": lora_path, "scale": 1, "transformer": lora.get("transformer")})
+                continue
+
+            # Ensure weight is a number between 0 and 2, rounded to hundredths
+            try:
+                weight = round(max(0.0, min(2.0, float(lora.get("weight", 1.0)))), 2)
+            except (ValueError, TypeError):
+                raise GenerationRequestError(f'Invalid weight value for LoRA: {lora.get("model", "unknown")}')
+            valid_loras.append({"path": lora_path, "scale": weight})
+
         if not valid_loras:
-            raise Exception('At least one LoRA model is required.')
-            
-        # For wan model, require both high and low LoRAs
-        if base_model == "fal-ai/wan/v2.2-a14b/text-to-image/lora":
-            transformers = [lora.get("transformer") for lora in valid_loras]
+            raise GenerationRequestError('At least one LoRA model is required.')
+
+        if self.lora_rule == 'wan_pair':
+            transformers = [lora["transformer"] for lora in valid_loras]
             if "high" not in transformers or "low" not in transformers:
-                raise Exception('wan/v2.2-a14b model requires both high and low LoRAs')
+                raise GenerationRequestError('wan/v2.2-a14b model requires both high and low LoRAs')
             if len(valid_loras) != 2:
-                raise Exception('wan/v2.2-a14b model requires exactly 2 LoRAs (high and low)')
-            
-        # Validate seed
-        if seed is not None:
-            if not isinstance(seed, int) or seed < 1 or seed > 2147483638:
-                raise Exception('Seed must be an integer between 1 and 2,147,483,638.')
-            
-        if not FAL_KEY:
-            raise Exception('Server configuration error: FAL_KEY not configured')
-            
-        # Parse resolution
-        try:
-            width, height = map(int, resolution.split('x'))
-        except ValueError:
-            raise Exception('Invalid resolution format. Use WIDTHxHEIGHT (e.g., 512x512)')
-        
-        # Determine which endpoint to use based on reference image presence
-        actual_model = base_model
-        if reference_image_url and base_model in ["fal-ai/flux-lora", "fal-ai/flux-kontext-lora"]:
-            # Switch to FLUX Control LoRA Depth for reference image mode
-            actual_model = "fal-ai/flux-control-lora-depth"
-            print(f"Job {job_id}: Reference image detected, switching to FLUX Control LoRA Depth")
-
-        # Get the appropriate fal.ai endpoint
-        endpoint_url = FAL_ENDPOINTS.get(actual_model)
-        if not endpoint_url:
-            raise Exception(f'Unsupported model: {actual_model}')
-
-        print(f"Job {job_id}: Using endpoint: {endpoint_url}")
-        print(f"Job {job_id}: Model: {actual_model}")
-        print(f"Job {job_id}: LoRAs: {loras}")
-        print(f"Job {job_id}: Resolution: {width}x{height}")
-        print(f"Job {job_id}: Seed: {seed}")
-        print(f"Job {job_id}: Prompt: {prompt}")
-        print(f"Job {job_id}: Negative Prompt: {negative_prompt}")
-        print(f"Job {job_id}: Reference Image: {reference_image_url}")
-        
-        # Prepare fal.ai request payload
-        payload = {
-            "prompt": prompt,
-            "image_size": {
-                "width": width,
-                "height": height
-            },
-            "num_inference_steps": 30,  # Flux default
-            "guidance_scale": 3.5,      # Flux default
-            "num_images": 1,
-            "enable_safety_checker": False,
-            "has_nsfw_concepts": True
-        }
-        
-        # Add seed if provided
+                raise GenerationRequestError('wan/v2.2-a14b model requires exactly 2 LoRAs (high and low)')
+        return valid_loras
+
+    def build_payload(self, prompt, width, height, loras, seed=None, negative_prompt=None,
+                      reference_image_url=None, num_images=1):
+        """Assemble the fal.ai request body"""
+        payload = {"prompt": prompt, "image_size": {"width": width, "height": height}, **self.defaults}
         if seed is not None:
             payload["seed"] = seed
-
-        # Add negative prompt if provided
         if negative_prompt:
             payload["negative_prompt"] = negative_prompt
-        
-        # Add LoRA configuration based on model type
-        if base_model == "fal-ai/wan/v2.2-a14b/text-to-image/lora":
-            # Override payload for wan model to match fal.ai documentation
-            payload = {
-                "prompt": prompt,
-                "loras": valid_loras,
-                "image_size": {
-                    "width": width,
-                    "height": height
-                },
-                "num_inference_steps": 27,  # wan default per docs
-                "guidance_scale": 3.5,      # wan default per docs
-                "guidance_scale_2": 4,      # wan default per docs
-                "shift": 2,                 # wan default per docs
-                "enable_safety_checker": False
-            }
-            
-            # Add seed if provided
-            if seed is not None:
-                payload["seed"] = seed
-
-            # Add negative prompt if provided
-            if negative_prompt:
-                payload["negative_prompt"] = negative_prompt
-
-        elif base_model in ["fal-ai/flux-lora", "fal-ai/flux-kontext-lora"]:
-            # FLUX LoRA format
-            payload["loras"] = valid_loras
-        elif base_model == "fal-ai/qwen-image":
-            # Qwen LoRA format with different settings
-            payload["loras"] = valid_loras
-            # Qwen-specific parameters
-            payload["guidance_scale"] = 2.5
-            payload["num_inference_steps"] = 50
-        elif actual_model == "fal-ai/flux-control-lora-depth":
-            # FLUX Control LoRA Depth format (reference image mode with LoRA support)
-            if reference_image_url:
-                # Convert relative URL to full URL for fal.ai
-                if reference_image_url.startswith('/api/reference-images/'):
-                    # Convert to absolute URL (fal.ai needs accessible URL)
-                    reference_image_url = f"https://fallora.gemneye.info{reference_image_url}"
-
-                # Required parameters for flux-control-lora-depth API
-                payload["image_url"] = reference_image_url  # Color reference image
-                payload["control_lora_image_url"] = reference_image_url  # Depth control image (same image)
-                payload["control_lora_strength"] = 0.8  # Optional: strength of style control
-                payload["strength"] = 0.85  # Optional: image transformation intensity (default: 0.85)
-
-            # Add LoRAs
-            payload["loras"] = valid_loras
-
-            # FLUX Control LoRA Depth specific parameters
-            payload["guidance_scale"] = 3.5
-            payload["num_inference_steps"] = 28
-        elif base_model == "fal-ai/flux-pro/v1/depth":
-            # FLUX Pro depth format (legacy support - no LoRA compatibility)
-            if reference_image_url:
-                # Convert relative URL to full URL for fal.ai
-                if reference_image_url.startswith('/api/reference-images/'):
-                    # Convert to absolute URL (fal.ai needs accessible URL)
-                    reference_image_url = f"https://fallora.gemneye.info{reference_image_url}"
-                payload["control_image_url"] = reference_image_url
-            # Note: FLUX Pro depth does NOT support LoRAs
-            # FLUX Pro depth specific parameters
-            payload["guidance_scale"] = 3.5
-            payload["num_inference_steps"] = 28
+        if self.send_loras:
+            payload["loras"] = loras
+        if reference_image_url and self.reference_fields:
+            for field in self.reference_fields:
+                payload[field] = reference_image_url
+            payload.update(self.reference_defaults)
+        # Batch jobs may ask for several images in one request
+        if num_images > 1 and self.supports_num_images:
+            payload["num_images"] = num_images
+        return payload
 
-        # Make request to fal.ai (increased timeout for async processing)
-        headers = {
-            "Authorization": f"Key {FAL_KEY}",
-            "Content-Type": "application/json"
-        }
-        
-        print(f"Job {job_id}: Sending payload to fal.ai: {json.dumps(payload, indent=2)}")
-        
-        response = requests.post(endpoint_url, headers=headers, json=payload, timeout=300)  # 5 minute timeout
-        
-        print(f"Job {job_id}: fal.ai response status: {response.status_code}")
-        
-        if response.status_code != 200:
-            error_msg = f"fal.ai API error: {response.status_code}"
-            try:
-                error_data = response.json()
-                error_msg += f" - {error_data.get('detail', 'Unknown error')}"
-            except:
-                error_msg += f" - {response.text}"
-            print(f"Job {job_id}: Error: {error_msg}")
-            raise Exception(error_msg)
-            
-        result = response.json()
-        print(f"Job {job_id}: fal.ai result keys: {result.keys()}")
-        
-        # Extract image URL from fal.ai response
-        # wan model returns 'image' object, other models return 'images' array
-        if base_model == "fal-ai/wan/v2.2-a14b/text-to-image/lora":
+    def extract_image_urls(self, result):
+        """Image URLs of a fal.ai result, first one required"""
+        if self.result_field == 'image':
             image_data = result.get('image')
             if not image_data:
                 raise Exception('No image generated')
-            image_url = image_data.get('url')
+            image_urls = [image_data.get('url')]
         else:
             images = result.get('images', [])
             if not images:
                 raise Exception('No images generated')
-            image_url = images[0].get('url')
-
-        if not image_url:
+            # Collapsed batch requests (num_images > 1) return several images
+            image_urls = [images[0].get('url')] + [image.get('url') for image in images[1:] if image.get('url')]
+        if not image_urls[0]:
             raise Exception('No image URL in response')
+        return image_urls
 
-        # Update job with success result
-        with JOB_LOCK:
-            JOB_STORE[job_id]['status'] = 'completed'
-            JOB_STORE[job_id]['result'] = {
-                'images': [{'url': image_url}],
-                'metadata': {
-                    'model': actual_model,  # Use actual model (might be switched for reference mode)
-                    'original_model': base_model,  # Track original model selection
-                    'reference_mode': bool(reference_image_url),  # Track if reference mode was used
-                    'loras': loras,
-                    'resolution': resolution,
-                    'generation_time': result.get('timings', {})
-                }
-            }
-            JOB_STORE[job_id]['updated_at'] = datetime.now()
-        
-        print(f"Job {job_id}: Completed successfully")
-            
-    except Exception as e:
-        print(f"Job {job_id}: Error processing: {e}")
-        with JOB_LOCK:
-            JOB_STORE[job_id]['status'] = 'failed'
-            JOB_STORE[job_id]['error'] = str(e)
-            JOB_STORE[job_id]['updated_at'] = datetime.now()
+def build_model_adapters():
+    """Build the adapter registry from FAL_ENDPOINTS, MODEL_ADAPTER_SETTINGS and BASE_MODEL_TO_CIVITAI"""
+    return {
+        model: ModelAdapter(
+            model, endpoint_url,
+            civitai_categories=BASE_MODEL_TO_CIVITAI.get(model, []),
+            **MODEL_ADAPTER_SETTINGS.get(model, {})
+        )
+        for model, endpoint_url in FAL_ENDPOINTS.items()
+    }
 
-@app.route('/')
-def serve_index():
-    return send_from_directory(app.root_path, 'index.html')
+MODEL_ADAPTERS = build_model_adapters()
 
-@app.route('/favicon.ico')
-def serve_favicon():
-    return send_from_directory(app.root_path, 
-                             'favicon.ico', mimetype='image/vnd.microsoft.icon')
+# Job statuses that will never change again and are therefore safe to evict
+TERMINAL_JOB_STATUSES = ('completed', 'failed', 'cancelled')
 
-@app.route('/favicon.svg')
-def serve_favicon_svg():
-    return send_from_directory(app.root_path, 
-                             'favicon.svg', mimetype='image/svg+xml')
+# Prometheus metrics, served on /metrics. With several gunicorn workers the values are
+# aggregated through PROMETHEUS_MULTIPROC_DIR (set up by gunicorn.conf.py)
+LATENCY_BUCKETS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120, 300)
+CROP_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5)
 
-@app.route('/style.css')
-def serve_css():
-    return send_from_directory(app.root_path, 
-                             'style.css', mimetype='text/css')
+class NullMetric:
+    """Stands in for every metric when prometheus_client is not installed"""
 
-@app.route('/script.js')
-def serve_js():
-    return send_from_directory(app.root_path, 
-                             'script.js', mimetype='application/javascript')
+    def labels(self, *args, **kwargs):
+        return self
 
-@app.route('/api/generate', methods=['POST'])
-def submit_generation_job():
-    """Submit an async image generation job"""
-    try:
-        data = request.get_json()
+    def inc(self, amount=1):
+        pass
 
-        # Debug logging to see what's being received
-        app.logger.error(f"=== DEBUG /api/generate request ===")
-        app.logger.error(f"Raw request data keys: {list(data.keys())}")
-        app.logger.error(f"Raw request data: {data}")
-        app.logger.error(f"=========================================")
+    def dec(self, amount=1):
+        pass
 
-        base_model = data.get('base_model')
-        loras = data.get('loras', [])
-        prompt = data.get('prompt')
-        resolution = data.get('resolution', '512x512')
-        seed = data.get('seed')
-        negative_prompt = data.get('negative_prompt')
-        reference_image_url = data.get('reference_image_url')
+    def set(self, value):
+        pass
 
-        app.logger.error(f"Extracted reference_image_url: {reference_image_url}")
-        
-        if not all([base_model, prompt]):
-            return jsonify({'error': 'base_model and prompt are required.'}), 400
-        
-        if not loras:
-            return jsonify({'error': 'At least one LoRA model is required.'}), 400
-            
-        # Validate seed
-        if seed is not None:
-            if not isinstance(seed, int) or seed < 1 or seed > 2147483638:
-                return jsonify({'error': 'Seed must be an integer between 1 and 2,147,483,638.'}), 400
-            
-        if not FAL_KEY:
-            return jsonify({'error': 'Server configuration error: FAL_KEY not configured'}), 500
-            
-        # Validate resolution format
-        try:
-            width, height = map(int, resolution.split('x'))
-        except ValueError:
-            return jsonify({'error': 'Invalid resolution format. Use WIDTHxHEIGHT (e.g., 512x512)'}), 400
-        
-        # Get the appropriate fal.ai endpoint
-        endpoint_url = FAL_ENDPOINTS.get(base_model)
-        if not endpoint_url:
-            return jsonify({'error': f'Unsupported model: {base_model}'}), 400
-        
-        # Generate unique job ID
-        job_id = str(uuid.uuid4())
-        
-        # Store job in memory with pending status
-        with JOB_LOCK:
-            JOB_STORE[job_id] = {
-                'status': 'pending',
-                'created_at': datetime.now(),
-                'updated_at': datetime.now(),
-                'params': {
-                    'base_model': base_model,
-                    'loras': loras,
-                    'prompt': prompt,
-                    'resolution': resolution,
-                    'seed': seed,
-                    'negative_prompt': negative_prompt,
-                    'reference_image_url': reference_image_url
-                }
-            }
-        
-        # Start background thread to process the image generation
-        thread = threading.Thread(
-            target=process_image_generation,
-            args=(job_id, base_model, loras, prompt, resolution, seed, negative_prompt, reference_image_url)
+    def observe(self, value):
+        pass
+
+def create_metric(kind, name, documentation, labelnames=(), **kwargs):
+    if prometheus_client is None:
+        return NullMetric()
+    return getattr(prometheus_client, kind)(name, documentation, labelnames, **kwargs)
+
+GENERATION_QUEUE_WAIT = create_metric(
+    'Histogram', 'fallora_generation_queue_wait_seconds',
+    'Time a generation job waited before a worker picked it up', ['model'], buckets=LATENCY_BUCKETS)
+GENERATION_UPSTREAM_LATENCY = create_metric(
+    'Histogram', 'fallora_generation_upstream_seconds',
+    'fal.ai round trip (submit to result in queue mode)', ['model'], buckets=LATENCY_BUCKETS)
+GENERATION_FAL_INFERENCE = create_metric(
+    'Histogram', 'fallora_generation_fal_inference_seconds',
+    'Inference time reported in the fal.ai timings', ['model'], buckets=LATENCY_BUCKETS)
+GENERATION_DURATION = create_metric(
+    'Histogram', 'fallora_generation_duration_seconds',
+    'Submission to completion of a generation job', ['model', 'cache_hit'], buckets=LATENCY_BUCKETS)
+GENERATION_FAILURES = create_metric(
+    'Counter', 'fallora_generation_failures_total',
+    'Failed generation jobs by upstream status code', ['model', 'status'])
+GENERATION_DEADLINE = create_metric(
+    'Gauge', 'fallora_generation_deadline_seconds',
+    'Current processing deadline per model, derived from observed fal.ai latency', ['model'],
+    multiprocess_mode='livemax')
+JOB_WATCHDOG_ACTIONS = create_metric(
+    'Counter', 'fallora_job_watchdog_actions_total',
+    'Jobs handled by the watchdog (timed_out, requeued, resumed, failed)', ['action'])
+GENERATION_CANCELLATIONS = create_metric(
+    'Counter', 'fallora_generation_cancellations_total',
+    'Cancelled generation jobs by how far they had got (queued, running or upstream)', ['stage'])
+ANALYSIS_DURATION = create_metric(
+    'Histogram', 'fallora_analysis_duration_seconds',
+    'Successful /api/analyze-image requests', ['cache_hit'], buckets=LATENCY_BUCKETS)
+ANALYSIS_UPSTREAM_LATENCY = create_metric(
+    'Histogram', 'fallora_analysis_upstream_seconds',
+    'z.ai chat completion round trip', buckets=LATENCY_BUCKETS)
+ANALYSIS_FAILURES = create_metric(
+    'Counter', 'fallora_analysis_failures_total',
+    'Failed /api/analyze-image requests by response status', ['status'])
+CROP_DURATION = create_metric(
+    'Histogram', 'fallora_crop_duration_seconds',
+    'Successful /api/crop-reference requests', ['cache_hit'], buckets=CROP_BUCKETS)
+CROP_FAILURES = create_metric(
+    'Counter', 'fallora_crop_failures_total',
+    'Failed /api/crop-reference requests by response status', ['status'])
+UPSTREAM_RESPONSES = create_metric(
+    'Counter', 'fallora_upstream_responses_total',
+    'Upstream HTTP responses by status code (error: no response)', ['upstream', 'status'])
+UPSTREAM_RETRIES = create_metric(
+    'Counter', 'fallora_upstream_retries_total', 'Retried upstream calls', ['upstream'])
+UPSTREAM_INFLIGHT = create_metric(
+    'Gauge', 'fallora_upstream_inflight_requests',
+    'Upstream calls in progress', ['upstream'], multiprocess_mode='livesum')
+UPSTREAM_CONCURRENCY_LIMIT = create_metric(
+    'Gauge', 'fallora_upstream_concurrency_limit',
+    'Current adaptive concurrency limit per upstream limiter', ['limiter'], multiprocess_mode='livesum')
+UPSTREAM_LIMITER_INFLIGHT = create_metric(
+    'Gauge', 'fallora_upstream_limiter_inflight',
+    'Calls holding a slot of an upstream limiter', ['limiter'], multiprocess_mode='livesum')
+UPSTREAM_LIMITER_WAIT = create_metric(
+    'Histogram', 'fallora_upstream_limiter_wait_seconds',
+    'Time spent waiting for an upstream limiter slot', ['limiter'], buckets=LATENCY_BUCKETS)
+UPSTREAM_LIMITER_DECREASES = create_metric(
+    'Counter', 'fallora_upstream_limiter_decreases_total',
+    'Times an upstream limiter cut its concurrency limit', ['limiter'])
+UPSTREAM_LIMITER_REJECTIONS = create_metric(
+    'Counter', 'fallora_upstream_limiter_rejections_total',
+    'Calls given up after waiting UPSTREAM_LIMIT_WAIT_SECONDS for a limiter slot', ['limiter'])
+CIRCUIT_STATE = create_metric(
+    'Gauge', 'fallora_circuit_state',
+    'Circuit breaker state (0 closed, 1 half-open, 2 open)', ['circuit'], multiprocess_mode='livemax')
+CIRCUIT_REJECTIONS = create_metric(
+    'Counter', 'fallora_circuit_rejections_total',
+    'Jobs and calls refused because a circuit was open', ['circuit'])
+SSE_STREAMS_REJECTED = create_metric(
+    'Counter', 'fallora_sse_streams_rejected_total',
+    'Job event streams refused because SSE_MAX_STREAMS were already open')
+GENERATION_WORKERS_BUSY = create_metric(
+    'Gauge', 'fallora_generation_workers_busy',
+    'Generation worker threads running a job', multiprocess_mode='livesum')
+GENERATION_QUEUE_DEPTH = create_metric(
+    'Gauge', 'fallora_generation_queue_depth',
+    'Generation jobs waiting for a worker', multiprocess_mode='livesum')
+FAL_QUEUE_TRACKED = create_metric(
+    'Gauge', 'fallora_fal_queue_requests_tracked',
+    'fal.ai queue requests being polled', multiprocess_mode='livesum')
+ASYNC_UPSTREAM_INFLIGHT = create_metric(
+    'Gauge', 'fallora_async_upstream_inflight',
+    'Coroutines running on the async upstream loop', multiprocess_mode='livesum')
+# A shared SQLite store reports the same counts from every process; in-memory stores add up
+JOB_STORE_JOBS = create_metric(
+    'Gauge', 'fallora_job_store_jobs', 'Jobs in the job store by status', ['status'],
+    multiprocess_mode='mostrecent' if JOB_STORE_BACKEND == 'sqlite' else 'livesum')
+
+def failure_status(error):
+    """Metric label for a failure: the upstream HTTP status, 'timeout' or 'error'"""
+    status_code = getattr(error, 'status_code', None)
+    if status_code:
+        return str(status_code)
+    if isinstance(error, requests.Timeout) or (httpx and isinstance(error, httpx.TimeoutException)):
+        return 'timeout'
+    return 'error'
+
+def timed_route(duration, failures):
+    """Decorator: observe a JSON view's duration by cache_hit and count error responses"""
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            response = app.make_response(view(*args, **kwargs))
+            if response.status_code >= 400:
+                failures.labels(status=str(response.status_code)).inc()
+            else:
+                cache_hit = bool((response.get_json(silent=True) or {}).get('cache_hit'))
+                duration.labels(cache_hit=str(cache_hit).lower()).observe(time.perf_counter() - start)
+            return response
+        return wrapper
+    return decorator
+
+def job_matches(job, expect):
+    """Whether job has every field value in expect (None matches any job)"""
+    return not expect or all(job.get(key) == value for key, value in expect.items())
+
+class JobStore:
+    """Base class providing change notification for job store backends.
+
+    Every create/update/delete bumps a per-job version and wakes threads blocked
+    in wait_for_changes, which lets the SSE endpoints push updates instead of
+    polling. Versions of finished or deleted jobs are dropped, which still reads
+    as a change to any waiter holding an older version.
+    """
+
+    # Seconds between re-reads for waiters when other processes may change jobs
+    # without signalling this process (None: every change is signalled locally)
+    change_poll_interval = None
+
+    def __init__(self):
+        self._changed = threading.Condition()
+        self._versions = {}  # job_id -> version of the last change
+        self._version_counter = 0
+
+    def _notify(self, job_id, status=None):
+        with self._changed:
+            self._version_counter += 1
+            if status is None or status in TERMINAL_JOB_STATUSES:
+                self._versions.pop(job_id, None)
+            else:
+                self._versions[job_id] = self._version_counter
+            self._changed.notify_all()
+
+    def version(self, job_id):
+        with self._changed:
+            return self._versions.get(job_id, 0)
+
+    def wait_for_changes(self, seen, timeout):
+        """Block until any job in seen (job_id -> version) changes; returns the changed ids"""
+        deadline = time.monotonic() + timeout
+        with self._changed:
+            while True:
+                changed = [job_id for job_id, version in seen.items()
+                           if self._versions.get(job_id, 0) != version]
+                remaining = deadline - time.monotonic()
+                if changed or remaining <= 0:
+                    return changed
+                self._changed.wait(remaining)
+
+class InMemoryJobStore(JobStore):
+    """Process-local job store with TTL and size-bounded eviction.
+
+    Only finished jobs are evicted. They are kept in order of their last update,
+    so eviction pops from the head: jobs last updated more than JOB_TTL_SECONDS
+    ago, then the oldest ones while the store holds more than max_jobs entries
+    or roughly max_bytes of finished-job data. A job's serialized size is
+    estimated once when it finishes, outside the store lock.
+    """
+
+    def __init__(self, ttl_seconds, max_jobs, max_bytes):
+        super().__init__()
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._jobs = {}                 # job_id -> job
+        self._finished = OrderedDict()  # job_id -> approximate serialized size, oldest update first
+        self._by_status = {}            # status -> set of job_ids
+        self._finished_bytes = 0
+
+    @staticmethod
+    def _estimate_size(job):
+        return len(json.dumps(job, default=str))
+
+    def _index(self, job_id, old_status, new_status):
+        if old_status == new_status:
+            return
+        if old_status is not None:
+            self._by_status.get(old_status, set()).discard(job_id)
+        if new_status is not None:
+            self._by_status.setdefault(new_status, set()).add(job_id)
+
+    def _store(self, job_id, job):
+        # Caller must hold self._lock; returns whether the job is finished and needs _account()
+        previous = self._jobs.get(job_id)
+        self._jobs[job_id] = job
+        self._index(job_id, previous['status'] if previous else None, job['status'])
+        size = self._finished.pop(job_id, 0)
+        if job['status'] not in TERMINAL_JOB_STATUSES:
+            self._finished_bytes -= size
+            return False
+        # Keeps its previous size until _account() measures the new version
+        self._finished[job_id] = size
+        return True
+
+    def _account(self, job_id, job):
+        """Record the size of a finished job stored by _store(), then evict"""
+        size = self._estimate_size(job)
+        with self._lock:
+            # A later update or a removal got there first; that writer accounts for it
+            if self._jobs.get(job_id) is not job:
+                return
+            self._finished_bytes += size - self._finished[job_id]
+            self._finished[job_id] = size
+            self._evict()
+
+    def _remove(self, job_id):
+        job = self._jobs.pop(job_id, None)
+        if job is None:
+            return None
+        self._finished_bytes -= self._finished.pop(job_id, 0)
+        self._index(job_id, job['status'], None)
+        self._notify(job_id)
+        return job
+
+    def _evict(self):
+        # Caller must hold self._lock
+        cutoff = datetime.now().timestamp() - self.ttl_seconds
+        while self._finished:
+            job_id = next(iter(self._finished))
+            if (self._jobs[job_id]['updated_at'].timestamp() >= cutoff
+                    and len(self._jobs) <= self.max_jobs and self._finished_bytes <= self.max_bytes):
+                break
+            self._remove(job_id)
+
+    def create(self, job_id, job):
+        job = dict(job)
+        with self._lock:
+            finished = self._store(job_id, job)
+            self._evict()
+        if finished:
+            self._account(job_id, job)
+        self._notify(job_id, job['status'])
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job is not None else None
+
+    def update(self, job_id, fields, expect=None):
+        """Merge fields into a job and bump updated_at.
+
+        Returns False if the job is gone or any field in expect has another value.
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+            if job is None or not job_matches(job, expect):
+                return False
+            updated = dict(job)
+            updated.update(fields)
+            updated['updated_at'] = datetime.now()
+            finished = self._store(job_id, updated)
+            self._evict()
+        if finished:
+            self._account(job_id, updated)
+        self._notify(job_id, updated['status'])
+        return True
+
+    def delete(self, job_id):
+        with self._lock:
+            return self._remove(job_id) is not None
+
+    def ids_by_status(self, status):
+        with self._lock:
+            return list(self._by_status.get(status, ()))
+
+    def count(self):
+        with self._lock:
+            return len(self._jobs)
+
+class SQLiteJobStore(JobStore):
+    """Job store persisted to a SQLite database in WAL mode.
+
+    Jobs survive a restart of the process. The status and timestamps live in
+    indexed columns; everything else is kept as a JSON document, so job fields
+    other than created_at/updated_at must be JSON serializable.
+    """
+
+    SWEEP_INTERVAL = 60  # seconds between eviction sweeps
+
+    # Other worker processes share the database, so their updates are only seen by re-reading
+    change_poll_interval = 1.0
+
+    def __init__(self, path, ttl_seconds, max_jobs):
+        super().__init__()
+        self.path = path
+        self.ttl_seconds = ttl_seconds
+        self.max_jobs = max_jobs
+        self._local = threading.local()
+        self._last_sweep = 0
+        with self._connect() as conn:
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS jobs (
+                    job_id TEXT PRIMARY KEY,
+                    status TEXT NOT NULL,
+                    created_at TEXT NOT NULL,
+                    updated_at TEXT NOT NULL,
+                    data TEXT NOT NULL
+                )
+            """)
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_status ON jobs (status)")
+            conn.execute("CREATE INDEX IF NOT EXISTS idx_jobs_updated_at ON jobs (updated_at)")
+
+    def _connect(self):
+        # One connection per thread; sqlite3 connections must not be shared across threads
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    @staticmethod
+    def _row_to_job(row):
+        status, created_at, updated_at, data = row
+        job = json.loads(data)
+        job['status'] = status
+        job['created_at'] = datetime.fromisoformat(created_at)
+        job['updated_at'] = datetime.fromisoformat(updated_at)
+        return job
+
+    @staticmethod
+    def _job_to_row(job_id, job):
+        data = {k: v for k, v in job.items() if k not in ('status', 'created_at', 'updated_at')}
+        return (
+            job_id,
+            job['status'],
+            job['created_at'].isoformat(),
+            job['updated_at'].isoformat(),
+            json.dumps(data)
         )
-        thread.daemon = True
-        thread.start()
-        
-        print(f"Job {job_id}: Submitted for async processing")
-        
-        # Return job ID immediately to avoid Cloudflare timeout
-        return jsonify({
-            'job_id': job_id,
-            'status': 'pending',
-            'message': 'Image generation job submitted successfully'
-        })
-        
+
+    def _maybe_evict(self, conn):
+        now = time.time()
+        if now - self._last_sweep < self.SWEEP_INTERVAL:
+            return
+        self._last_sweep = now
+        cutoff = datetime.fromtimestamp(now - self.ttl_seconds).isoformat()
+        placeholders = ','.join('?' * len(TERMINAL_JOB_STATUSES))
+        conn.execute(
+            f"DELETE FROM jobs WHERE status IN ({placeholders}) AND updated_at < ?",
+            (*TERMINAL_JOB_STATUSES, cutoff)
+        )
+        conn.execute(
+            f"""DELETE FROM jobs WHERE status IN ({placeholders}) AND job_id NOT IN (
+                    SELECT job_id FROM jobs ORDER BY updated_at DESC LIMIT ?
+                )""",
+            (*TERMINAL_JOB_STATUSES, self.max_jobs)
+        )
+
+    def create(self, job_id, job):
+        conn = self._connect()
+        with conn:
+            conn.execute(
+                "INSERT OR REPLACE INTO jobs (job_id, status, created_at, updated_at, data) VALUES (?, ?, ?, ?, ?)",
+                self._job_to_row(job_id, job)
+            )
+            self._maybe_evict(conn)
+        self._notify(job_id, job['status'])
+
+    def get(self, job_id):
+        row = self._connect().execute(
+            "SELECT status, created_at, updated_at, data FROM jobs WHERE job_id = ?", (job_id,)
+        ).fetchone()
+        return self._row_to_job(row) if row else None
+
+    def update(self, job_id, fields, expect=None):
+        """Merge fields into a job and bump updated_at.
+
+        Returns False if the job is gone or any field in expect has another value.
+        """
+        conn = self._connect()
+        with conn:
+            # BEGIN IMMEDIATE serializes concurrent read-modify-write cycles
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute(
+                "SELECT status, created_at, updated_at, data FROM jobs WHERE job_id = ?", (job_id,)
+            ).fetchone()
+            if not row:
+                return False
+            job = self._row_to_job(row)
+            if not job_matches(job, expect):
+                return False
+            job.update(fields)
+            job['updated_at'] = datetime.now()
+            conn.execute(
+                "UPDATE jobs SET status = ?, created_at = ?, updated_at = ?, data = ? WHERE job_id = ?",
+                self._job_to_row(job_id, job)[1:] + (job_id,)
+            )
+            self._maybe_evict(conn)
+        self._notify(job_id, job['status'])
+        return True
+
+    def delete(self, job_id):
+        conn = self._connect()
+        with conn:
+            deleted = conn.execute("DELETE FROM jobs WHERE job_id = ?", (job_id,)).rowcount > 0
+        self._notify(job_id)
+        return deleted
+
+    def ids_by_status(self, status):
+        rows = self._connect().execute("SELECT job_id FROM jobs WHERE status = ?", (status,)).fetchall()
+        return [row[0] for row in rows]
+
+    def count(self):
+        return self._connect().execute("SELECT COUNT(*) FROM jobs").fetchone()[0]
+
+def create_job_store():
+    """Build the job store selected by JOB_STORE_BACKEND"""
+    if JOB_STORE_BACKEND == 'sqlite':
+        storage_log.info("Using SQLite job store at %s", JOB_STORE_PATH)
+        return SQLiteJobStore(JOB_STORE_PATH, JOB_TTL_SECONDS, JOB_STORE_MAX_JOBS)
+    if JOB_STORE_BACKEND != 'memory':
+        storage_log.warning("Unknown JOB_STORE_BACKEND '%s', falling back to memory", JOB_STORE_BACKEND)
+    return InMemoryJobStore(JOB_TTL_SECONDS, JOB_STORE_MAX_JOBS, JOB_STORE_MAX_BYTES)
+
+# Job store for async image generation
+JOB_STORE = create_job_store()
+
+# Upstream responses worth retrying: rate limiting and transient server errors
+RETRY_STATUS_CODES = (429, 500, 502, 503, 504)
+
+class UpstreamAPIError(Exception):
+    """An upstream service answered with an error status"""
+
+    def __init__(self, message, status_code):
+        super().__init__(message)
+        self.status_code = status_code
+
+class UpstreamBusyError(UpstreamAPIError):
+    """No upstream limiter slot became free in time, so the call was never sent"""
+
+    def __init__(self, limiter_name, waited):
+        super().__init__(f"{limiter_name} is at its request limit (waited {waited:.0f}s), please retry shortly", 429)
+
+class UpstreamCallAborted(Exception):
+    """The caller gave up on a call (its job ended) before it was sent"""
+
+def parse_retry_after(response):
+    """Seconds to wait according to a response's Retry-After header, or None"""
+    retry_after = response.headers.get('Retry-After') if response is not None else None
+    if not retry_after:
+        return None
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        try:
+            return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+        except (TypeError, ValueError):
+            return None
+
+class AdaptiveLimiter:
+    """Token bucket plus AIMD concurrency limit for the calls to one upstream or endpoint.
+
+    A call needs a token (refilled at rate per second, bursting up to one
+    second's worth; rate 0 disables the bucket) and a slot under the current
+    concurrency limit. Each successful call raises the limit by 1/limit, about
+    one per round of calls, up to max_limit. A 429, 503 or timeout multiplies it
+    by decrease_factor, at most once per cooldown so a burst of rejections from
+    the same round only counts once, and a Retry-After pauses new calls.
+    """
+
+    OVERLOAD_STATUS_CODES = (429, 503)
+
+    def __init__(self, name, max_limit, min_limit, rate, decrease_factor, acquire_timeout, cooldown=1.0):
+        self.name = name
+        self.max_limit = max(1, max_limit)
+        self.min_limit = max(1, min(min_limit, self.max_limit))
+        self.limit = float(self.max_limit)
+        self.rate = max(0.0, rate)
+        self.burst = max(1.0, self.rate)
+        self.tokens = self.burst
+        self.decrease_factor = decrease_factor
+        self.acquire_timeout = acquire_timeout
+        self.cooldown = cooldown
+        self.inflight = 0
+        self._refilled_at = time.monotonic()
+        self._paused_until = 0.0
+        self._last_decrease = 0.0
+        self._cond = threading.Condition()
+        self._async_waiters = deque()  # (loop, future) of coroutines waiting for a slot, oldest first
+        self._export()
+
+    def _export(self):
+        UPSTREAM_CONCURRENCY_LIMIT.labels(self.name).set(int(self.limit))
+        UPSTREAM_LIMITER_INFLIGHT.labels(self.name).set(self.inflight)
+
+    def _take(self):
+        # Caller holds _cond. Takes a slot and a token and returns 0, or returns the seconds
+        # until a token is due or the pause ends (None: wait for a release)
+        now = time.monotonic()
+        if now < self._paused_until:
+            return self._paused_until - now
+        if self.inflight >= int(self.limit):
+            return None
+        if self.rate:
+            self.tokens = min(self.burst, self.tokens + (now - self._refilled_at) * self.rate)
+            self._refilled_at = now
+            if self.tokens < 1:
+                return (1 - self.tokens) / self.rate
+            self.tokens -= 1
+        self.inflight += 1
+        self._export()
+        return 0
+
+    def acquire(self):
+        """Block until the call may go ahead; raises UpstreamBusyError after acquire_timeout"""
+        started = time.monotonic()
+        with self._cond:
+            while True:
+                wait = self._take()
+                if wait == 0:
+                    break
+                remaining = started + self.acquire_timeout - time.monotonic()
+                if remaining <= 0:
+                    UPSTREAM_LIMITER_REJECTIONS.labels(self.name).inc()
+                    raise UpstreamBusyError(self.name, time.monotonic() - started)
+                self._cond.wait(remaining if wait is None else min(wait, remaining))
+        UPSTREAM_LIMITER_WAIT.labels(self.name).observe(time.monotonic() - started)
+
+    async def acquire_async(self):
+        """acquire() for coroutines: waits on a future that release() resolves instead of blocking the loop"""
+        started = time.monotonic()
+        loop = asyncio.get_running_loop()
+        while True:
+            remaining = started + self.acquire_timeout - time.monotonic()
+            with self._cond:
+                wait = self._take()
+                if wait == 0:
+                    break
+                if remaining <= 0:
+                    UPSTREAM_LIMITER_REJECTIONS.labels(self.name).inc()
+                    raise UpstreamBusyError(self.name, time.monotonic() - started)
+                entry = (loop, loop.create_future())
+                self._async_waiters.append(entry)
+            waiter = entry[1]
+            try:
+                await asyncio.wait_for(waiter, remaining if wait is None else min(wait, remaining))
+            except asyncio.TimeoutError:
+                pass
+            except BaseException:
+                # Leaving without the slot: a wake-up meant for this waiter goes to the next one
+                with self._cond:
+                    if waiter.done() and not waiter.cancelled():
+                        self._wake_async_waiters()
+                raise
+            finally:
+                with self._cond:
+                    if entry in self._async_waiters:
+                        self._async_waiters.remove(entry)
+        UPSTREAM_LIMITER_WAIT.labels(self.name).observe(time.monotonic() - started)
+
+    def _wake_async_waiters(self):
+        # Caller holds _cond. Wakes one waiting coroutine per free slot (at least one)
+        free = max(1, int(self.limit) - self.inflight)
+        while free and self._async_waiters:
+            loop, waiter = self._async_waiters.popleft()
+            try:
+                loop.call_soon_threadsafe(self._resolve_waiter, waiter)
+            except RuntimeError:  # loop closed
+                continue
+            free -= 1
+
+    def _resolve_waiter(self, waiter):
+        # Runs on the waiter's loop; one that already timed out passes the wake-up on
+        if waiter.done():
+            with self._cond:
+                self._wake_async_waiters()
+        else:
+            waiter.set_result(None)
+
+    def release(self, outcome=None, retry_after=None):
+        """Free the slot and adapt the limit to outcome: 'success', 'overload' or None (no signal)"""
+        with self._cond:
+            self.inflight -= 1
+            now = time.monotonic()
+            if outcome == 'success':
+                self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+            elif outcome == 'overload':
+                if retry_after:
+                    self._paused_until = max(self._paused_until, now + retry_after)
+                if now - self._last_decrease >= self.cooldown:
+                    self._last_decrease = now
+                    previous = int(self.limit)
+                    self.limit = max(self.min_limit, self.limit * self.decrease_factor)
+                    UPSTREAM_LIMITER_DECREASES.labels(self.name).inc()
+                    http_log.warning("%s: upstream overloaded, concurrency limit %s -> %s",
+                                     self.name, previous, int(self.limit))
+            self._export()
+            self._cond.notify_all()
+            self._wake_async_waiters()
+
+    def snapshot(self):
+        with self._cond:
+            return {
+                'limit': int(self.limit),
+                'max_limit': self.max_limit,
+                'inflight': self.inflight,
+                'rate': self.rate,
+                'paused_seconds': round(max(0.0, self._paused_until - time.monotonic()), 1)
+            }
+
+def limiter_outcome(response=None, error=None):
+    """Signal a finished call gives its limiters: 'overload', 'success' or None for other errors"""
+    if error is not None:
+        return 'overload' if failure_status(error) == 'timeout' else None
+    if response.status_code in AdaptiveLimiter.OVERLOAD_STATUS_CODES:
+        return 'overload'
+    return 'success' if response.status_code < 500 else None
+
+def release_limiters(limiters, outcome=None, retry_after=None):
+    for limiter in reversed(limiters):
+        limiter.release(outcome, retry_after)
+
+def acquire_limiters(limiters):
+    """Acquire every limiter in order, giving back the ones already held if one times out"""
+    for index, limiter in enumerate(limiters):
+        try:
+            limiter.acquire()
+        except BaseException:
+            release_limiters(limiters[:index])
+            raise
+
+async def acquire_limiters_async(limiters):
+    for index, limiter in enumerate(limiters):
+        try:
+            await limiter.acquire_async()
+        except BaseException:
+            release_limiters(limiters[:index])
+            raise
+
+class CircuitOpenError(UpstreamAPIError):
+    """A call refused without being sent because its upstream's circuit is open"""
+
+    def __init__(self, breaker):
+        super().__init__(f"{breaker.name} is temporarily unavailable after repeated upstream failures", 503)
+        self.retry_after = max(1, math.ceil(breaker.retry_after()))
+
+class CircuitBreaker:
+    """Closed / open / half-open circuit for one upstream endpoint.
+
+    While closed, call outcomes from the last window seconds are kept; once at
+    least min_calls are in the window and failure_rate of them failed, the
+    circuit opens and calls are refused for open_seconds. It then turns
+    half-open and lets one probe call through at a time: a successful probe
+    closes it, a failed one opens it again. A probe that never reports back
+    (its job was cancelled) is replaced after open_seconds.
+    """
+
+    STATE_VALUES = {'closed': 0, 'half_open': 1, 'open': 2}
+
+    def __init__(self, name, failure_rate, min_calls, window, open_seconds):
+        self.name = name
+        self.failure_rate = failure_rate
+        self.min_calls = max(1, min_calls)
+        self.window = window
+        self.open_seconds = open_seconds
+        self.state = 'closed'
+        self._outcomes = deque()  # (monotonic time, failed)
+        self._failures = 0
+        self._opened_at = 0.0
+        self._probe_started = None
+        self._lock = threading.Lock()
+        CIRCUIT_STATE.labels(self.name).set(0)
+
+    def _set_state(self, state):
+        if state != self.state:
+            http_log.warning("%s: circuit %s -> %s", self.name, self.state, state)
+        self.state = state
+        self._outcomes.clear()
+        self._failures = 0
+        self._probe_started = None
+        CIRCUIT_STATE.labels(self.name).set(self.STATE_VALUES[state])
+
+    def _open(self, now):
+        self._set_state('open')
+        self._opened_at = now
+
+    def retry_after(self):
+        """Seconds until the open circuit lets a probe through (0 when not open)"""
+        if self.state != 'open':
+            return 0.0
+        return max(0.0, self._opened_at + self.open_seconds - time.monotonic())
+
+    def accepting(self):
+        """Whether a new job for this upstream would get a call through now (does not take the probe)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                return now - self._opened_at >= self.open_seconds
+            if self.state == 'half_open':
+                return self._probe_started is None or now - self._probe_started >= self.open_seconds
+            return True
+
+    def allow(self):
+        """Let a call through, taking the probe slot when half-open"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'open':
+                if now - self._opened_at < self.open_seconds:
+                    return False
+                self._set_state('half_open')
+            if self.state == 'half_open':
+                if self._probe_started is not None and now - self._probe_started < self.open_seconds:
+                    return False
+                self._probe_started = now
+            return True
+
+    def check(self):
+        """allow(), raising CircuitOpenError when the call is refused"""
+        if not self.allow():
+            CIRCUIT_REJECTIONS.labels(self.name).inc()
+            raise CircuitOpenError(self)
+
+    def record(self, outcome):
+        """Count a finished call: outcome is 'success', 'failure' or None (no signal, e.g. 429)"""
+        with self._lock:
+            now = time.monotonic()
+            if self.state == 'half_open':
+                if outcome == 'success':
+                    self._set_state('closed')
+                elif outcome == 'failure':
+                    self._open(now)
+                else:
+                    self._probe_started = None
+                return
+            if self.state == 'open' or outcome is None:
+                # Calls sent before the circuit opened do not extend it
+                return
+            failed = outcome == 'failure'
+            self._outcomes.append((now, failed))
+            self._failures += failed
+            while self._outcomes and self._outcomes[0][0] < now - self.window:
+                self._failures -= self._outcomes.popleft()[1]
+            if len(self._outcomes) >= self.min_calls and self._failures >= self.failure_rate * len(self._outcomes):
+                self._open(now)
+
+    def snapshot(self):
+        with self._lock:
+            calls = len(self._outcomes)
+            state = self.state
+            if state == 'open' and self.retry_after() == 0:
+                state = 'half_open'  # the next call is let through as a probe
+            return {
+                'state': state,
+                'recent_calls': calls,
+                'recent_failure_rate': round(self._failures / calls, 2) if calls else 0.0,
+                'retry_after': math.ceil(self.retry_after())
+            }
+
+def circuit_outcome(response=None, error=None):
+    """How a finished call counts for its circuit: 'failure' for 5xx and network errors,
+    None when it says nothing about the upstream's health, else 'success'"""
+    if error is not None:
+        if isinstance(error, requests.RequestException) or (httpx and isinstance(error, httpx.HTTPError)):
+            return 'failure'
+        return None
+    if response.status_code >= 500:
+        return 'failure'
+    return None if response.status_code == 429 else 'success'
+
+class UpstreamClient:
+    """Pooled keep-alive HTTP session for one upstream service.
+
+    Connection and read timeouts are separate: connecting uses the shared
+    HTTP_CONNECT_TIMEOUT while each call passes its own read_timeout. Connection
+    errors and RETRY_STATUS_CODES are retried with full-jitter exponential backoff,
+    honouring Retry-After when the upstream sends one.
+    """
+
+    def __init__(self, name, pool_size, connect_timeout, max_retries, backoff, max_backoff):
+        self.name = name
+        self.connect_timeout = connect_timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    def _retry_delay(self, attempt, response=None):
+        delay = parse_retry_after(response)
+        if delay is not None:
+            return min(delay, self.max_backoff)
+        return random.uniform(0, min(self.max_backoff, self.backoff * (2 ** attempt)))
+
+    def request(self, method, url, read_timeout=30, limiters=(), breaker=None, should_abort=None, **kwargs):
+        """should_abort, if given, is checked once the limiters are held and before every retry;
+        when it returns True the call is not sent and UpstreamCallAborted is raised"""
+        if breaker is not None:
+            breaker.check()
+        UPSTREAM_INFLIGHT.labels(self.name).inc()
+        try:
+            with TRACER.span(f"HTTP {method}", **http_span_attributes(self.name, method, url)) as span:
+                try:
+                    response = self._request(method, url, read_timeout, limiters, should_abort, **kwargs)
+                except BaseException as e:
+                    if breaker is not None:
+                        breaker.record(circuit_outcome(error=e))
+                    raise
+                if breaker is not None:
+                    breaker.record(circuit_outcome(response))
+                if span:
+                    span.set_attribute('http.status_code', response.status_code)
+                return response
+        finally:
+            UPSTREAM_INFLIGHT.labels(self.name).dec()
+
+    def _request(self, method, url, read_timeout, limiters, should_abort, **kwargs):
+        # Limiter slots are held per attempt, not across retry delays
+        attempt = 0
+        while True:
+            acquire_limiters(limiters)
+            # Waiting for a slot can take a while; the caller may no longer want the call
+            if should_abort is not None and should_abort():
+                release_limiters(limiters)
+                raise UpstreamCallAborted(f"{self.name}: {method} abandoned before it was sent")
+            try:
+                response = self.session.request(
+                    method, url, timeout=(self.connect_timeout, read_timeout), **kwargs
+                )
+            except requests.RequestException as e:
+                release_limiters(limiters, limiter_outcome(error=e))
+                UPSTREAM_RESPONSES.labels(self.name, failure_status(e)).inc()
+                if not isinstance(e, requests.ConnectionError) or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                http_log.warning("%s: %s failed (%s), retrying in %.1fs", self.name, method, e, delay)
+            except BaseException:
+                release_limiters(limiters)
+                raise
+            else:
+                release_limiters(limiters, limiter_outcome(response), parse_retry_after(response))
+                UPSTREAM_RESPONSES.labels(self.name, str(response.status_code)).inc()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                http_log.warning("%s: %s returned %s, retrying in %.1fs", self.name, method, response.status_code, delay)
+                response.close()
+            if should_abort is not None and should_abort():
+                raise UpstreamCallAborted(f"{self.name}: {method} abandoned before retrying")
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            time.sleep(delay)
+            attempt += 1
+
+    def get(self, url, **kwargs):
+        return self.request('GET', url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.request('POST', url, **kwargs)
+
+    def put(self, url, **kwargs):
+        return self.request('PUT', url, **kwargs)
+
+def http_span_attributes(upstream, method, url):
+    # Query strings may carry tokens, so only scheme, host and path are recorded
+    parsed = urlparse(url)
+    return {'upstream': upstream, 'http.method': method, 'http.url': f"{parsed.scheme}://{parsed.netloc}{parsed.path}"}
+
+def create_upstream_client(name):
+    return UpstreamClient(
+        name,
+        HTTP_POOL_SIZE,
+        HTTP_CONNECT_TIMEOUT,
+        HTTP_MAX_RETRIES,
+        HTTP_RETRY_BACKOFF,
+        HTTP_RETRY_MAX_BACKOFF
+    )
+
+# One pooled client per upstream; MEDIA_CLIENT fetches result and reference images
+FAL_CLIENT = create_upstream_client('fal.ai')
+ZAI_CLIENT = create_upstream_client('z.ai')
+MEDIA_CLIENT = create_upstream_client('media')
+
+def create_limiter(name, max_limit, rate):
+    return AdaptiveLimiter(
+        name,
+        max(1, max_limit // UPSTREAM_LIMIT_SHARDS),
+        UPSTREAM_MIN_CONCURRENCY,
+        rate / UPSTREAM_LIMIT_SHARDS,
+        UPSTREAM_LIMIT_DECREASE_FACTOR,
+        UPSTREAM_LIMIT_WAIT_SECONDS
+    )
+
+# fal.ai generation calls hold a slot of the account-wide limiter and of their model's endpoint
+# limiter; status polls and cancels are not limited. Endpoint limiters only bound concurrency
+FAL_LIMITER = create_limiter('fal.ai', FAL_MAX_CONCURRENCY, FAL_RATE_LIMIT)
+FAL_ENDPOINT_LIMITERS = {
+    model: create_limiter(model, FAL_ENDPOINT_MAX_CONCURRENCY, 0) for model in FAL_ENDPOINTS
+}
+ZAI_LIMITER = create_limiter('z.ai', ZAI_MAX_CONCURRENCY, ZAI_RATE_LIMIT)
+
+def fal_limiters(model):
+    """Limiters a fal.ai generation call for model has to pass, outermost first"""
+    return (FAL_LIMITER, FAL_ENDPOINT_LIMITERS[model]) if UPSTREAM_LIMITER_ENABLED else ()
+
+ZAI_LIMITERS = (ZAI_LIMITER,) if UPSTREAM_LIMITER_ENABLED else ()
+
+def create_circuit_breaker(name):
+    return CircuitBreaker(
+        name,
+        CIRCUIT_FAILURE_RATE,
+        CIRCUIT_MIN_CALLS,
+        CIRCUIT_WINDOW_SECONDS,
+        CIRCUIT_OPEN_SECONDS
+    )
+
+# One circuit per fal.ai model endpoint, so a degraded endpoint does not take the others down
+FAL_BREAKERS = {model: create_circuit_breaker(model) for model in FAL_ENDPOINTS} if CIRCUIT_BREAKER_ENABLED else {}
+ZAI_BREAKER = create_circuit_breaker('z.ai') if CIRCUIT_BREAKER_ENABLED else None
+
+class AsyncUpstreamClient:
+    """asyncio counterpart of UpstreamClient, backed by an httpx.AsyncClient.
+
+    Same timeouts and retry policy; responses expose the parts of the requests
+    API the app uses (status_code, headers, text, json(), raise_for_status()).
+    The httpx client is created on first use so it belongs to the running loop.
+    """
+
+    RETRY_EXCEPTIONS = (httpx.ConnectError, httpx.ConnectTimeout, httpx.RemoteProtocolError) if httpx else ()
+
+    def __init__(self, name, pool_size, connect_timeout, max_retries, backoff, max_backoff):
+        self.name = name
+        self.pool_size = pool_size
+        self.connect_timeout = connect_timeout
+        self.max_retries = max(0, max_retries)
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self._client = None
+
+    _retry_delay = UpstreamClient._retry_delay
+
+    def _get_client(self):
+        if self._client is None:
+            limits = httpx.Limits(max_connections=self.pool_size, max_keepalive_connections=self.pool_size)
+            self._client = httpx.AsyncClient(limits=limits)
+        return self._client
+
+    async def request(self, method, url, read_timeout=30, limiters=(), breaker=None, should_abort=None, **kwargs):
+        if breaker is not None:
+            breaker.check()
+        UPSTREAM_INFLIGHT.labels(self.name).inc()
+        try:
+            with TRACER.span(f"HTTP {method}", **http_span_attributes(self.name, method, url)) as span:
+                try:
+                    response = await self._request(method, url, read_timeout, limiters, should_abort, **kwargs)
+                except BaseException as e:
+                    if breaker is not None:
+                        breaker.record(circuit_outcome(error=e))
+                    raise
+                if breaker is not None:
+                    breaker.record(circuit_outcome(response))
+                if span:
+                    span.set_attribute('http.status_code', response.status_code)
+                return response
+        finally:
+            UPSTREAM_INFLIGHT.labels(self.name).dec()
+
+    async def _request(self, method, url, read_timeout, limiters, should_abort, **kwargs):
+        client = self._get_client()
+        timeout = httpx.Timeout(read_timeout, connect=self.connect_timeout)
+        attempt = 0
+        while True:
+            await acquire_limiters_async(limiters)
+            # should_abort may read the job store, so it runs off the loop
+            if should_abort is not None and await asyncio.to_thread(should_abort):
+                release_limiters(limiters)
+                raise UpstreamCallAborted(f"{self.name}: {method} abandoned before it was sent")
+            try:
+                response = await client.request(method, url, timeout=timeout, **kwargs)
+            except httpx.HTTPError as e:
+                release_limiters(limiters, limiter_outcome(error=e))
+                UPSTREAM_RESPONSES.labels(self.name, failure_status(e)).inc()
+                if not isinstance(e, self.RETRY_EXCEPTIONS) or attempt >= self.max_retries:
+                    raise
+                delay = self._retry_delay(attempt)
+                http_log.warning("%s: %s failed (%s), retrying in %.1fs", self.name, method, e, delay)
+            except BaseException:
+                # Cancelled jobs abort the request with CancelledError
+                release_limiters(limiters)
+                raise
+            else:
+                release_limiters(limiters, limiter_outcome(response), parse_retry_after(response))
+                UPSTREAM_RESPONSES.labels(self.name, str(response.status_code)).inc()
+                if response.status_code not in RETRY_STATUS_CODES or attempt >= self.max_retries:
+                    return response
+                delay = self._retry_delay(attempt, response)
+                http_log.warning("%s: %s returned %s, retrying in %.1fs", self.name, method, response.status_code, delay)
+            if should_abort is not None and await asyncio.to_thread(should_abort):
+                raise UpstreamCallAborted(f"{self.name}: {method} abandoned before retrying")
+            UPSTREAM_RETRIES.labels(self.name).inc()
+            await asyncio.sleep(delay)
+            attempt += 1
+
+    async def get(self, url, **kwargs):
+        return await self.request('GET', url, **kwargs)
+
+    async def post(self, url, **kwargs):
+        return await self.request('POST', url, **kwargs)
+
+class AsyncIORuntime:
+    """Background thread running the event loop shared by every async upstream call.
+
+    Generation workers hand coroutines over with submit(), which returns a
+    concurrent.futures.Future. At most max_inflight coroutines run at once;
+    the rest wait on the loop, not on a thread.
+    """
+
+    def __init__(self, max_inflight):
+        self.max_inflight = max_inflight
+        self._loop = None
+        self._semaphore = None
+        self._inflight = 0
+        self._lock = threading.Lock()
+
+    def _ensure_started(self):
+        with self._lock:
+            if self._loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            started = threading.Event()
+
+            def run_loop():
+                asyncio.set_event_loop(loop)
+                self._semaphore = asyncio.Semaphore(self.max_inflight)
+                started.set()
+                loop.run_forever()
+
+            threading.Thread(target=run_loop, daemon=True, name='async-upstream').start()
+            started.wait()
+            self._loop = loop
+
+    async def _guarded(self, coro, caller_context):
+        # The task runs in its own copy of the loop's context; give it the caller's
+        # log correlation ids and current span instead
+        for var, value in caller_context.items():
+            var.set(value)
+        async with self._semaphore:
+            self._inflight += 1
+            ASYNC_UPSTREAM_INFLIGHT.inc()
+            try:
+                return await coro
+            finally:
+                self._inflight -= 1
+                ASYNC_UPSTREAM_INFLIGHT.dec()
+
+    def submit(self, coro):
+        self._ensure_started()
+        return asyncio.run_coroutine_threadsafe(self._guarded(coro, contextvars.copy_context()), self._loop)
+
+    def inflight_count(self):
+        return self._inflight
+
+ASYNC_UPSTREAM_ENABLED = UPSTREAM_IO_MODE == 'async'
+if ASYNC_UPSTREAM_ENABLED and httpx is None:
+    log.warning("UPSTREAM_IO_MODE=async needs httpx - falling back to threaded upstream calls")
+    ASYNC_UPSTREAM_ENABLED = False
+
+def create_async_upstream_client(name):
+    return AsyncUpstreamClient(
+        name,
+        ASYNC_POOL_SIZE,
+        HTTP_CONNECT_TIMEOUT,
+        HTTP_MAX_RETRIES,
+        HTTP_RETRY_BACKOFF,
+        HTTP_RETRY_MAX_BACKOFF
+    )
+
+ASYNC_IO = AsyncIORuntime(ASYNC_MAX_INFLIGHT)
+# Only generations go through the loop: they are the calls that would otherwise pin a worker
+# thread. Analysis requests hold their WSGI thread until they respond either way, so they
+# stay on the threaded clients
+FAL_ASYNC_CLIENT = create_async_upstream_client('fal.ai')
+
+def clean_ai_prompt(raw_prompt):
+    """Clean up AI-generated prompt by removing artifacts and box markers"""
+    import re
+
+    # Remove box markers
+    cleaned = re.sub(r'<\|begin_of_box\|>|<\|end_of_box\|>', '', raw_prompt)
+
+    # Remove any remaining template brackets with content like [Subject: details]
+    cleaned = re.sub(r'\[([^\]]+)\]', r'\1', cleaned)
+
+    # Clean up extra whitespace
+    cleaned = ' '.join(cleaned.split())
+
+    return cleaned.strip()
+
+def generation_cache_key(endpoint_url, payload):
+    """Content address of a fal.ai request: SHA-256 of the endpoint and canonical payload JSON"""
+    canonical = json.dumps([endpoint_url, payload], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+class GenerationResultCache:
+    """LRU/TTL cache of fal.ai results with in-flight de-duplication.
+
+    The first job for a key becomes the leader and calls fal.ai; identical jobs
+    arriving while it runs are attached as followers and completed (or failed)
+    together with the leader, so only one upstream request is paid for. The
+    in-flight entry belongs to its leader's job id, so a leader that ends more
+    than once (cancelled, then its request returns) cannot end a later leader's.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._results = OrderedDict()  # key -> (stored_at, result)
+        self._inflight = {}            # key -> list of (job_id, context) followers
+        self._leading = {}             # leader job_id -> key
+
+    @property
+    def enabled(self):
+        return self.max_entries > 0 and self.ttl_seconds > 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._results.get(key)
+            if entry is None:
+                return None
+            stored_at, result = entry
+            if time.time() - stored_at > self.ttl_seconds:
+                del self._results[key]
+                return None
+            self._results.move_to_end(key)
+            return result
+
+    def join_or_lead(self, key, job_id, context):
+        """Attach job_id to an in-flight leader and return True, or register it as leader"""
+        with self._lock:
+            if key in self._inflight:
+                self._inflight[key].append((job_id, context))
+                return True
+            self._inflight[key] = []
+            self._leading[job_id] = key
+            return False
+
+    def release_unshared(self, job_id):
+        """Drop job_id's in-flight entry unless duplicates wait on it; returns False if some do"""
+        with self._lock:
+            key = self._leading.get(job_id)
+            if key is None:
+                return True
+            if self._inflight[key]:
+                return False
+            del self._leading[job_id]
+            del self._inflight[key]
+            return True
+
+    def resolve(self, job_id, result=None):
+        """End the in-flight request led by job_id, caching result if given; returns the followers"""
+        with self._lock:
+            key = self._leading.pop(job_id, None)
+            if key is None:
+                return []
+            followers = self._inflight.pop(key)
+            if result is not None:
+                self._results[key] = (time.time(), result)
+                self._results.move_to_end(key)
+                while len(self._results) > self.max_entries:
+                    self._results.popitem(last=False)
+            return followers
+
+RESULT_CACHE = GenerationResultCache(RESULT_CACHE_MAX_ENTRIES, RESULT_CACHE_TTL_SECONDS)
+
+class GenerationDeadlines:
+    """Per-model processing deadlines derived from recent fal.ai latency.
+
+    Keeps the last max_samples upstream latencies of each model; once a model
+    has min_samples, its deadline is multiplier times their p99, clamped to
+    [minimum, maximum]. Until then the default applies.
+    """
+
+    def __init__(self, default, minimum, maximum, multiplier, min_samples, max_samples=200):
+        self.default = default
+        self.minimum = minimum
+        self.maximum = maximum
+        self.multiplier = multiplier
+        self.min_samples = min_samples
+        self.max_samples = max_samples
+        self._lock = threading.Lock()
+        self._samples = {}  # model -> deque of seconds
+
+    def observe(self, model, seconds):
+        """Record one fal.ai round trip (also exported as GENERATION_UPSTREAM_LATENCY)"""
+        GENERATION_UPSTREAM_LATENCY.labels(model).observe(seconds)
+        with self._lock:
+            self._samples.setdefault(model, deque(maxlen=self.max_samples)).append(seconds)
+
+    def deadline(self, model):
+        with self._lock:
+            samples = sorted(self._samples.get(model, ()))
+        if len(samples) < self.min_samples:
+            deadline = self.default
+        else:
+            p99 = samples[min(len(samples) - 1, int(len(samples) * 0.99))]
+            deadline = min(self.maximum, max(self.minimum, p99 * self.multiplier))
+        GENERATION_DEADLINE.labels(model).set(deadline)
+        return deadline
+
+GENERATION_DEADLINES = GenerationDeadlines(
+    JOB_DEADLINE_DEFAULT_SECONDS,
+    JOB_DEADLINE_MIN_SECONDS,
+    JOB_DEADLINE_MAX_SECONDS,
+    JOB_DEADLINE_MULTIPLIER,
+    JOB_DEADLINE_MIN_SAMPLES
+)
+
+def process_owner_id(pid):
+    """pid plus its start time from /proc, so a recycled pid is not taken for the old process"""
+    try:
+        with open(f"/proc/{pid}/stat") as f:
+            start_time = f.read().rsplit(')', 1)[1].split()[19]
+    except (OSError, IndexError):
+        return None
+    return f"{pid}:{start_time}"
+
+# Recorded on every job this process accepts, so others can tell when it has gone
+PROCESS_OWNER = process_owner_id(os.getpid()) or f"{os.getpid()}:0"
+
+def owner_is_alive(owner):
+    """Whether the process that recorded owner (see PROCESS_OWNER) is still running"""
+    pid = int(owner.split(':', 1)[0])
+    if owner.endswith(':0'):
+        # No /proc on this platform; fall back to asking the kernel about the pid
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    return process_owner_id(pid) == owner
+
+def job_has_ended(job_id):
+    """Whether a job was finished elsewhere (cancelled, timed out or expired) while work was in flight"""
+    job = JOB_STORE.get(job_id)
+    return job is None or job['status'] in TERMINAL_JOB_STATUSES
+
+def generation_abandoned(job_id):
+    """should_abort predicate for a job's fal.ai call: True once the job has ended and no
+    duplicates wait on its request (the leader's in-flight entry is dropped then)"""
+    return job_has_ended(job_id) and RESULT_CACHE.release_unshared(job_id)
+
+def finish_generation(job_id, result, context):
+    """Complete a job from a fal.ai result, then cache it and complete attached duplicates"""
+    complete_generation_job(job_id, result, context)
+    if not context.get('cache_leader'):
+        return
+    for follower_id, follower_context in RESULT_CACHE.resolve(job_id, result):
+        try:
+            complete_generation_job(follower_id, result, follower_context, cache_hit=True)
+        except Exception as e:
+            fail_generation(follower_id, e, follower_context)
+
+@job_log_context
+def fail_generation(job_id, error, context=None):
+    """Mark a job failed, along with any duplicates attached to it"""
+    failures = GENERATION_FAILURES.labels(context['actual_model'] if context else 'unknown', failure_status(error))
+    update = {'status': 'failed', 'error': str(error), 'spans': TRACER.job_spans(job_id)}
+    if isinstance(error, CircuitOpenError):
+        update['failure_reason'] = 'circuit_open'
+    # Only a job still processing can fail; a cancelled or timed out one keeps its status
+    if JOB_STORE.update(job_id, update, expect={'status': 'processing'}):
+        job_log.error("Error processing: %s", error)
+        failures.inc()
+        refresh_batch_for_job(job_id)
+    else:
+        job_log.info("Job had already ended when it failed with: %s", error)
+    if context and context.get('cache_leader'):
+        fail_duplicates(job_id, str(error), context['actual_model'], failure_status(error))
+
+def fail_duplicates(job_id, error, model, status):
+    """End the in-flight request led by job_id, failing the duplicates attached to it"""
+    for follower_id, _ in RESULT_CACHE.resolve(job_id):
+        if JOB_STORE.update(follower_id, {'status': 'failed', 'error': error}, expect={'status': 'processing'}):
+            GENERATION_FAILURES.labels(model, status).inc()
+            refresh_batch_for_job(follower_id)
+
+@job_log_context
+@TRACER.traced('generation.complete')
+def complete_generation_job(job_id, result, context, cache_hit=False):
+    """Extract the image from a fal.ai result and mark the job completed"""
+    job_log.debug("fal.ai result keys: %s", list(result))
+    image_urls = MODEL_ADAPTERS[context['actual_model']].extract_image_urls(result)
+
+    # Update job with success result
+    completed = JOB_STORE.update(job_id, {
+        'status': 'completed',
+        'spans': TRACER.job_spans(job_id),
+        'result': {
+            'images': [{'url': url} for url in image_urls],
+            'metadata': {
+                'model': context['actual_model'],  # Use actual model (might be switched for reference mode)
+                'original_model': context['base_model'],  # Track original model selection
+                'reference_mode': bool(context['reference_image_url']),  # Track if reference mode was used
+                'loras': context['loras'],
+                'resolution': context['resolution'],
+                'generation_time': result.get('timings', {}),
+                'cache_hit': cache_hit  # True when served from the result cache or a shared in-flight request
+            }
+        }
+    }, expect={'status': 'processing'})
+    if not completed:
+        # Cancelled or timed out while fal.ai was still working (or shared with duplicates)
+        job_log.info("Discarding result of a job that already ended")
+        return
+    
+    job_log.info("Completed successfully", extra={'fields': {'cache_hit': cache_hit, 'images': len(image_urls)}})
+    model = context['actual_model']
+    if 'queued_at' in context:
+        GENERATION_DURATION.labels(model, str(cache_hit).lower()).observe(time.time() - context['queued_at'])
+    inference_time = result.get('timings', {}).get('inference')
+    if not cache_hit and isinstance(inference_time, (int, float)):
+        GENERATION_FAL_INFERENCE.labels(model).observe(inference_time)
+    RESULT_MIRROR.schedule(image_urls)
+    refresh_batch_for_job(job_id)
+
+@TRACER.traced('generation.prepare')
+def prepare_generation(base_model, loras, prompt, resolution, seed=None, negative_prompt=None,
+                       reference_image_url=None, num_images=1):
+    """Validate a generation request and build its fal.ai call, raising GenerationRequestError"""
+    adapter = MODEL_ADAPTERS.get(base_model)
+    if adapter is None:
+        raise GenerationRequestError(f'Unsupported model: {base_model}')
+
+    try:
+        width, height = map(int, resolution.split('x'))
+    except (ValueError, AttributeError):
+        raise GenerationRequestError('Invalid resolution format. Use WIDTHxHEIGHT (e.g., 512x512)')
+
+    # LoRA rules and Civitai categories follow the requested model
+    valid_loras = adapter.resolve_loras(loras)
+
+    # Determine which endpoint to use based on reference image presence
+    actual_model = base_model
+    if reference_image_url and adapter.reference_model:
+        actual_model = adapter.reference_model
+        adapter = MODEL_ADAPTERS[actual_model]
+
+    if reference_image_url and reference_image_url.startswith('/api/reference-images/'):
+        # Convert to absolute URL (fal.ai needs accessible URL)
+        reference_image_url = f"{PUBLIC_BASE_URL}{reference_image_url}"
+
+    payload = adapter.build_payload(
+        prompt, width, height, valid_loras, seed, negative_prompt, reference_image_url, num_images
+    )
+    return {
+        'endpoint_url': adapter.endpoint_url,
+        'payload': payload,
+        # Only seeded requests are deterministic enough to reuse a previous result
+        'cacheable': seed is not None,
+        'context': {
+            'base_model': base_model,
+            'actual_model': actual_model,
+            'loras': loras,
+            'resolution': resolution,
+            'reference_image_url': reference_image_url
+        }
+    }
+
+@job_log_context
+@TRACER.traced('process_image_generation')
+def process_image_generation(job_id, plan):
+    """Background function to process image generation from a prepare_generation plan"""
+    context = None
+    try:
+        started_at = time.time()
+        job = JOB_STORE.get(job_id)
+        endpoint_url = plan['endpoint_url']
+        payload = plan['payload']
+        context = dict(plan['context'], queued_at=job['created_at'].timestamp() if job else started_at)
+        actual_model = context['actual_model']
+
+        # Claiming the job fails if it was cancelled while queued
+        if not JOB_STORE.update(job_id, {
+            'status': 'processing',
+            'started_at': started_at,
+            'deadline_at': started_at + GENERATION_DEADLINES.deadline(actual_model),
+            'model': actual_model
+        }, expect={'status': 'pending'}):
+            job_log.info("Job ended before a worker picked it up")
+            return
+        if job:
+            TRACER.record('generation.queued', int(job['created_at'].timestamp() * 1e9), time.time_ns())
+        GENERATION_QUEUE_WAIT.labels(actual_model).observe(started_at - context['queued_at'])
+
+        job_log.info("Generating with %s", actual_model, extra={'fields': {
+            'endpoint': endpoint_url,
+            'loras': len(payload.get('loras', [])),
+            'resolution': context['resolution'],
+            'seeded': plan['cacheable'],
+            'reference_image': bool(context['reference_image_url'])
+        }})
+
+        # Make request to fal.ai (increased timeout for async processing)
+        headers = {
+            "Authorization": f"Key {FAL_KEY}",
+            "Content-Type": "application/json"
+        }
+
+        if plan['cacheable'] and RESULT_CACHE.enabled:
+            cache_key = generation_cache_key(endpoint_url, payload)
+            cached_result = RESULT_CACHE.get(cache_key)
+            if cached_result is not None:
+                job_log.info("Result cache hit")
+                complete_generation_job(job_id, cached_result, context, cache_hit=True)
+                return
+            if RESULT_CACHE.join_or_lead(cache_key, job_id, context):
+                job_log.info("Attached to identical in-flight request")
+                return
+            context['cache_key'] = cache_key
+            context['cache_leader'] = True
+
+        log_payload(job_log, "fal.ai request payload", payload)
+
+        if FAL_EXECUTION_MODE == 'queue':
+            # Submit and return; FAL_QUEUE_POLLER completes the job when fal.ai is done.
+            # Until then the job still counts against its client's active limit
+            GENERATION_POOL.detach(job_id)
+            submit_fal_queue_request(job_id, endpoint_url, headers, payload, context)
+            return
+
+        if ASYNC_UPSTREAM_ENABLED:
+            # Hand the wait to the event loop so this worker can take the next job
+            GENERATION_POOL.detach(job_id)
+            ASYNC_GENERATIONS.add(job_id, context)
+            future = ASYNC_IO.submit(run_fal_request_async(job_id, endpoint_url, headers, payload, context))
+            ASYNC_GENERATIONS.attach(job_id, future)
+            return
+        
+        upstream_started = time.perf_counter()
+        response = FAL_CLIENT.post(endpoint_url, headers=headers, json=payload, read_timeout=300,  # 5 minute timeout
+                                   limiters=fal_limiters(actual_model), breaker=FAL_BREAKERS.get(actual_model),
+                                   should_abort=functools.partial(generation_abandoned, job_id))
+        GENERATION_DEADLINES.observe(actual_model, time.perf_counter() - upstream_started)
+        result = parse_fal_response(job_id, response)
+        finish_generation(job_id, result, context)
+
+    except UpstreamCallAborted:
+        GENERATION_POOL.release_detached(job_id)
+        job_log.info("Job ended before its fal.ai call was sent")
+    except Exception as e:
+        # The hand-off did not happen, so nothing else will release a detached job
+        GENERATION_POOL.release_detached(job_id)
+        fail_generation(job_id, e, context)
+
+def parse_fal_response(job_id, response):
+    """Return the JSON result of a synchronous fal.ai call, raising on an error status"""
+    job_log.info("fal.ai response status: %s", response.status_code)
+    
+    if response.status_code != 200:
+        error_msg = f"fal.ai API error: {response.status_code}"
+        try:
+            error_data = response.json()
+            error_msg += f" - {error_data.get('detail', 'Unknown error')}"
+        except:
+            error_msg += f" - {response.text}"
+        job_log.warning("fal.ai error: %s", error_msg)
+        raise UpstreamAPIError(error_msg, response.status_code)
+        
+    return response.json()
+
+class AsyncGenerationTracker:
+    """Futures of the generation requests waiting on the event loop, so they can be cancelled"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._jobs = {}  # job_id -> {'context': ..., 'future': concurrent.futures.Future or None}
+
+    def add(self, job_id, context):
+        with self._lock:
+            self._jobs[job_id] = {'context': context, 'future': None}
+
+    def attach(self, job_id, future):
+        with self._lock:
+            # The request may already have finished and been removed
+            if job_id in self._jobs:
+                self._jobs[job_id]['future'] = future
+
+    def remove(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def cancel(self, job_id):
+        """Cancel the task waiting on fal.ai (closing its connection); returns True if one was cancelled"""
+        with self._lock:
+            entry = self._jobs.get(job_id)
+            if entry is None or entry['future'] is None or not RESULT_CACHE.release_unshared(job_id):
+                return False
+            del self._jobs[job_id]
+        cancelled = entry['future'].cancel()
+        # A task cancelled before it started never reaches run_fal_request_async's finally
+        GENERATION_POOL.release_detached(job_id)
+        return cancelled
+
+ASYNC_GENERATIONS = AsyncGenerationTracker()
+
+async def run_fal_request_async(job_id, endpoint_url, headers, payload, context):
+    """Async path of process_image_generation: wait for fal.ai on the event loop"""
+    try:
+        upstream_started = time.perf_counter()
+        response = await FAL_ASYNC_CLIENT.post(endpoint_url, headers=headers, json=payload, read_timeout=300,
+                                               limiters=fal_limiters(context['actual_model']),
+                                               breaker=FAL_BREAKERS.get(context['actual_model']),
+                                               should_abort=functools.partial(generation_abandoned, job_id))
+        GENERATION_DEADLINES.observe(context['actual_model'], time.perf_counter() - upstream_started)
+        result = parse_fal_response(job_id, response)
+        # Completion touches the job store and caches, so keep it off the loop
+        # (to_thread carries the task's context, so the job's span continues there)
+        await asyncio.to_thread(finish_generation, job_id, result, context)
+    except UpstreamCallAborted:
+        job_log.info("Job ended before its fal.ai call was sent")
+    except Exception as e:
+        await asyncio.to_thread(fail_generation, job_id, e, context)
+    except asyncio.CancelledError:
+        # Duplicates attached after the cancel must not wait on this request forever
+        if context.get('cache_leader'):
+            fail_duplicates(job_id, 'Identical request was cancelled, please retry',
+                            context['actual_model'], 'cancelled')
+        raise
+    finally:
+        ASYNC_GENERATIONS.remove(job_id)
+        GENERATION_POOL.release_detached(job_id)
+
+def fal_queue_url(endpoint_url):
+    """Map a synchronous fal.run endpoint to its queue.fal.run equivalent"""
+    return endpoint_url.replace(FAL_RUN_BASE_URL, FAL_QUEUE_BASE_URL.rstrip('/'), 1)
+
+def submit_fal_queue_request(job_id, endpoint_url, headers, payload, context):
+    """Submit a payload to the fal.ai queue and hand the job to FAL_QUEUE_POLLER"""
+    submit_url = fal_queue_url(endpoint_url)
+    params = {'fal_webhook': FAL_WEBHOOK_URL} if FAL_WEBHOOK_URL else None
+
+    context['submitted_at'] = time.time()
+    response = FAL_CLIENT.post(submit_url, headers=headers, json=payload, params=params, read_timeout=30,
+                               limiters=fal_limiters(context['actual_model']),
+                               breaker=FAL_BREAKERS.get(context['actual_model']),
+                               should_abort=functools.partial(generation_abandoned, job_id))
+    job_log.info("fal.ai queue submit status: %s", response.status_code)
+
+    if response.status_code not in (200, 201, 202):
+        error_msg = f"fal.ai queue API error: {response.status_code}"
+        try:
+            error_msg += f" - {response.json().get('detail', 'Unknown error')}"
+        except Exception:
+            error_msg += f" - {response.text}"
+        raise UpstreamAPIError(error_msg, response.status_code)
+
+    submission = response.json()
+    fal_request = {
+        'request_id': submission['request_id'],
+        'status_url': submission.get('status_url'),
+        'response_url': submission.get('response_url'),
+        'cancel_url': submission.get('cancel_url')
+    }
+    JOB_STORE.update(job_id, {'fal_request': fal_request})
+    FAL_QUEUE_POLLER.track(job_id, fal_request, context)
+    job_log.info("Queued on fal.ai as request %s", fal_request['request_id'])
+
+class FalQueuePoller:
+    """Single background poller that resolves every in-flight fal.ai queue request.
+
+    One thread wakes every FAL_POLL_INTERVAL seconds and checks all tracked
+    requests through a small executor, so the thread count stays fixed no matter
+    how many generations are in flight. A webhook call only wakes it up early.
+    """
+
+    def __init__(self, poll_interval, concurrency):
+        self.poll_interval = poll_interval
+        self.concurrency = max(1, concurrency)
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._inflight = {}  # job_id -> {'fal_request': ..., 'context': ...}
+        self._thread = None
+        self._executor = None
+
+    def track(self, job_id, fal_request, context):
+        with self._lock:
+            self._inflight[job_id] = {
+                'fal_request': fal_request,
+                'context': context,
+                'log_context': contextvars.copy_context()  # polls are traced under the job
+            }
+            FAL_QUEUE_TRACKED.set(len(self._inflight))
+            if self._thread is None:
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.concurrency, thread_name_prefix='fal-queue-poll'
+                )
+                self._thread = threading.Thread(target=self._poll_loop, name='fal-queue-poller')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def wake(self, request_id=None):
+        """Trigger an immediate poll; returns False if request_id is not tracked"""
+        if request_id is not None:
+            with self._lock:
+                known = any(
+                    entry['fal_request']['request_id'] == request_id
+                    for entry in self._inflight.values()
+                )
+            if not known:
+                return False
+        self._wake.set()
+        return True
+
+    def inflight_count(self):
+        with self._lock:
+            return len(self._inflight)
+
+    def cancel(self, job_id):
+        """Stop tracking job_id and cancel its fal.ai request; returns True if it was tracked here"""
+        with self._lock:
+            entry = self._inflight.get(job_id)
+            # A leader's request goes on while duplicates are attached to it
+            if entry is None or not RESULT_CACHE.release_unshared(job_id):
+                return False
+        self._finish(job_id)
+        cancel_url = entry['fal_request'].get('cancel_url')
+        if cancel_url:
+            try:
+                response = FAL_CLIENT.put(cancel_url, headers={"Authorization": f"Key {FAL_KEY}"}, read_timeout=10)
+                job_log.info("fal.ai queue cancel status: %s", response.status_code)
+            except requests.RequestException as e:
+                job_log.warning("fal.ai queue cancel failed: %s", e)
+        return True
+
+    def _poll_loop(self):
+        while True:
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()
+            with self._lock:
+                entries = list(self._inflight.items())
+            if entries:
+                # list() drains the iterator so exceptions surface here rather than vanish
+                list(self._executor.map(self._check, entries))
+
+    def _finish(self, job_id):
+        with self._lock:
+            self._inflight.pop(job_id, None)
+            FAL_QUEUE_TRACKED.set(len(self._inflight))
+        GENERATION_POOL.release_detached(job_id)
+
+    def _check(self, item):
+        job_id, entry = item
+        # Each job is checked by one executor thread per round, so its context is never entered twice
+        entry['log_context'].run(self._check_request, job_id, entry)
+
+    def _check_request(self, job_id, entry):
+        fal_request = entry['fal_request']
+        headers = {"Authorization": f"Key {FAL_KEY}"}
+        if job_has_ended(job_id) and self.cancel(job_id):
+            # Cancelled or timed out through another worker process
+            return
+        try:
+            status_response = FAL_CLIENT.get(fal_request['status_url'], headers=headers, read_timeout=30)
+            if status_response.status_code not in (200, 202):
+                job_log.warning("fal.ai status check returned %s", status_response.status_code)
+                return
+            fal_status = status_response.json().get('status')
+            if fal_status != 'COMPLETED':
+                return
+
+            response = FAL_CLIENT.get(fal_request['response_url'], headers=headers, read_timeout=60)
+            job_log.info("fal.ai queue result status: %s", response.status_code)
+            context = entry['context']
+            if 'submitted_at' in context:
+                GENERATION_DEADLINES.observe(context['actual_model'], time.time() - context['submitted_at'])
+            breaker = FAL_BREAKERS.get(context['actual_model'])
+            if breaker is not None:
+                # The submit already counted; a failed result says more about the endpoint's health
+                breaker.record(circuit_outcome(response))
+            if response.status_code != 200:
+                error_msg = f"fal.ai API error: {response.status_code}"
+                try:
+                    error_msg += f" - {response.json().get('detail', 'Unknown error')}"
+                except Exception:
+                    error_msg += f" - {response.text}"
+                raise UpstreamAPIError(error_msg, response.status_code)
+
+            finish_generation(job_id, response.json(), entry['context'])
+            self._finish(job_id)
+        except requests.RequestException as e:
+            # Transient network problem: keep the job tracked and retry next round
+            job_log.warning("fal.ai poll error: %s", e)
+        except Exception as e:
+            fail_generation(job_id, e, entry['context'])
+            self._finish(job_id)
+
+FAL_QUEUE_POLLER = FalQueuePoller(FAL_POLL_INTERVAL, FAL_POLL_CONCURRENCY)
+
+class QueueFullError(Exception):
+    """Raised when the generation queue cannot admit another job"""
+
+    def __init__(self, message, retry_after=10):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+class GenerationWorkerPool:
+    """Fixed-size worker pool with a bounded FIFO admission queue.
+
+    Jobs are taken in submission order, except that a job is skipped (and keeps
+    its place) while its client already has MAX_ACTIVE_JOBS_PER_CLIENT jobs
+    running, so one client's burst cannot occupy every worker. A job handed to
+    the fal.ai queue poller or the async loop is detached: its worker moves on,
+    but it counts against its client until release_detached() is called.
+    """
+
+    def __init__(self, num_workers, max_queue_size, max_active_per_client, max_queued_per_client, max_retired):
+        self.num_workers = max(1, num_workers)
+        self.max_retired = max(0, max_retired)
+        self.max_queue_size = max(1, max_queue_size)
+        self.max_active_per_client = max(1, max_active_per_client)
+        self.max_queued_per_client = max(1, max_queued_per_client)
+        self._cond = threading.Condition()
+        self._queue = deque()  # entries of (job_id, client_id, target, args, submitter's contextvars)
+        self._active = {}      # client_id -> running job count
+        self._queued = {}      # client_id -> waiting job count
+        self._running = 0
+        self._running_jobs = {}  # job_id -> (client_id, worker thread)
+        self._detached = {}      # job_id -> client_id, for jobs waiting on fal.ai without a worker
+        self._workers = []
+        self._retired = set()    # workers released from a cancelled job; they exit when it returns
+        self._started = 0
+
+    def _start_worker(self):
+        worker = threading.Thread(target=self._worker_loop, name=f"generation-worker-{self._started}")
+        worker.daemon = True
+        worker.start()
+        self._workers.append(worker)
+        self._started += 1
+
+    def _ensure_workers(self):
+        # Started lazily so the threads belong to the process that serves requests
+        if self._workers:
+            return
+        for _ in range(self.num_workers):
+            self._start_worker()
+
+    def submit(self, job_id, client_id, target, args):
+        """Admit a job to the queue or raise QueueFullError"""
+        with self._cond:
+            if len(self._queue) >= self.max_queue_size:
+                raise QueueFullError('Generation queue is full, please retry shortly')
+            if self._queued.get(client_id, 0) >= self.max_queued_per_client:
+                raise QueueFullError(
+                    f'Too many queued jobs for this client (limit {self.max_queued_per_client})'
+                )
+            self._ensure_workers()
+            self._queue.append((job_id, client_id, target, args, contextvars.copy_context()))
+            self._queued[client_id] = self._queued.get(client_id, 0) + 1
+            GENERATION_QUEUE_DEPTH.set(len(self._queue))
+            self._cond.notify()
+        return self.position(job_id)
+
+    def position(self, job_id):
+        """Return the 1-based queue position of a waiting job, or None"""
+        with self._cond:
+            for index, entry in enumerate(self._queue):
+                if entry[0] == job_id:
+                    return index + 1
+        return None
+
+    def cancel(self, job_id):
+        """Drop a queued job, or release the worker running it.
+
+        A thread blocked in a synchronous upstream call cannot be interrupted, so
+        its slot is handed to a fresh worker and the old thread exits once the
+        call returns. At most max_retired such threads exist at a time; past that
+        the worker is kept and comes back when its call is abandoned (before it
+        is sent) or returns. Returns 'queued', 'running' or None if the job is not here.
+        """
+        with self._cond:
+            for entry in self._queue:
+                if entry[0] == job_id:
+                    self._queue.remove(entry)
+                    self._release_queued(entry[1])
+                    GENERATION_QUEUE_DEPTH.set(len(self._queue))
+                    return 'queued'
+            running = self._running_jobs.get(job_id)
+            if running is None:
+                return None
+            self._release_running(job_id)
+            if len(self._retired) < self.max_retired:
+                self._retired.add(running[1])
+                self._workers.remove(running[1])
+                self._start_worker()
+            self._cond.notify_all()
+            return 'running'
+
+    def detach(self, job_id):
+        """Keep the running job counted against its client after its worker returns"""
+        with self._cond:
+            running = self._running_jobs.get(job_id)
+            if running is not None:
+                self._detached[job_id] = running[0]
+
+    def release_detached(self, job_id):
+        """Stop counting a detached job against its client; no-op for other jobs"""
+        with self._cond:
+            client_id = self._detached.pop(job_id, None)
+            # While its worker is still on it, _release_running() frees the client's slot
+            if client_id is not None and job_id not in self._running_jobs:
+                self._release_active(client_id)
+                self._cond.notify_all()
+
+    def stats(self):
+        with self._cond:
+            return {
+                'workers': self.num_workers,
+                'running': self._running,
+                'queued': len(self._queue),
+                'detached': len(self._detached),
+                'retired': len(self._retired),
+                'max_queue_size': self.max_queue_size
+            }
+
+    def _release_queued(self, client_id):
+        # Caller must hold self._cond
+        self._queued[client_id] -= 1
+        if not self._queued[client_id]:
+            del self._queued[client_id]
+
+    def _release_running(self, job_id):
+        # Caller must hold self._cond; no-op if cancel() already released the job
+        running = self._running_jobs.pop(job_id, None)
+        if running is None:
+            return
+        self._running -= 1
+        GENERATION_WORKERS_BUSY.set(self._running)
+        if job_id not in self._detached:
+            self._release_active(running[0])
+
+    def _release_active(self, client_id):
+        # Caller must hold self._cond
+        self._active[client_id] -= 1
+        if not self._active[client_id]:
+            del self._active[client_id]
+
+    def _take_next(self):
+        # Caller must hold self._cond
+        for entry in self._queue:
+            if self._active.get(entry[1], 0) < self.max_active_per_client:
+                self._queue.remove(entry)
+                client_id = entry[1]
+                self._release_queued(client_id)
+                self._active[client_id] = self._active.get(client_id, 0) + 1
+                self._running += 1
+                self._running_jobs[entry[0]] = (client_id, threading.current_thread())
+                GENERATION_QUEUE_DEPTH.set(len(self._queue))
+                GENERATION_WORKERS_BUSY.set(self._running)
+                return entry
+        return None
+
+    @staticmethod
+    def _run_job(job_id, target, args):
+        with log_context(job_id=job_id):
+            target(job_id, *args)
+
+    def _worker_loop(self):
+        while True:
+            with self._cond:
+                entry = self._take_next()
+                while entry is None:
+                    self._cond.wait()
+                    entry = self._take_next()
+
+            job_id, client_id, target, args, submit_context = entry
+            try:
+                # Run in the submitter's context so logs and spans join its request
+                submit_context.run(self._run_job, job_id, target, args)
+            except Exception:
+                job_log.exception("Worker error")
+            finally:
+                with self._cond:
+                    self._release_running(job_id)
+                    # A slot for this client opened up, so a skipped job may now be runnable
+                    self._cond.notify_all()
+                    if threading.current_thread() in self._retired:
+                        self._retired.discard(threading.current_thread())
+                        return
+
+GENERATION_POOL = GenerationWorkerPool(
+    GENERATION_WORKERS,
+    GENERATION_QUEUE_SIZE,
+    MAX_ACTIVE_JOBS_PER_CLIENT,
+    MAX_QUEUED_JOBS_PER_CLIENT,
+    GENERATION_MAX_RETIRED_WORKERS
+)
+
+class BatchScheduler:
+    """Feeds the child jobs of a batch into GENERATION_POOL a few at a time.
+
+    At most max_concurrency children of one batch are queued or running; when
+    one returns from its worker the next is submitted. If the pool is full the
+    submission is retried after the QueueFullError retry delay.
+    """
+
+    def __init__(self, pool, max_concurrency):
+        self.pool = pool
+        self.max_concurrency = max(1, max_concurrency)
+        self._lock = threading.Lock()
+        self._batches = {}  # batch_id -> {'client_id', 'pending': deque of (job_id, args), 'running': set of job_ids}
+
+    def start(self, batch_id, client_id, children):
+        """Begin scheduling children; raises QueueFullError if none could be admitted"""
+        with self._lock:
+            self._batches[batch_id] = {'client_id': client_id, 'pending': deque(children), 'running': set()}
+        self._fill(batch_id, retry=False)
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch and not batch['running']:
+                del self._batches[batch_id]
+                raise QueueFullError('Generation queue is full, please retry shortly')
+
+    def _fill(self, batch_id, retry=True):
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return
+            while batch['pending'] and len(batch['running']) < self.max_concurrency:
+                job_id, args = batch['pending'][0]
+                try:
+                    self.pool.submit(job_id, batch['client_id'], self._run_child, (batch_id, args))
+                except QueueFullError as e:
+                    if retry:
+                        timer = threading.Timer(e.retry_after, self._fill, args=(batch_id,))
+                        timer.daemon = True
+                        timer.start()
+                    return
+                batch['pending'].popleft()
+                batch['running'].add(job_id)
+
+    def cancel(self, batch_id, job_id):
+        """Drop a child not yet handed to the pool, or cancel it there (see GenerationWorkerPool.cancel)"""
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None:
+                return None
+            for child in batch['pending']:
+                if child[0] == job_id:
+                    batch['pending'].remove(child)
+                    if not batch['pending'] and not batch['running']:
+                        del self._batches[batch_id]
+                    return 'queued'
+        outcome = self.pool.cancel(job_id)
+        if outcome:
+            self._child_done(batch_id, job_id)
+        return outcome
+
+    def _child_done(self, batch_id, job_id):
+        # A child ends once: cancel() and its returning worker may both get here
+        with self._lock:
+            batch = self._batches.get(batch_id)
+            if batch is None or job_id not in batch['running']:
+                return
+            batch['running'].discard(job_id)
+            if not batch['pending'] and not batch['running']:
+                del self._batches[batch_id]
+        self._fill(batch_id)
+
+    def _run_child(self, job_id, batch_id, args):
+        try:
+            process_image_generation(job_id, *args)
+        finally:
+            self._child_done(batch_id, job_id)
+
+BATCH_SCHEDULER = BatchScheduler(GENERATION_POOL, BATCH_MAX_CONCURRENCY)
+
+def build_batch_summary(batch_id, batch):
+    """Aggregate the status and results of a batch's child jobs"""
+    counts = {'pending': 0, 'processing': 0, 'completed': 0, 'failed': 0, 'cancelled': 0}
+    results = []
+    for child in batch['children']:
+        job = JOB_STORE.get(child['job_id'])
+        status = job['status'] if job else 'failed'
+        counts[status] = counts.get(status, 0) + 1
+        entry = dict(child, status=status)
+        if not job:
+            entry['error'] = 'Job expired'
+        elif status == 'completed':
+            entry['images'] = job['result']['images']
+        elif status in ('failed', 'cancelled'):
+            entry['error'] = job['error']
+        results.append(entry)
+
+    finished = counts['completed'] + counts['failed'] + counts['cancelled']
+    return {
+        'batch_id': batch_id,
+        'total': len(results),
+        'counts': counts,
+        'progress': round(finished / len(results), 3) if results else 1.0,
+        'results': results
+    }
+
+def refresh_batch_for_job(job_id):
+    """Mark a job's parent batch finished once every child has finished"""
+    job = JOB_STORE.get(job_id)
+    batch_id = job.get('batch_id') if job else None
+    if not batch_id:
+        return
+    batch = JOB_STORE.get(batch_id)
+    if not batch or batch['status'] in TERMINAL_JOB_STATUSES:
+        return
+    summary = build_batch_summary(batch_id, batch)
+    counts = summary['counts']
+    if counts['completed'] + counts['failed'] + counts['cancelled'] < summary['total']:
+        return
+    if counts['completed']:
+        JOB_STORE.update(batch_id, {'status': 'completed', 'result': summary})
+    elif counts['failed']:
+        JOB_STORE.update(batch_id, {'status': 'failed', 'error': 'All batch jobs failed'})
+    else:
+        JOB_STORE.update(batch_id, {'status': 'cancelled', 'error': 'All batch jobs were cancelled'})
+
+def release_generation_job(job_id, job):
+    """Stop this process's work on a job that was just ended; returns how far it had got"""
+    if job.get('batch_id'):
+        outcome = BATCH_SCHEDULER.cancel(job['batch_id'], job_id)
+    else:
+        outcome = GENERATION_POOL.cancel(job_id)
+    if ASYNC_GENERATIONS.cancel(job_id) or FAL_QUEUE_POLLER.cancel(job_id):
+        return 'upstream'
+    return outcome or ('queued' if job['status'] == 'pending' else 'running')
+
+@job_log_context
+def cancel_generation_job(job_id):
+    """Mark a job cancelled and stop whatever this process is doing for it.
+
+    Returns False if the job had already finished. Work held by another worker
+    process notices the cancelled status at its next checkpoint (worker start,
+    queue poll or completion).
+    """
+    job = JOB_STORE.get(job_id)
+    if not job or job['status'] in TERMINAL_JOB_STATUSES:
+        return False
+    update = {'status': 'cancelled', 'error': 'Cancelled', 'spans': TRACER.job_spans(job_id)}
+    if not JOB_STORE.update(job_id, update, expect={'status': job['status']}):
+        # Moved on in the meantime; try again against its new status
+        return cancel_generation_job(job_id)
+
+    stage = release_generation_job(job_id, job)
+    GENERATION_CANCELLATIONS.labels(stage).inc()
+    job_log.info("Cancelled", extra={'fields': {'stage': stage}})
+    refresh_batch_for_job(job_id)
+    return True
+
+class JobWatchdog:
+    """Background reaper for generation jobs that can no longer finish on their own.
+
+    Every interval it fails this process's jobs still processing past their
+    deadline_at, freeing the worker and cancelling the fal.ai request. Jobs left
+    pending or processing by a process that has exited (a crashed worker, or
+    the previous run on startup) are taken over: those already submitted to the
+    fal.ai queue are polled again, the rest are re-enqueued from their stored
+    params (JOB_RECOVERY_MODE=requeue, once, if younger than max_age) or failed.
+    The owner check on every update means only one process acts on a job.
+    """
+
+    def __init__(self, interval, recovery_mode, recovery_max_age):
+        self.interval = interval
+        self.recovery_mode = recovery_mode
+        self.recovery_max_age = recovery_max_age
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_run = {}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='job-watchdog')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        # The first pass runs at startup and recovers jobs from the previous run
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                job_log.exception("Job watchdog error")
+            time.sleep(self.interval)
+
+    def run_once(self):
+        now = time.time()
+        actions = {}
+        for status in ('pending', 'processing'):
+            for job_id in JOB_STORE.ids_by_status(status):
+                job = JOB_STORE.get(job_id)
+                if not job or job['status'] != status or job.get('type') == 'batch':
+                    continue
+                owner = job.get('owner')
+                with log_context(job_id=job_id):
+                    if owner != PROCESS_OWNER:
+                        action = None if owner and owner_is_alive(owner) else self._recover(job_id, job, now)
+                    elif status == 'processing' and now > job.get('deadline_at', now):
+                        action = self._time_out(job_id, job, now)
+                    else:
+                        action = None
+                if action:
+                    JOB_WATCHDOG_ACTIONS.labels(action).inc()
+                    actions[action] = actions.get(action, 0) + 1
+        self.last_run = {'finished_at': datetime.now().isoformat(), 'actions': actions}
+        return self.last_run
+
+    def _time_out(self, job_id, job, now):
+        limit = job['deadline_at'] - job['started_at']
+        error = f"Generation timed out after {now - job['started_at']:.0f}s (deadline {limit:.0f}s)"
+        update = {'status': 'failed', 'error': error, 'failure_reason': 'timed_out', 'spans': TRACER.job_spans(job_id)}
+        if not JOB_STORE.update(job_id, update, expect={'status': 'processing', 'owner': PROCESS_OWNER}):
+            return None
+        model = job.get('model') or job['params']['base_model']
+        # Fail duplicates waiting on this job first, so releasing it also cancels its fal.ai request
+        fail_duplicates(job_id, error, model, 'timeout')
+        stage = release_generation_job(job_id, job)
+        GENERATION_FAILURES.labels(model, 'timeout').inc()
+        job_log.warning(error, extra={'fields': {'stage': stage}})
+        refresh_batch_for_job(job_id)
+        return 'timed_out'
+
+    def _recover(self, job_id, job, now):
+        claim = {'status': job['status'], 'owner': job.get('owner')}
+        params = job.get('params') or {}
+        try:
+            plan = prepare_generation(**params)
+        except Exception as e:
+            plan = None
+            job_log.warning("Orphaned job cannot be rebuilt: %s", e)
+
+        # Already paid for on fal.ai: pick the queue request up again instead of resubmitting
+        fal_request = job.get('fal_request')
+        if plan and fal_request and job['status'] == 'processing':
+            if not JOB_STORE.update(job_id, {'owner': PROCESS_OWNER}, expect=claim):
+                return None
+            context = dict(plan['context'], queued_at=job['created_at'].timestamp())
+            FAL_QUEUE_POLLER.track(job_id, fal_request, context)
+            job_log.info("Resumed polling fal.ai request %s of orphaned job", fal_request['request_id'])
+            return 'resumed'
+
+        age = now - job['created_at'].timestamp()
+        attempts = job.get('recovery_attempts', 0)
+        if plan and self.recovery_mode == 'requeue' and age < self.recovery_max_age and not attempts:
+            requeue = {'status': 'pending', 'owner': PROCESS_OWNER, 'recovery_attempts': attempts + 1}
+            if not JOB_STORE.update(job_id, requeue, expect=claim):
+                return None
+            try:
+                GENERATION_POOL.submit(job_id, job.get('client_id', 'recovered'), process_image_generation, (plan,))
+            except QueueFullError as e:
+                claim = {'status': 'pending', 'owner': PROCESS_OWNER}
+                job_log.warning("Could not re-enqueue orphaned job: %s", e)
+            else:
+                job_log.info("Re-enqueued orphaned job")
+                return 'requeued'
+
+        update = {
+            'status': 'failed',
+            'error': 'Job was interrupted by a server restart, please try again',
+            'failure_reason': 'orphaned'
+        }
+        if not JOB_STORE.update(job_id, update, expect=claim):
+            return None
+        job_log.warning("Failed orphaned job")
+        refresh_batch_for_job(job_id)
+        return 'failed'
+
+JOB_WATCHDOG = JobWatchdog(JOB_WATCHDOG_INTERVAL, JOB_RECOVERY_MODE, JOB_RECOVERY_MAX_AGE_SECONDS)
+
+def get_client_id():
+    """Identify the requesting client by address (resolved from X-Forwarded-For by ProxyFix)"""
+    return request.remote_addr or 'unknown'
+
+@app.route('/')
+def serve_index():
+    return send_from_directory(app.root_path, 'index.html')
+
+@app.route('/favicon.ico')
+def serve_favicon():
+    return send_from_directory(app.root_path, 
+                             'favicon.ico', mimetype='image/vnd.microsoft.icon')
+
+@app.route('/favicon.svg')
+def serve_favicon_svg():
+    return send_from_directory(app.root_path, 
+                             'favicon.svg', mimetype='image/svg+xml')
+
+@app.route('/style.css')
+def serve_css():
+    return send_from_directory(app.root_path, 
+                             'style.css', mimetype='text/css')
+
+@app.route('/script.js')
+def serve_js():
+    return send_from_directory(app.root_path, 
+                             'script.js', mimetype='application/javascript')
+
+def circuit_rejection(models):
+    """503 response refusing a submission while the circuit of one of models is open, else None"""
+    for model in models:
+        breaker = FAL_BREAKERS.get(model)
+        if breaker is not None and not breaker.accepting():
+            CIRCUIT_REJECTIONS.labels(model).inc()
+            error = CircuitOpenError(breaker)
+            response = jsonify({'error': str(error), 'circuit': breaker.state})
+            response.headers['Retry-After'] = str(error.retry_after)
+            return response, 503
+    return None
+
+@app.route('/api/generate', methods=['POST'])
+@TRACER.traced('submit_generation_job')
+def submit_generation_job():
+    """Submit an async image generation job"""
+    try:
+        data = request.get_json()
+
+        log_payload(job_log, "/api/generate request", data)
+
+        base_model = data.get('base_model')
+        loras = data.get('loras', [])
+        prompt = data.get('prompt')
+        resolution = data.get('resolution', '512x512')
+        seed = data.get('seed')
+        negative_prompt = data.get('negative_prompt')
+        reference_image_url = data.get('reference_image_url')
+        
+        if not all([base_model, prompt]):
+            return jsonify({'error': 'base_model and prompt are required.'}), 400
+        
+        if not loras:
+            return jsonify({'error': 'At least one LoRA model is required.'}), 400
+
+        try:
+            validate_loras(loras)
+        except GenerationRequestError as e:
+            return jsonify({'error': str(e)}), 400
+            
+        # Validate seed
+        if seed is not None:
+            if not isinstance(seed, int) or seed < 1 or seed > 2147483638:
+                return jsonify({'error': 'Seed must be an integer between 1 and 2,147,483,638.'}), 400
+            
+        if not FAL_KEY:
+            return jsonify({'error': 'Server configuration error: FAL_KEY not configured'}), 500
+            
+        # Validate everything and build the fal.ai payload now, so workers only do network I/O
+        try:
+            plan = prepare_generation(
+                base_model, loras, prompt, resolution, seed, negative_prompt, reference_image_url
+            )
+        except GenerationRequestError as e:
+            return jsonify({'error': str(e)}), 400
+
+        # Fail fast while the endpoint is down instead of queueing a job that would wait on it
+        rejection = circuit_rejection([plan['context']['actual_model']])
+        if rejection:
+            return rejection
+        
+        # Generate unique job ID
+        job_id = str(uuid.uuid4())
+        span = current_span()
+        if span:
+            span.set_attribute('job_id', job_id)
+        
+        # Store job in memory with pending status
+        JOB_STORE.create(job_id, {
+            'status': 'pending',
+            'created_at': datetime.now(),
+            'updated_at': datetime.now(),
+            'trace_id': span.trace_id if span else None,
+            'owner': PROCESS_OWNER,
+            'client_id': get_client_id(),
+            'params': {
+                'base_model': base_model,
+                'loras': loras,
+                'prompt': prompt,
+                'resolution': resolution,
+                'seed': seed,
+                'negative_prompt': negative_prompt,
+                'reference_image_url': reference_image_url
+            }
+        })
+        
+        # Hand the job to the worker pool; reject with 429 when the queue is full
+        try:
+            queue_position = GENERATION_POOL.submit(
+                job_id,
+                get_client_id(),
+                process_image_generation,
+                (plan,)
+            )
+        except QueueFullError as e:
+            JOB_STORE.delete(job_id)
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+        
+        job_log.info("Submitted for async processing", extra={'fields': {'job_id': job_id, 'queue_position': queue_position}})
+        
+        # Return job ID immediately to avoid Cloudflare timeout
+        return jsonify({
+            'job_id': job_id,
+            'status': 'pending',
+            'queue_position': queue_position,
+            'message': 'Image generation job submitted successfully'
+        })
+        
+    except Exception as e:
+        log.exception("Error submitting job")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+def apply_lora_weights(loras, weights):
+    """Override LoRA weights with one sweep value (all LoRAs) or a per-LoRA list"""
+    if weights is None:
+        return loras
+    if not isinstance(weights, list):
+        weights = [weights] * len(loras)
+    return [dict(lora, weight=weight) for lora, weight in zip(loras, weights)] + loras[len(weights):]
+
+def split_num_images(base_model, num_images):
+    """Split images per combination into fal.ai requests, collapsing where num_images is supported"""
+    if not MODEL_ADAPTERS[base_model].supports_num_images:
+        return [1] * num_images
+    chunk = max(1, BATCH_MAX_NUM_IMAGES)
+    return [min(chunk, num_images - start) for start in range(0, num_images, chunk)]
+
+@app.route('/api/generate/batch', methods=['POST'])
+def submit_generation_batch():
+    """Submit a grid of generation jobs (prompts x seeds x LoRA weights) under one batch id"""
+    try:
+        data = request.get_json(silent=True)
+        if not isinstance(data, dict):
+            return jsonify({'error': 'Request body must be a JSON object.'}), 400
+
+        # The sweep axes must be lists; iterating a string would turn each character into a job
+        for field in ('prompts', 'seeds', 'weights', 'loras'):
+            if data.get(field) is not None and not isinstance(data[field], list):
+                return jsonify({'error': f'{field} must be a list.'}), 400
+
+        base_model = data.get('base_model')
+        loras = data.get('loras') or []
+        prompts = data.get('prompts') or ([data['prompt']] if data.get('prompt') else [])
+        seeds = data.get('seeds') or [None]
+        weight_sets = data.get('weights') or [None]
+        resolution = data.get('resolution', '512x512')
+        negative_prompt = data.get('negative_prompt')
+        reference_image_url = data.get('reference_image_url')
+        num_images = data.get('num_images', 1)
+
+        if not base_model or not prompts:
+            return jsonify({'error': 'base_model and prompt (or prompts) are required.'}), 400
+
+        if not loras:
+            return jsonify({'error': 'At least one LoRA model is required.'}), 400
+
+        try:
+            validate_loras(loras)
+        except GenerationRequestError as e:
+            return jsonify({'error': str(e)}), 400
+
+        if not all(isinstance(prompt, str) and prompt.strip() for prompt in prompts):
+            return jsonify({'error': 'prompts must be non-empty strings.'}), 400
+
+        for seed in seeds:
+            if seed is not None and (
+                not isinstance(seed, int) or isinstance(seed, bool) or seed < 1 or seed > 2147483638
+            ):
+                return jsonify({'error': 'Seed must be an integer between 1 and 2,147,483,638.'}), 400
+
+        for weights in weight_sets:
+            values = weights if isinstance(weights, list) else [weights]
+            if weights is not None and (
+                (isinstance(weights, list) and len(values) != len(loras))
+                or not all(isinstance(v, (int, float)) and not isinstance(v, bool) for v in values)
+            ):
+                return jsonify({'error': 'weights must be numbers or lists with one number per LoRA.'}), 400
+        if weight_sets != [None] and base_model == "fal-ai/wan/v2.2-a14b/text-to-image/lora":
+            return jsonify({'error': 'wan/v2.2-a14b LoRAs do not support weight sweeps'}), 400
+
+        if not isinstance(num_images, int) or num_images < 1:
+            return jsonify({'error': 'num_images must be a positive integer.'}), 400
+        if num_images > 1 and seeds != [None]:
+            return jsonify({'error': 'num_images can only be used without explicit seeds.'}), 400
+
+        if not FAL_KEY:
+            return jsonify({'error': 'Server configuration error: FAL_KEY not configured'}), 500
+
+        if base_model not in MODEL_ADAPTERS:
+            return jsonify({'error': f'Unsupported model: {base_model}'}), 400
+
+        combinations = list(itertools.product(prompts, seeds, weight_sets))
+        if len(combinations) * num_images > BATCH_MAX_JOBS:
+            return jsonify({'error': f'Batch too large: at most {BATCH_MAX_JOBS} images per batch'}), 400
+
+        # Validate and build every child's payload before any job is created
+        plans = []
+        try:
+            for prompt, seed, weights in combinations:
+                child_loras = apply_lora_weights(loras, weights)
+                for images in split_num_images(base_model, num_images):
+                    plans.append((prompt, seed, weights, child_loras, images, prepare_generation(
+                        base_model, child_loras, prompt, resolution, seed,
+                        negative_prompt, reference_image_url, images
+                    )))
+        except GenerationRequestError as e:
+            return jsonify({'error': str(e)}), 400
+
+        rejection = circuit_rejection({plan['context']['actual_model'] for *_, plan in plans})
+        if rejection:
+            return rejection
+
+        # Expand the grid into child jobs
+        batch_id = str(uuid.uuid4())
+        client_id = get_client_id()
+        now = datetime.now()
+        children = []
+        scheduled = []
+        for prompt, seed, weights, child_loras, images, plan in plans:
+            job_id = str(uuid.uuid4())
+            JOB_STORE.create(job_id, {
+                'status': 'pending',
+                'created_at': now,
+                'updated_at': now,
+                'batch_id': batch_id,
+                'owner': PROCESS_OWNER,
+                'client_id': client_id,
+                'params': {
+                    'base_model': base_model,
+                    'loras': child_loras,
+                    'prompt': prompt,
+                    'resolution': resolution,
+                    'seed': seed,
+                    'negative_prompt': negative_prompt,
+                    'reference_image_url': reference_image_url,
+                    'num_images': images
+                }
+            })
+            children.append({
+                'job_id': job_id,
+                'prompt': prompt,
+                'seed': seed,
+                'weights': weights,
+                'num_images': images
+            })
+            scheduled.append((job_id, (plan,)))
+
+        JOB_STORE.create(batch_id, {
+            'status': 'processing',
+            'type': 'batch',
+            'created_at': now,
+            'updated_at': now,
+            'params': {
+                'base_model': base_model,
+                'resolution': resolution,
+                'negative_prompt': negative_prompt,
+                'reference_image_url': reference_image_url
+            },
+            'children': children
+        })
+
+        try:
+            BATCH_SCHEDULER.start(batch_id, client_id, scheduled)
+        except QueueFullError as e:
+            for child in children:
+                JOB_STORE.delete(child['job_id'])
+            JOB_STORE.delete(batch_id)
+            response = jsonify({'error': str(e)})
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response, 429
+
+        job_log.info("Submitted batch of %d jobs for %d images", len(children), len(combinations) * num_images, extra={'fields': {'batch_id': batch_id}})
+
+        return jsonify({
+            'batch_id': batch_id,
+            'status': 'processing',
+            'job_ids': [child['job_id'] for child in children],
+            'total': len(children),
+            'message': 'Batch generation submitted successfully'
+        })
+
     except Exception as e:
-        print(f"Error submitting job: {e}")
-        print(traceback.format_exc())
+        log.exception("Error submitting batch")
         return jsonify({'error': f'Server error: {str(e)}'}), 500
 
-@app.route('/api/job/<job_id>', methods=['GET'])
-def get_job_status(job_id):
-    """Get the status of an image generation job"""
-    with JOB_LOCK:
-        job = JOB_STORE.get(job_id)
+@app.route('/api/generate/batch/<batch_id>', methods=['GET'])
+def get_batch_status(batch_id):
+    """Get aggregate progress and results of a batch"""
+    batch = JOB_STORE.get(batch_id)
     
-    if not job:
-        return jsonify({'error': 'Job not found'}), 404
+    if not batch or batch.get('type') != 'batch':
+        return jsonify({'error': 'Batch not found'}), 404
     
+    response = build_batch_summary(batch_id, batch)
+    response['status'] = batch['status']
+    response['created_at'] = batch['created_at'].isoformat()
+    response['updated_at'] = batch['updated_at'].isoformat()
+    return jsonify(response)
+
+def serialize_job_status(job_id, job):
+    """Build the public status payload for a job"""
     response = {
         'job_id': job_id,
         'status': job['status'],
@@ -531,21 +3292,199 @@ def get_job_status(job_id):
         'updated_at': job['updated_at'].isoformat()
     }
     
-    if job['status'] == 'completed':
+    if job['status'] == 'pending':
+        response['queue_position'] = GENERATION_POOL.position(job_id)
+    elif job['status'] == 'completed':
         response['result'] = job['result']
-    elif job['status'] == 'failed':
+    elif job['status'] in ('failed', 'cancelled'):
         response['error'] = job['error']
+        if job.get('failure_reason'):
+            response['failure_reason'] = job['failure_reason']  # timed_out, orphaned or circuit_open
+
+    # Spans recorded in this process are the most complete; otherwise use the ones
+    # saved with the finished job
+    spans = TRACER.job_spans(job_id) or job.get('spans')
+    if job.get('trace_id') or spans:
+        response['trace'] = {'trace_id': job.get('trace_id'), 'spans': spans or []}
     
-    return jsonify(response)
+    return response
+
+@app.route('/api/job/<job_id>', methods=['GET'])
+def get_job_status(job_id):
+    """Get the status of an image generation job"""
+    job = JOB_STORE.get(job_id)
+    
+    if not job:
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return jsonify(serialize_job_status(job_id, job))
+
+@app.route('/api/job/<job_id>', methods=['DELETE'])
+def cancel_job(job_id):
+    """Cancel a pending or running generation job, or every unfinished job of a batch"""
+    try:
+        job = JOB_STORE.get(job_id)
+
+        if not job:
+            return jsonify({'error': 'Job not found'}), 404
+
+        if job['status'] in TERMINAL_JOB_STATUSES:
+            return jsonify({'error': f"Job already {job['status']}", 'status': job['status']}), 409
+
+        if job.get('type') == 'batch':
+            cancelled = sum(cancel_generation_job(child['job_id']) for child in job['children'])
+            batch = JOB_STORE.get(job_id)
+            if batch and batch['status'] not in TERMINAL_JOB_STATUSES:
+                JOB_STORE.update(job_id, {
+                    'status': 'cancelled',
+                    'error': 'Batch cancelled',
+                    'result': build_batch_summary(job_id, batch)
+                })
+            return jsonify({'batch_id': job_id, 'status': 'cancelled', 'cancelled_jobs': cancelled})
+
+        if not cancel_generation_job(job_id):
+            job = JOB_STORE.get(job_id)
+            if not job:
+                # Expired or evicted since the first read
+                return jsonify({'error': 'Job not found'}), 404
+            return jsonify({'error': f"Job already {job['status']}", 'status': job['status']}), 409
+        return jsonify({'job_id': job_id, 'status': 'cancelled'})
+
+    except Exception as e:
+        log.exception("Error cancelling job")
+        return jsonify({'error': f'Server error: {str(e)}'}), 500
+
+def stream_job_events(job_ids):
+    """Yield SSE messages for job_ids until all of them finish or the stream expires.
+
+    A message is sent whenever a job's status payload changes. Pending jobs are
+    re-read every couple of seconds because queue position moves without the job
+    itself being updated, and stores shared between processes are re-read every
+    change_poll_interval; otherwise the stream sleeps until the store signals a
+    change. A comment line is sent as keep-alive when the stream has been quiet.
+    """
+    deadline = time.monotonic() + SSE_MAX_STREAM_SECONDS
+    last_sent = {}
+    last_write = time.monotonic()
+    active = list(job_ids)
+
+    while active and time.monotonic() < deadline:
+        # Read versions before the jobs so a change in between is not missed
+        seen = {job_id: JOB_STORE.version(job_id) for job_id in active}
+        any_pending = False
+        for job_id in list(active):
+            job = JOB_STORE.get(job_id)
+            if job is None:
+                payload = {'job_id': job_id, 'status': 'failed', 'error': 'Job not found'}
+            else:
+                payload = serialize_job_status(job_id, job)
+            if payload != last_sent.get(job_id):
+                last_sent[job_id] = payload
+                last_write = time.monotonic()
+                yield f"data: {json.dumps(payload)}\n\n"
+            if payload['status'] in TERMINAL_JOB_STATUSES:
+                active.remove(job_id)
+                seen.pop(job_id, None)
+            elif payload['status'] == 'pending':
+                any_pending = True
+
+        if not active:
+            break
+
+        timeout = min(SSE_KEEPALIVE_SECONDS, 2) if any_pending else SSE_KEEPALIVE_SECONDS
+        if JOB_STORE.change_poll_interval:
+            timeout = min(timeout, JOB_STORE.change_poll_interval)
+        timeout = min(timeout, max(0, deadline - time.monotonic()))
+        JOB_STORE.wait_for_changes(seen, timeout)
+        if time.monotonic() - last_write >= SSE_KEEPALIVE_SECONDS:
+            last_write = time.monotonic()
+            yield ": keep-alive\n\n"
+
+# Open streams in this process; a slot is given back when the response is closed
+SSE_STREAM_SLOTS = threading.BoundedSemaphore(max(1, SSE_MAX_STREAMS))
+
+def sse_response(generator):
+    """Stream generator as SSE, or answer 503 while SSE_MAX_STREAMS streams are open here"""
+    if not SSE_STREAM_SLOTS.acquire(blocking=False):
+        SSE_STREAMS_REJECTED.inc()
+        response = jsonify({'error': 'Too many open status streams, poll /api/job/<id> instead'})
+        response.headers['Retry-After'] = str(int(SSE_KEEPALIVE_SECONDS))
+        return response, 503
+    response = Response(
+        stream_with_context(generator),
+        mimetype='text/event-stream',
+        headers={
+            'Cache-Control': 'no-cache',
+            'X-Accel-Buffering': 'no'  # Stop nginx from buffering the stream
+        }
+    )
+    # The server closes every response, including streams the client dropped before the first message
+    response.call_on_close(SSE_STREAM_SLOTS.release)
+    return response
+
+@app.route('/api/job/<job_id>/events', methods=['GET'])
+def stream_job_status(job_id):
+    """Stream status updates for one job as Server-Sent Events"""
+    if not JOB_STORE.get(job_id):
+        return jsonify({'error': 'Job not found'}), 404
+    
+    return sse_response(stream_job_events([job_id]))
+
+@app.route('/api/jobs/events', methods=['GET'])
+def stream_jobs_status():
+    """Stream status updates for several jobs (?ids=a,b,c) as Server-Sent Events"""
+    job_ids = [job_id for job_id in request.args.get('ids', '').split(',') if job_id]
+    if not job_ids:
+        return jsonify({'error': 'ids parameter required'}), 400
+    if len(job_ids) > SSE_MAX_JOBS_PER_STREAM:
+        return jsonify({'error': f'At most {SSE_MAX_JOBS_PER_STREAM} jobs per stream'}), 400
+    
+    return sse_response(stream_job_events(list(dict.fromkeys(job_ids))))
+
+@app.route('/api/fal-webhook', methods=['POST'])
+def fal_webhook():
+    """fal.ai completion webhook; only wakes the poller, the result is fetched from fal.ai"""
+    data = request.get_json(silent=True) or {}
+    request_id = data.get('request_id')
+    if not request_id:
+        return jsonify({'error': 'request_id is required'}), 400
+
+    # With several worker processes the request may be tracked by another one;
+    # its poller still picks the result up on its next round
+    tracked = FAL_QUEUE_POLLER.wake(request_id)
+    return jsonify({'success': True, 'tracked': tracked})
 
 @app.route('/api/models', methods=['GET'])
 def get_available_models():
-    """Return available fal.ai LoRA models"""
+    """Return available fal.ai LoRA models and the state of their circuit breakers"""
+    circuits = {model: breaker.snapshot() for model, breaker in FAL_BREAKERS.items()}
+    if ZAI_BREAKER is not None:
+        circuits['z.ai'] = ZAI_BREAKER.snapshot()
     return jsonify({
         'models': list(FAL_ENDPOINTS.keys()),
-        'endpoints': FAL_ENDPOINTS
+        'endpoints': FAL_ENDPOINTS,
+        'circuits': circuits
     })
 
+def refresh_job_store_metrics():
+    for status in ('pending', 'processing') + TERMINAL_JOB_STATUSES:
+        JOB_STORE_JOBS.labels(status).set(len(JOB_STORE.ids_by_status(status)))
+
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    """Prometheus metrics"""
+    if prometheus_client is None:
+        return jsonify({'error': 'Metrics not available - prometheus_client not installed'}), 503
+
+    refresh_job_store_metrics()
+    if os.environ.get('PROMETHEUS_MULTIPROC_DIR'):
+        # Aggregate the values written by every worker process
+        registry = prometheus_client.CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = prometheus_client.REGISTRY
+    return Response(prometheus_client.generate_latest(registry), mimetype=prometheus_client.CONTENT_TYPE_LATEST)
+
 @app.route('/api/civitai-loras', methods=['GET'])
 def get_civitai_loras():
     """Return available Civitai LoRA models for a specific base model"""
@@ -606,6 +3545,171 @@ def get_civitai_loras():
 
 
 
+def is_allowed_download_url(url):
+    """Only https URLs on DOWNLOAD_ALLOWED_HOSTS may be fetched (exact host or *.suffix)"""
+    try:
+        parsed = urlparse(url)
+    except ValueError:
+        return False
+    host = (parsed.hostname or '').lower()
+    if parsed.scheme != 'https' or not host:
+        return False
+    for allowed in DOWNLOAD_ALLOWED_HOSTS:
+        if allowed.startswith('*.'):
+            if host.endswith(allowed[1:]):
+                return True
+        elif host == allowed:
+            return True
+    return False
+
+class ResultImageMirror:
+    """On-disk LRU mirror of generated images.
+
+    Images are fetched once in the background (when a job completes or on the
+    first download) and stored under the SHA-256 of their URL. File names
+    depend only on the URL, so worker processes sharing the directory find
+    each other's copies. The size bound applies to the directory itself:
+    after each fetch the directory is scanned and the least recently used
+    files (oldest mtime, bumped on every lookup) are deleted until it fits in
+    max_bytes, whichever process wrote them.
+    """
+
+    MIRROR_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.webp', '.gif')
+
+    def __init__(self, directory, max_bytes, workers, chunk_size):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.workers = max(1, workers)
+        self.chunk_size = chunk_size
+        self._lock = threading.Lock()
+        self._evict_lock = threading.Lock()
+        self._pending = set()
+        self._executor = None
+
+    @staticmethod
+    def _key(url):
+        return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+    def _filename(self, url, key):
+        extension = os.path.splitext(urlparse(url).path)[1].lower()
+        return key + (extension if extension in self.MIRROR_EXTENSIONS else '.jpg')
+
+    def lookup(self, url):
+        """Path of the mirrored copy of url, or None"""
+        path = os.path.join(self.directory, self._filename(url, self._key(url)))
+        if not os.path.exists(path):
+            return None
+        touch_file(path)
+        return path
+
+    def schedule(self, urls):
+        """Fetch allowed, not yet mirrored urls in the background"""
+        with self._lock:
+            if self._executor is None:
+                self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='result-mirror')
+            for url in urls:
+                key = self._key(url)
+                if key in self._pending or not is_allowed_download_url(url):
+                    continue
+                if os.path.exists(os.path.join(self.directory, self._filename(url, key))):
+                    continue
+                self._pending.add(key)
+                self._executor.submit(self._fetch, url, key)
+
+    def tee(self, url, chunks):
+        """Yield the chunks of url's body while saving them to the mirror.
+
+        The copy is kept only if the stream is read to the end; a failed write
+        stops mirroring but not the stream. If url is already being mirrored the
+        chunks are passed through untouched.
+        """
+        key = self._key(url)
+        with self._lock:
+            claimed = key not in self._pending
+            if claimed:
+                self._pending.add(key)
+        if not claimed:
+            yield from chunks
+            return
+
+        temp_path = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp")
+        saved = False
+        f = None
+        try:
+            f = open(temp_path, 'wb')
+            for chunk in chunks:
+                if f is not None:
+                    try:
+                        f.write(chunk)
+                    except OSError as e:
+                        storage_log.warning("Failed to mirror result image %s: %s", url, e)
+                        f.close()
+                        f = None
+                yield chunk
+            if f is not None:
+                f.close()
+                f = None
+                os.replace(temp_path, os.path.join(self.directory, self._filename(url, key)))
+                saved = True
+        finally:
+            if f is not None:
+                f.close()
+            if not saved and os.path.exists(temp_path):
+                os.remove(temp_path)
+            with self._lock:
+                self._pending.discard(key)
+        self._evict()
+
+    def _fetch(self, url, key):
+        temp_path = os.path.join(self.directory, f"{key}.{uuid.uuid4().hex}.tmp")
+        try:
+            response = MEDIA_CLIENT.get(url, stream=True, read_timeout=60)
+            response.raise_for_status()
+            with open(temp_path, 'wb') as f:
+                for chunk in response.iter_content(chunk_size=self.chunk_size):
+                    f.write(chunk)
+            os.replace(temp_path, os.path.join(self.directory, self._filename(url, key)))
+            self._evict()
+        except Exception as e:
+            storage_log.warning("Failed to mirror result image %s: %s", url, e)
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+        finally:
+            with self._lock:
+                self._pending.discard(key)
+
+    def _evict(self):
+        # Sizes come from the directory rather than a per-process index, so every
+        # worker's files count; concurrent evictions from several processes pick
+        # the same oldest files and simply skip the ones already removed
+        with self._evict_lock:
+            entries = []
+            total_bytes = 0
+            with os.scandir(self.directory) as files:
+                for entry in files:
+                    if entry.name.endswith('.tmp'):
+                        continue
+                    try:
+                        if not entry.is_file():
+                            continue
+                        stat = entry.stat()
+                    except FileNotFoundError:
+                        continue
+                    entries.append((stat.st_mtime, entry.name, stat.st_size))
+                    total_bytes += stat.st_size
+            entries.sort()
+            # Always keep the most recent file, even if it alone exceeds max_bytes
+            for _, name, size in entries[:-1]:
+                if total_bytes <= self.max_bytes:
+                    break
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except FileNotFoundError:
+                    pass
+                total_bytes -= size
+
+RESULT_MIRROR = ResultImageMirror(RESULT_MIRROR_DIR, RESULT_MIRROR_MAX_BYTES, RESULT_MIRROR_WORKERS, DOWNLOAD_CHUNK_SIZE)
+
 @app.route('/api/download', methods=['GET'])
 def download_image():
     """Proxy download with forced download headers"""
@@ -614,17 +3718,35 @@ def download_image():
     
     if not image_url:
         return jsonify({'error': 'URL parameter required'}), 400
+
+    if not is_allowed_download_url(image_url):
+        return jsonify({'error': 'URL host is not allowed'}), 400
     
     try:
+        # Serve the local mirror when we have it; send_file lets the server use sendfile()
+        mirrored_path = RESULT_MIRROR.lookup(image_url)
+        if mirrored_path:
+            return send_file(
+                mirrored_path,
+                as_attachment=True,
+                download_name=filename,
+                conditional=True,
+                max_age=RESULT_DOWNLOAD_MAX_AGE
+            )
+
         # Fetch the image
-        response = requests.get(image_url, stream=True, timeout=30)
+        response = MEDIA_CLIENT.get(image_url, stream=True, read_timeout=30)
         response.raise_for_status()
-        
-        # Create a response with download headers
+
+        # Create a response with download headers, mirroring the body as it streams
+        # so the next download is served locally without a second fetch
         def generate():
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    yield chunk
+            try:
+                yield from RESULT_MIRROR.tee(image_url, (
+                    chunk for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE) if chunk
+                ))
+            finally:
+                response.close()
         
         return Response(
             generate(),
@@ -637,9 +3759,172 @@ def download_image():
     except Exception as e:
         return jsonify({'error': f'Download failed: {str(e)}'}), 500
 
+def reference_image_path(filename, create_shard=False):
+    """Path of a stored reference image, or None for names that could escape the directory.
+
+    Files live in two-character shard subdirectories taken from their content
+    hash (crop_ prefix ignored) so no single directory grows without bound.
+    Files written before sharding are still found at the top level.
+    """
+    if not filename or os.path.basename(filename) != filename or filename.startswith('.'):
+        return None
+    shard = filename[len('crop_'):][:2] if filename.startswith('crop_') else filename[:2]
+    shard_dir = os.path.join(REFERENCE_IMAGE_DIR, shard)
+    path = os.path.join(shard_dir, filename)
+    if create_shard:
+        os.makedirs(shard_dir, exist_ok=True)
+    elif not os.path.exists(path):
+        legacy_path = os.path.join(REFERENCE_IMAGE_DIR, filename)
+        if os.path.exists(legacy_path):
+            return legacy_path
+    return path
+
+def touch_file(path):
+    """Record an access for LRU ordering by bumping mtime (atime is unreliable on most mounts)"""
+    try:
+        os.utime(path)
+    except OSError:
+        pass
+
+def referenced_image_filenames():
+    """Filenames of reference images still needed by pending or processing jobs"""
+    filenames = set()
+    for status in ('pending', 'processing'):
+        for job_id in JOB_STORE.ids_by_status(status):
+            job = JOB_STORE.get(job_id)
+            url = ((job or {}).get('params') or {}).get('reference_image_url') or ''
+            if '/api/reference-images/' in url:
+                filenames.add(url.rsplit('/', 1)[-1])
+    return filenames
+
+class ReferenceImageJanitor:
+    """Background garbage collector for REFERENCE_IMAGE_DIR.
+
+    Every interval it deletes files (and their derivatives) not accessed for
+    max_age seconds, then evicts least recently accessed files until the
+    directory is under max_bytes. Images referenced by unfinished jobs are never
+    removed. Abandoned upload temp files are cleaned up after an hour.
+    """
+
+    TEMP_FILE_MAX_AGE = 3600
+
+    def __init__(self, directory, max_bytes, max_age, interval):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self.last_run = {}
+
+    def start(self):
+        with self._lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name='reference-image-janitor')
+                self._thread.daemon = True
+                self._thread.start()
+
+    def _loop(self):
+        while True:
+            try:
+                self.run_once()
+            except Exception:
+                storage_log.exception("Reference image janitor error")
+            time.sleep(self.interval)
+
+    def _scan(self):
+        with os.scandir(self.directory) as top:
+            for entry in top:
+                if entry.is_dir(follow_symlinks=False):
+                    with os.scandir(entry.path) as shard:
+                        for item in shard:
+                            if item.is_file(follow_symlinks=False):
+                                yield item
+                elif entry.is_file(follow_symlinks=False):
+                    yield entry
+
+    def run_once(self):
+        now = time.time()
+        protected = referenced_image_filenames()
+        files = []
+        total_bytes = 0
+        removed = 0
+        removed_bytes = 0
+
+        for entry in self._scan():
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except FileNotFoundError:
+                continue
+            last_access = max(stat.st_atime, stat.st_mtime)
+            name = entry.name
+            if name.endswith('.tmp'):
+                if now - stat.st_mtime > self.TEMP_FILE_MAX_AGE:
+                    removed += self._remove(entry.path)
+                    removed_bytes += stat.st_size
+                continue
+            # Derivatives (<name>.<ext>.analysis-*, <name>.<ext>.thumb-*) share the protection of their source
+            if '.'.join(name.split('.')[:2]) in protected:
+                total_bytes += stat.st_size
+                continue
+            if now - last_access > self.max_age:
+                removed += self._remove(entry.path)
+                removed_bytes += stat.st_size
+                continue
+            files.append((last_access, stat.st_size, entry.path))
+            total_bytes += stat.st_size
+
+        if total_bytes > self.max_bytes:
+            files.sort()
+            for _, size, path in files:
+                if total_bytes <= self.max_bytes:
+                    break
+                removed += self._remove(path)
+                removed_bytes += size
+                total_bytes -= size
+
+        self.last_run = {
+            'finished_at': datetime.now().isoformat(),
+            'bytes': total_bytes,
+            'removed_files': removed,
+            'removed_bytes': removed_bytes
+        }
+        if removed:
+            storage_log.info("Reference image janitor removed %d files (%d bytes), %d bytes remain", removed, removed_bytes, total_bytes)
+        return self.last_run
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+            return 1
+        except FileNotFoundError:
+            return 0
+
+REFERENCE_JANITOR = ReferenceImageJanitor(
+    REFERENCE_IMAGE_DIR,
+    REFERENCE_MAX_BYTES,
+    REFERENCE_MAX_AGE_SECONDS,
+    REFERENCE_GC_INTERVAL
+)
+
+@app.before_request
+def ensure_background_tasks():
+    # Started from the first request so the threads live in the serving process
+    REFERENCE_JANITOR.start()
+    JOB_WATCHDOG.start()
+
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f'File too large. Maximum size is {MAX_REFERENCE_IMAGE_SIZE // (1024*1024)}MB'}), 413
+
+# Image formats accepted for reference uploads, mapped to the stored file extension
+UPLOAD_EXTENSIONS = {'JPEG': 'jpg', 'MPO': 'jpg', 'PNG': 'png', 'WEBP': 'webp', 'GIF': 'gif'}
+
 @app.route('/api/upload-reference', methods=['POST'])
 def upload_reference_image():
     """Upload and store reference image"""
+    temp_path = None
     try:
         if 'reference_image' not in request.files:
             return jsonify({'error': 'No file uploaded'}), 400
@@ -652,26 +3937,43 @@ def upload_reference_image():
         if not file.content_type.startswith('image/'):
             return jsonify({'error': 'File must be an image'}), 400
 
-        # Read and validate file size
-        file_data = file.read()
-        if len(file_data) > MAX_REFERENCE_IMAGE_SIZE:
-            return jsonify({'error': f'File too large. Maximum size is {MAX_REFERENCE_IMAGE_SIZE // (1024*1024)}MB'}), 400
+        # Stream to a temp file in chunks, hashing as we go and stopping at the size limit
+        too_large_error = f'File too large. Maximum size is {MAX_REFERENCE_IMAGE_SIZE // (1024*1024)}MB'
+        digest = hashlib.sha256()
+        file_size = 0
+        temp_path = os.path.join(REFERENCE_IMAGE_DIR, f".upload-{uuid.uuid4().hex}.tmp")
+        with open(temp_path, 'wb') as f:
+            while True:
+                chunk = file.stream.read(UPLOAD_CHUNK_SIZE)
+                if not chunk:
+                    break
+                file_size += len(chunk)
+                if file_size > MAX_REFERENCE_IMAGE_SIZE:
+                    return jsonify({'error': too_large_error}), 400
+                digest.update(chunk)
+                f.write(chunk)
 
-        # Validate image format with PIL
+        # Sniff the format from the header only; PIL does not decode pixels on open
         try:
-            image = Image.open(io.BytesIO(file_data))
-            image.verify()  # Verify it's a valid image
+            with Image.open(temp_path) as image:
+                image_format = image.format
         except Exception:
             return jsonify({'error': 'Invalid image file'}), 400
 
-        # Generate unique filename
-        file_extension = file.filename.rsplit('.', 1)[1].lower() if '.' in file.filename else 'jpg'
-        unique_filename = f"{uuid.uuid4()}.{file_extension}"
-        file_path = os.path.join(REFERENCE_IMAGE_DIR, unique_filename)
+        file_extension = UPLOAD_EXTENSIONS.get(image_format)
+        if not file_extension:
+            return jsonify({'error': f'Unsupported image format: {image_format}'}), 400
 
-        # Save file
-        with open(file_path, 'wb') as f:
-            f.write(file_data)
+        # Name by content hash so the same image uploaded twice maps to one file
+        unique_filename = f"{digest.hexdigest()[:32]}.{file_extension}"
+        file_path = reference_image_path(unique_filename, create_shard=True)
+
+        deduplicated = os.path.exists(file_path)
+        if deduplicated:
+            touch_file(file_path)  # Count the re-upload as a fresh access
+        else:
+            os.replace(temp_path, file_path)
+            temp_path = None
 
         # Generate public URL (assuming we serve from /api/reference-images/)
         image_url = f"/api/reference-images/{unique_filename}"
@@ -680,23 +3982,155 @@ def upload_reference_image():
             'success': True,
             'filename': unique_filename,
             'image_url': image_url,
-            'file_size': len(file_data)
+            'file_size': file_size,
+            'deduplicated': deduplicated
         })
 
     except Exception as e:
-        print(f"Error uploading reference image: {e}")
-        print(traceback.format_exc())
+        log.exception("Error uploading reference image")
         return jsonify({'error': f'Upload failed: {str(e)}'}), 500
+    finally:
+        if temp_path and os.path.exists(temp_path):
+            os.remove(temp_path)
+
+class ThumbnailDecodeError(Exception):
+    """A reference image could not be decoded to build its thumbnail"""
+
+def reference_thumbnail_path(file_path, width):
+    """Path of a width-bounded JPEG thumbnail of a reference image, generating it if needed"""
+    thumbnail_path = f"{file_path}.thumb-{width}.jpg"
+    if os.path.exists(thumbnail_path):
+        return thumbnail_path
+
+    try:
+        with Image.open(file_path) as img:
+            img.draft('RGB', (width, width))
+            thumbnail = img.convert('RGB')
+    except FileNotFoundError:
+        raise
+    except (OSError, ValueError, Image.DecompressionBombError) as e:
+        raise ThumbnailDecodeError(str(e)) from e
+    thumbnail.thumbnail((width, thumbnail.size[1]), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+    temp_path = f"{thumbnail_path}.{uuid.uuid4().hex}.tmp"
+    try:
+        thumbnail.save(temp_path, 'JPEG', quality=85)
+        os.replace(temp_path, thumbnail_path)
+    finally:
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+    return thumbnail_path
 
 @app.route('/api/reference-images/<filename>')
 def serve_reference_image(filename):
-    """Serve uploaded reference images"""
+    """Serve uploaded reference images (?w=<width> for a thumbnail)"""
     try:
-        return send_from_directory(REFERENCE_IMAGE_DIR, filename)
-    except Exception as e:
+        file_path = reference_image_path(filename)
+        if not file_path or not os.path.exists(file_path):
+            return jsonify({'error': 'Image not found'}), 404
+        touch_file(file_path)
+
+        width = request.args.get('w', type=int)
+        if width is not None:
+            if width not in REFERENCE_THUMBNAIL_WIDTHS:
+                return jsonify({'error': f'Unsupported thumbnail width. Use one of {REFERENCE_THUMBNAIL_WIDTHS}'}), 400
+            file_path = reference_thumbnail_path(file_path, width)
+
+        # Strong content-hash ETag; conditional=True answers If-None-Match with 304 and Range with 206
+        response = send_file(
+            file_path,
+            conditional=True,
+            etag=file_content_hash(file_path),
+            max_age=REFERENCE_CACHE_MAX_AGE
+        )
+        response.cache_control.immutable = True
+        return response
+    except FileNotFoundError:
+        # Removed by the janitor between the existence check and the read
         return jsonify({'error': 'Image not found'}), 404
+    except ThumbnailDecodeError as e:
+        storage_log.warning("Cannot decode reference image %s for a thumbnail: %s", filename, e)
+        return jsonify({'error': 'Image cannot be decoded for a thumbnail'}), 415
+    except Exception:
+        storage_log.exception("Error serving reference image %s", filename)
+        return jsonify({'error': 'Failed to serve image'}), 500
+
+@functools.lru_cache(maxsize=1024)
+def _file_content_hash(path, inode, size):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(UPLOAD_CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+def file_content_hash(path):
+    """SHA-256 of a file, memoized until the file is replaced.
+
+    Keyed on inode rather than mtime because reference images are only ever
+    replaced atomically, while their mtime is bumped on every access.
+    """
+    stat = os.stat(path)
+    return _file_content_hash(path, stat.st_ino, stat.st_size)
+
+class DecodedImageCache:
+    """LRU of decoded source images for repeated crops, bounded by total pixel count"""
+
+    def __init__(self, max_pixels):
+        self.max_pixels = max_pixels
+        self._lock = threading.Lock()
+        self._images = OrderedDict()  # key -> (original_size, decoded image)
+        self._pixels = 0
+
+    def get(self, key):
+        with self._lock:
+            entry = self._images.get(key)
+            if entry is not None:
+                self._images.move_to_end(key)
+            return entry
+
+    def put(self, key, original_size, image):
+        pixels = image.size[0] * image.size[1]
+        if pixels > self.max_pixels:
+            return
+        with self._lock:
+            previous = self._images.pop(key, None)
+            if previous is not None:
+                self._pixels -= previous[1].size[0] * previous[1].size[1]
+            self._images[key] = (original_size, image)
+            self._pixels += pixels
+            while self._pixels > self.max_pixels:
+                _, (_, evicted) = self._images.popitem(last=False)
+                self._pixels -= evicted.size[0] * evicted.size[1]
+
+CROP_SOURCE_CACHE = DecodedImageCache(CROP_SOURCE_CACHE_MAX_PIXELS)
+
+def load_crop_source(source_path, min_size):
+    """Return (original_size, RGB image) decoded at no less than min_size.
+
+    JPEG sources are decoded with draft() at the smallest DCT scale that still
+    covers min_size. Decoded images are kept in CROP_SOURCE_CACHE and reused as
+    long as they are large enough for the requested crop.
+    """
+    stat = os.stat(source_path)
+    key = (source_path, stat.st_ino, stat.st_size)
+    cached = CROP_SOURCE_CACHE.get(key)
+    if cached is not None:
+        original_size, image = cached
+        if image.size[0] >= min(min_size[0], original_size[0]) and image.size[1] >= min(min_size[1], original_size[1]):
+            return original_size, image
+
+    with Image.open(source_path) as img:
+        original_size = img.size
+        img.draft('RGB', min_size)
+        # Convert to RGB if necessary (convert also forces the decode)
+        image = img.convert('RGB')
+
+    CROP_SOURCE_CACHE.put(key, original_size, image)
+    return original_size, image
 
 @app.route('/api/crop-reference', methods=['POST'])
+@timed_route(CROP_DURATION, CROP_FAILURES)
+@TRACER.traced('crop_reference_image')
 def crop_reference_image():
     """Generate cropped version of reference image based on user framing"""
     try:
@@ -719,80 +4153,372 @@ def crop_reference_image():
         else:
             return jsonify({'error': 'Invalid source_url format'}), 400
 
-        source_path = os.path.join(REFERENCE_IMAGE_DIR, filename)
-        if not os.path.exists(source_path):
+        source_path = reference_image_path(filename)
+        if not source_path or not os.path.exists(source_path):
             return jsonify({'error': 'Source image not found'}), 404
+        touch_file(source_path)
+
+        crop_params = {
+            'scale': scale,
+            'offset_x': offset_x,
+            'offset_y': offset_y,
+            'target_width': target_width,
+            'target_height': target_height
+        }
+
+        # The same source and framing always produce the same file, so reuse it if present
+        crop_key = json.dumps(
+            [file_content_hash(source_path), offset_x, offset_y, scale, target_width, target_height, CROP_JPEG_QUALITY],
+            separators=(',', ':')
+        )
+        crop_filename = f"crop_{hashlib.sha256(crop_key.encode('utf-8')).hexdigest()[:32]}.jpg"
+        crop_path = reference_image_path(crop_filename)
+        cropped_url = f"/api/reference-images/{crop_filename}"
 
-        # Open and process the image
-        with Image.open(source_path) as img:
-            # Convert to RGB if necessary
+        if os.path.exists(crop_path):
+            touch_file(crop_path)  # Count the reuse as a fresh access
+            storage_log.debug("Cropped image cache hit: %s", crop_filename)
+            return jsonify({
+                'success': True,
+                'cropped_url': cropped_url,
+                'crop_filename': crop_filename,
+                'crop_params': crop_params,
+                'cache_hit': True
+            })
+
+        # Decode just enough resolution: the visible region (1/scale of the image)
+        # is resampled to the target size
+        min_size = (int(target_width * max(scale, 1)), int(target_height * max(scale, 1)))
+        (orig_width, orig_height), img = load_crop_source(source_path, min_size)
+
+        # Calculate the visible portion of the image based on scale
+        visible_width = orig_width / scale
+        visible_height = orig_height / scale
+
+        # Calculate crop box (centered on offset)
+        # Offset is from center, so convert to top-left coordinates
+        crop_left = (orig_width / 2) - (visible_width / 2) - offset_x
+        crop_top = (orig_height / 2) - (visible_height / 2) - offset_y
+        crop_right = crop_left + visible_width
+        crop_bottom = crop_top + visible_height
+
+        # Ensure crop bounds are within image
+        crop_left = max(0, crop_left)
+        crop_top = max(0, crop_top)
+        crop_right = min(orig_width, crop_right)
+        crop_bottom = min(orig_height, crop_bottom)
+
+        # Map the crop box onto the (possibly draft-reduced) decoded image
+        ratio_x = img.size[0] / orig_width
+        ratio_y = img.size[1] / orig_height
+        cropped_img = img.crop((
+            crop_left * ratio_x,
+            crop_top * ratio_y,
+            crop_right * ratio_x,
+            crop_bottom * ratio_y
+        ))
+
+        # Resize to target dimensions; reducing_gap lets PIL reduce() by an integer
+        # factor before the final LANCZOS pass
+        final_img = cropped_img.resize((target_width, target_height), Image.Resampling.LANCZOS, reducing_gap=3.0)
+
+        # Save cropped image atomically so a concurrent request never reads a partial file.
+        # The shard directory is only created now, so rejected crops leave nothing behind
+        os.makedirs(os.path.dirname(crop_path), exist_ok=True)
+        temp_path = f"{crop_path}.{uuid.uuid4().hex}.tmp"
+        try:
+            final_img.save(temp_path, 'JPEG', quality=CROP_JPEG_QUALITY)
+            os.replace(temp_path, crop_path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+        storage_log.debug(
+            "Cropped image generated: %s (original %dx%d, crop %s,%s,%s,%s, scale %s, offset %s,%s, target %dx%d)",
+            crop_filename, orig_width, orig_height, crop_left, crop_top, crop_right, crop_bottom,
+            scale, offset_x, offset_y, target_width, target_height
+        )
+
+        return jsonify({
+            'success': True,
+            'cropped_url': cropped_url,
+            'crop_filename': crop_filename,
+            'crop_params': crop_params,
+            'cache_hit': False
+        })
+
+    except Exception as e:
+        log.exception("Error cropping reference image")
+        return jsonify({'error': f'Crop failed: {str(e)}'}), 500
+
+class AnalysisError(Exception):
+    """Image analysis failure carrying the HTTP status to report"""
+
+    def __init__(self, message, status_code=500):
+        super().__init__(message)
+        self.status_code = status_code
+
+class SingleFlightCache:
+    """Bounded LRU/TTL cache whose misses are computed once per key.
+
+    Concurrent callers asking for a key that is being computed wait for that
+    computation instead of starting their own; failures are shared with the
+    waiters but not cached.
+    """
+
+    def __init__(self, max_entries, ttl_seconds):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self._lock = threading.Lock()
+        self._values = OrderedDict()  # key -> (stored_at, value)
+        self._inflight = {}           # key -> {'event', 'value', 'error'}
+
+    def get_or_compute(self, key, compute):
+        """Return (value, cache_hit); cache_hit is also True for callers that joined a computation"""
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and time.time() - entry[0] <= self.ttl_seconds:
+                self._values.move_to_end(key)
+                return entry[1], True
+            flight = self._inflight.get(key)
+            leader = flight is None
+            if leader:
+                flight = {'event': threading.Event(), 'value': None, 'error': None}
+                self._inflight[key] = flight
+
+        if not leader:
+            flight['event'].wait()
+            if flight['error'] is not None:
+                raise flight['error']
+            return flight['value'], True
+
+        try:
+            flight['value'] = compute()
+        except Exception as e:
+            flight['error'] = e
+            raise
+        finally:
+            with self._lock:
+                del self._inflight[key]
+                if flight['error'] is None and self.max_entries > 0:
+                    self._values[key] = (time.time(), flight['value'])
+                    self._values.move_to_end(key)
+                    while len(self._values) > self.max_entries:
+                        self._values.popitem(last=False)
+            flight['event'].set()
+        return flight['value'], False
+
+ANALYSIS_CACHE = SingleFlightCache(ANALYSIS_CACHE_MAX_ENTRIES, ANALYSIS_CACHE_TTL_SECONDS)
+
+# physical_attributes keys used in the analysis prompt
+PHYSICAL_ATTRIBUTE_KEYS = ('skin_color', 'hair_color', 'hair_style', 'eye_color')
+
+def normalize_physical_attributes(physical_attributes):
+    """Keep only the attributes used in the prompt, stripped and without empty values"""
+    normalized = {}
+    for key in PHYSICAL_ATTRIBUTE_KEYS:
+        value = (physical_attributes or {}).get(key)
+        if isinstance(value, str):
+            value = value.strip()
+        if value:
+            normalized[key] = value
+    return normalized
+
+def analysis_cache_key(image_data, physical_attributes):
+    """Cache key for an analysis: image bytes, normalized attributes and the z.ai model"""
+    digest = hashlib.sha256(image_data).hexdigest()
+    attributes = json.dumps(physical_attributes, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(f"{digest}|{attributes}|{Z_AI_MODEL}".encode('utf-8')).hexdigest()
+
+ANALYSIS_IMAGE_MIME_TYPES = {'JPEG': 'image/jpeg', 'WEBP': 'image/webp', 'PNG': 'image/png', 'GIF': 'image/gif'}
+
+def analysis_derivative_path(file_path):
+    """Location of the cached z.ai-ready copy of an uploaded reference image"""
+    extension = 'webp' if ANALYSIS_IMAGE_FORMAT == 'WEBP' else 'jpg'
+    return f"{file_path}.analysis-{ANALYSIS_MAX_EDGE}q{ANALYSIS_IMAGE_QUALITY}.{extension}"
+
+def prepare_analysis_image(image_data, derivative_path=None):
+    """Downscale and re-encode an image for z.ai.
+
+    Returns (bytes, mime_type, stats). The re-encoded copy is only used when it
+    is smaller than the original, and is written to derivative_path (if given)
+    so later analyses of the same upload skip the work.
+    """
+    target_format = 'WEBP' if ANALYSIS_IMAGE_FORMAT == 'WEBP' else 'JPEG'
+    stats = {'original_bytes': len(image_data)}
+
+    if derivative_path and os.path.exists(derivative_path):
+        with open(derivative_path, 'rb') as f:
+            prepared = f.read()
+        stats.update(sent_bytes=len(prepared), saved_bytes=len(image_data) - len(prepared))
+        return prepared, ANALYSIS_IMAGE_MIME_TYPES[target_format], stats
+
+    try:
+        with Image.open(io.BytesIO(image_data)) as img:
+            original_format = img.format
+            # Let the JPEG decoder skip detail we are about to throw away
+            img.draft('RGB', (ANALYSIS_MAX_EDGE, ANALYSIS_MAX_EDGE))
+            img = ImageOps.exif_transpose(img)
             if img.mode != 'RGB':
                 img = img.convert('RGB')
+            img.thumbnail((ANALYSIS_MAX_EDGE, ANALYSIS_MAX_EDGE), Image.Resampling.LANCZOS)
+            output = io.BytesIO()
+            img.save(output, target_format, quality=ANALYSIS_IMAGE_QUALITY)
+            prepared = output.getvalue()
+    except Exception as e:
+        analysis_log.warning("Could not preprocess image for analysis, sending original: %s", e)
+        stats.update(sent_bytes=len(image_data), saved_bytes=0)
+        return image_data, 'image/jpeg', stats
 
-            # Calculate crop parameters
-            orig_width, orig_height = img.size
+    if len(prepared) >= len(image_data):
+        stats.update(sent_bytes=len(image_data), saved_bytes=0)
+        return image_data, ANALYSIS_IMAGE_MIME_TYPES.get(original_format, 'image/jpeg'), stats
 
-            # Calculate the visible portion of the image based on scale
-            visible_width = orig_width / scale
-            visible_height = orig_height / scale
+    if derivative_path:
+        temp_path = f"{derivative_path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, 'wb') as f:
+            f.write(prepared)
+        os.replace(temp_path, derivative_path)
 
-            # Calculate crop box (centered on offset)
-            # Offset is from center, so convert to top-left coordinates
-            crop_left = (orig_width / 2) - (visible_width / 2) - offset_x
-            crop_top = (orig_height / 2) - (visible_height / 2) - offset_y
-            crop_right = crop_left + visible_width
-            crop_bottom = crop_top + visible_height
+    stats.update(sent_bytes=len(prepared), saved_bytes=len(image_data) - len(prepared))
+    analysis_log.debug("Analysis image reduced from %d to %d bytes", len(image_data), len(prepared))
+    return prepared, ANALYSIS_IMAGE_MIME_TYPES[target_format], stats
 
-            # Ensure crop bounds are within image
-            crop_left = max(0, crop_left)
-            crop_top = max(0, crop_top)
-            crop_right = min(orig_width, crop_right)
-            crop_bottom = min(orig_height, crop_bottom)
+def run_image_analysis(image_data, mime_type, physical_attributes):
+    """Ask z.ai for a prompt describing the image; raises AnalysisError on failure"""
+    image_base64 = base64.b64encode(image_data).decode('utf-8')
 
-            # Crop the image
-            cropped_img = img.crop((crop_left, crop_top, crop_right, crop_bottom))
+    # Build physical attributes override string
+    physical_attributes_text = ""
+    if physical_attributes:
+        attributes = []
+        if physical_attributes.get('skin_color'):
+            attributes.append(f"Ethnicity: {physical_attributes['skin_color']}")
+        if physical_attributes.get('hair_color'):
+            attributes.append(f"Hair: {physical_attributes['hair_color']}")
+        if physical_attributes.get('hair_style'):
+            attributes.append(f"Hair Style: {physical_attributes['hair_style']}")
+        if physical_attributes.get('eye_color'):
+            attributes.append(f"Eyes: {physical_attributes['eye_color']}")
 
-            # Resize to target dimensions
-            final_img = cropped_img.resize((target_width, target_height), Image.Resampling.LANCZOS)
+        if attributes:
+            physical_attributes_text = "PHYSICAL ATTRIBUTES OVERRIDE - Use these exact characteristics: " + ", ".join(attributes) + ". "
 
-            # Generate unique filename for cropped version
-            crop_filename = f"crop_{uuid.uuid4()}.jpg"
-            crop_path = os.path.join(REFERENCE_IMAGE_DIR, crop_filename)
+    # Analyze with z.ai GLM-4.5v (following official docs format)
+    expert_prompt = """You are an expert AI Image Prompt Engineer. Analyze this image and create a detailed ultrarealistic photography prompt in 150 words or less.
 
-            # Save cropped image
-            final_img.save(crop_path, 'JPEG', quality=95)
+""" + physical_attributes_text + """If physical attributes are specified above, you MUST use those exact characteristics for the subject. Otherwise, describe what you see.
 
-            # Generate URL for cropped image
-            cropped_url = f"/api/reference-images/{crop_filename}"
+Return ONLY the final prompt with this structure (replace ALL brackets with actual content):
 
-            print(f"Cropped image generated: {crop_filename}")
-            print(f"Original: {orig_width}x{orig_height}, Crop: {crop_left},{crop_top},{crop_right},{crop_bottom}")
-            print(f"Scale: {scale}, Offset: {offset_x},{offset_y}, Target: {target_width}x{target_height}")
+An ultrarealistic, cinematic photograph of a [describe subject: age, ethnicity, gender, hair, eyes] at [location]. The atmosphere is [mood] during [time of day] with [lighting description].
 
-            return jsonify({
-                'success': True,
-                'cropped_url': cropped_url,
-                'crop_filename': crop_filename,
-                'crop_params': {
-                    'scale': scale,
-                    'offset_x': offset_x,
-                    'offset_y': offset_y,
-                    'target_width': target_width,
-                    'target_height': target_height
+The subject is dressed in [clothing and accessories] and has a [facial expression] while in a [pose]. Pay meticulous attention to realistic [skin details].
+
+The composition is framed from a [camera angle] perspective. The environment features [foreground], [midground], and [background elements]. The lighting casts [lighting effects] and the scene has [colors, materials, textures].
+
+Photographic Style: Shot on a [camera] with [lens], aperture [f-stop] for [depth of field effect]. Style: [photography genre/reference].
+
+Realism Enhancers: masterpiece, 8k, UHD, sharp focus, professional photography, high detail, photorealistic, intricate detail, physically-based rendering, accurate anatomy, detailed textures.
+
+CRITICAL: Fill in ALL brackets with specific details. Return ONLY the final prompt, no box markers, no explanations."""
+
+    messages = [
+        {
+            "role": "user",
+            "content": [
+                {
+                    "type": "image_url",
+                    "image_url": {
+                        "url": f"data:{mime_type};base64,{image_base64}"
+                    }
+                },
+                {
+                    "type": "text",
+                    "text": expert_prompt
                 }
-            })
+            ]
+        }
+    ]
+
+    try:
+        analysis_log.info("Sending request to z.ai model %s", Z_AI_MODEL)
+
+        zai_request = dict(
+            headers={
+                "Authorization": f"Bearer {Z_AI_API_KEY}",
+                "Content-Type": "application/json"
+            },
+            json={
+                "model": Z_AI_MODEL,
+                "messages": messages,
+                "max_tokens": 200,
+                "thinking": {
+                    "type": "disabled"
+                }
+            },
+            read_timeout=30,
+            limiters=ZAI_LIMITERS,
+            breaker=ZAI_BREAKER
+        )
+        upstream_started = time.perf_counter()
+        response = ZAI_CLIENT.post(f"{Z_AI_BASE_URL}/chat/completions", **zai_request)
+        ANALYSIS_UPSTREAM_LATENCY.observe(time.perf_counter() - upstream_started)
+
+        analysis_log.info("z.ai response status: %s", response.status_code)
+
+        if response.status_code != 200:
+            error_msg = f"z.ai API error: {response.status_code}"
+            try:
+                error_data = response.json()
+                log_payload(analysis_log, "z.ai error response", error_data)
+                error_msg += f" - {error_data.get('error', {}).get('message', 'Unknown error')}"
+            except:
+                error_msg += f" - {response.text}"
+            analysis_log.warning("%s", error_msg)
+            raise AnalysisError(error_msg)
 
+    except AnalysisError:
+        raise
+    except (UpstreamBusyError, CircuitOpenError) as e:
+        raise AnalysisError(str(e), status_code=503)
     except Exception as e:
-        print(f"Error cropping reference image: {e}")
-        print(traceback.format_exc())
-        return jsonify({'error': f'Crop failed: {str(e)}'}), 500
+        analysis_log.warning("Exception calling z.ai API: %s", e)
+        raise AnalysisError(f'Failed to call z.ai API: {str(e)}')
+
+    # Parse response with error handling
+    try:
+        result = response.json()
+        log_payload(analysis_log, "z.ai response", result)
+    except Exception as json_error:
+        analysis_log.error("Failed to parse z.ai response as JSON: %s", json_error,
+                           extra={'fields': {'content_type': response.headers.get('content-type', 'unknown'),
+                                             'response_bytes': len(response.content)}})
+        raise AnalysisError(f'Invalid JSON response from z.ai: {str(json_error)}')
+
+    # Extract prompt with error handling (thinking disabled, so content should be in standard field)
+    try:
+        message = result.get('choices', [{}])[0].get('message', {})
+        raw_prompt = message.get('content', '') or message.get('reasoning_content', '')
+    except Exception as extract_error:
+        analysis_log.error("Failed to extract prompt from response: %s", extract_error)
+        log_payload(analysis_log, "z.ai response", result)
+        raise AnalysisError(f'Failed to extract AI response: {str(extract_error)}')
+
+    if not raw_prompt:
+        analysis_log.error("No content found in z.ai response")
+        raise AnalysisError('No response from AI analysis')
+
+    # Clean up the prompt (remove box markers and any remaining brackets)
+    suggested_prompt = clean_ai_prompt(raw_prompt)
+    return suggested_prompt.strip()
 
 @app.route('/api/analyze-image', methods=['POST'])
+@timed_route(ANALYSIS_DURATION, ANALYSIS_FAILURES)
+@TRACER.traced('analyze_reference_image')
 def analyze_reference_image():
     """Analyze reference image with z.ai GLM-4.5v"""
-    print("=== ANALYZE IMAGE FUNCTION CALLED ===", flush=True)
     try:
-        print(f"Z_AI_API_KEY exists: {bool(Z_AI_API_KEY)}", flush=True)
         if not Z_AI_API_KEY:
             return jsonify({'error': 'AI analysis not available - Z_AI_API_KEY not configured'}), 503
 
@@ -800,164 +4526,59 @@ def analyze_reference_image():
         image_url = data.get('image_url')
 
         # Get physical attributes for override
-        physical_attributes = data.get('physical_attributes', {})
+        physical_attributes = normalize_physical_attributes(data.get('physical_attributes', {}))
 
         if not image_url:
             return jsonify({'error': 'image_url is required'}), 400
 
         # Convert relative URL to file path
+        derivative_path = None
         if image_url.startswith('/api/reference-images/'):
             filename = image_url.split('/')[-1]
-            file_path = os.path.join(REFERENCE_IMAGE_DIR, filename)
+            file_path = reference_image_path(filename)
 
-            if not os.path.exists(file_path):
+            if not file_path or not os.path.exists(file_path):
                 return jsonify({'error': 'Reference image not found'}), 404
+            touch_file(file_path)
 
-            # Read and encode image as base64
             with open(file_path, 'rb') as f:
                 image_data = f.read()
-            image_base64 = base64.b64encode(image_data).decode('utf-8')
+            derivative_path = analysis_derivative_path(file_path)
         else:
             # Handle external URLs by downloading
             try:
-                response = requests.get(image_url, timeout=30)
+                response = MEDIA_CLIENT.get(image_url, read_timeout=30)
                 response.raise_for_status()
-                image_base64 = base64.b64encode(response.content).decode('utf-8')
+                image_data = response.content
             except Exception as e:
                 return jsonify({'error': f'Failed to download image: {str(e)}'}), 400
 
-        # Build physical attributes override string
-        physical_attributes_text = ""
-        if physical_attributes:
-            attributes = []
-            if physical_attributes.get('skin_color'):
-                attributes.append(f"Ethnicity: {physical_attributes['skin_color']}")
-            if physical_attributes.get('hair_color'):
-                attributes.append(f"Hair: {physical_attributes['hair_color']}")
-            if physical_attributes.get('hair_style'):
-                attributes.append(f"Hair Style: {physical_attributes['hair_style']}")
-            if physical_attributes.get('eye_color'):
-                attributes.append(f"Eyes: {physical_attributes['eye_color']}")
-
-            if attributes:
-                physical_attributes_text = "PHYSICAL ATTRIBUTES OVERRIDE - Use these exact characteristics: " + ", ".join(attributes) + ". "
-
-        # Analyze with z.ai GLM-4.5v (following official docs format)
-        expert_prompt = """You are an expert AI Image Prompt Engineer. Analyze this image and create a detailed ultrarealistic photography prompt in 150 words or less.
-
-""" + physical_attributes_text + """If physical attributes are specified above, you MUST use those exact characteristics for the subject. Otherwise, describe what you see.
-
-Return ONLY the final prompt with this structure (replace ALL brackets with actual content):
-
-An ultrarealistic, cinematic photograph of a [describe subject: age, ethnicity, gender, hair, eyes] at [location]. The atmosphere is [mood] during [time of day] with [lighting description].
-
-The subject is dressed in [clothing and accessories] and has a [facial expression] while in a [pose]. Pay meticulous attention to realistic [skin details].
-
-The composition is framed from a [camera angle] perspective. The environment features [foreground], [midground], and [background elements]. The lighting casts [lighting effects] and the scene has [colors, materials, textures].
-
-Photographic Style: Shot on a [camera] with [lens], aperture [f-stop] for [depth of field effect]. Style: [photography genre/reference].
-
-Realism Enhancers: masterpiece, 8k, UHD, sharp focus, professional photography, high detail, photorealistic, intricate detail, physically-based rendering, accurate anatomy, detailed textures.
-
-CRITICAL: Fill in ALL brackets with specific details. Return ONLY the final prompt, no box markers, no explanations."""
-
-        messages = [
-            {
-                "role": "user",
-                "content": [
-                    {
-                        "type": "image_url",
-                        "image_url": {
-                            "url": f"data:image/jpeg;base64,{image_base64}"
-                        }
-                    },
-                    {
-                        "type": "text",
-                        "text": expert_prompt
-                    }
-                ]
-            }
-        ]
+        def analyze():
+            with TRACER.span('analysis.prepare_image'):
+                prepared, mime_type, image_stats = prepare_analysis_image(image_data, derivative_path)
+            return run_image_analysis(prepared, mime_type, physical_attributes), image_stats
 
+        # Identical image + attributes + model reuse a cached (or in-flight) analysis
         try:
-            print(f"Sending request to z.ai: {Z_AI_BASE_URL}/chat/completions")
-            print(f"Model: {Z_AI_MODEL}")
-            print(f"Messages structure: {len(messages)} messages")
-
-            response = requests.post(
-                f"{Z_AI_BASE_URL}/chat/completions",
-                headers={
-                    "Authorization": f"Bearer {Z_AI_API_KEY}",
-                    "Content-Type": "application/json"
-                },
-                json={
-                    "model": Z_AI_MODEL,
-                    "messages": messages,
-                    "max_tokens": 200,
-                    "thinking": {
-                        "type": "disabled"
-                    }
-                },
-                timeout=30
+            (suggested_prompt, image_stats), cache_hit = ANALYSIS_CACHE.get_or_compute(
+                analysis_cache_key(image_data, physical_attributes),
+                analyze
             )
+        except AnalysisError as e:
+            return jsonify({'error': str(e)}), e.status_code
 
-            print(f"z.ai response status: {response.status_code}")
-
-            if response.status_code != 200:
-                error_msg = f"z.ai API error: {response.status_code}"
-                try:
-                    error_data = response.json()
-                    print(f"z.ai error data: {error_data}")
-                    error_msg += f" - {error_data.get('error', {}).get('message', 'Unknown error')}"
-                except:
-                    error_msg += f" - {response.text}"
-                print(f"z.ai API Error: {error_msg}")
-                return jsonify({'error': error_msg}), 500
-
-        except Exception as e:
-            print(f"Exception calling z.ai API: {str(e)}")
-            return jsonify({'error': f'Failed to call z.ai API: {str(e)}'}), 500
-
-        # Parse response with error handling
-        try:
-            print(f"Raw response text length: {len(response.text)}", flush=True)
-            print(f"Response content type: {response.headers.get('content-type', 'unknown')}", flush=True)
-            result = response.json()
-            print(f"Successfully parsed JSON response", flush=True)
-            print(f"z.ai response structure: {result.keys()}", flush=True)
-            print(f"Full z.ai response: {result}", flush=True)
-        except Exception as json_error:
-            print(f"ERROR: Failed to parse z.ai response as JSON: {json_error}", flush=True)
-            print(f"Raw response text: {response.text[:1000]}...", flush=True)
-            return jsonify({'error': f'Invalid JSON response from z.ai: {str(json_error)}'}), 500
-
-        # Extract prompt with error handling (thinking disabled, so content should be in standard field)
-        try:
-            message = result.get('choices', [{}])[0].get('message', {})
-            raw_prompt = message.get('content', '') or message.get('reasoning_content', '')
-            print(f"Raw prompt: '{raw_prompt[:100]}...'", flush=True)
-
-            if not raw_prompt:
-                print("ERROR: No content found in z.ai response", flush=True)
-                return jsonify({'error': 'No response from AI analysis'}), 500
-
-            # Clean up the prompt (remove box markers and any remaining brackets)
-            suggested_prompt = clean_ai_prompt(raw_prompt)
-            print(f"Cleaned prompt: '{suggested_prompt[:100]}...'", flush=True)
-
-            return jsonify({
-                'success': True,
-                'suggested_prompt': suggested_prompt.strip()
-            })
-        except Exception as extract_error:
-            print(f"ERROR: Failed to extract prompt from response: {extract_error}", flush=True)
-            print(f"Response structure for debugging: {result}", flush=True)
-            return jsonify({'error': f'Failed to extract AI response: {str(extract_error)}'}), 500
+        return jsonify({
+            'success': True,
+            'suggested_prompt': suggested_prompt,
+            'cache_hit': cache_hit,
+            'image_bytes': image_stats
+        })
 
     except Exception as e:
-        print(f"Error analyzing image: {e}")
-        print(traceback.format_exc())
+        log.exception("Error analyzing image")
         return jsonify({'error': f'Analysis failed: {str(e)}'}), 500
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=5000, debug=True)
\ No newline at end of file
+    # Development server only; production runs under gunicorn (see gunicorn.conf.py)
+    JOB_WATCHDOG.start()
+    app.run(host='0.0.0.0', port=5000, debug=os.environ.get("FLASK_DEBUG") == "1", threaded=True)
\ No newline at end of file
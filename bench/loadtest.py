@@ -0,0 +1,293 @@
+"""Load-test harness for the Fallora backend.
+
+Drives a mix of scenarios against a running app (normally pointed at
+bench/mock_upstreams.py) from a pool of client threads and reports
+throughput, latency percentiles and the app's resident memory:
+
+  generate  POST /api/generate, then poll /api/job/<id> until it finishes
+  upload    POST /api/upload-reference with a freshly generated JPEG
+  crop      POST /api/crop-reference on an uploaded image
+  analyze   POST /api/analyze-image on an uploaded image
+
+Usage:
+  python bench/loadtest.py --base-url http://127.0.0.1:5000 --duration 30 \\
+      --concurrency 16 --mix generate=4,upload=1,crop=2,analyze=1 --app-pid 1234
+"""
+import argparse
+import io
+import json
+import random
+import threading
+import time
+import uuid
+
+import requests
+from PIL import Image
+
+TERMINAL_JOB_STATUSES = ('completed', 'failed', 'cancelled')
+
+
+def percentile(values, fraction):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, int(round(fraction * (len(ordered) - 1)))))
+    return ordered[index]
+
+
+def read_rss_bytes(pid):
+    """Resident set size of pid (and its children for a gunicorn master), from /proc"""
+    total = 0
+    pids = [pid]
+    try:
+        with open(f"/proc/{pid}/task/{pid}/children") as f:
+            pids += [int(child) for child in f.read().split()]
+    except OSError:
+        pass
+    for process_id in pids:
+        try:
+            with open(f"/proc/{process_id}/status") as f:
+                for line in f:
+                    if line.startswith('VmRSS:'):
+                        total += int(line.split()[1]) * 1024
+        except OSError:
+            continue
+    return total or None
+
+
+class Results:
+    """Thread-safe latency samples and outcome counts per scenario"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.latencies = {}  # metric -> [seconds]
+        self.outcomes = {}   # scenario -> {outcome: count}
+
+    def record(self, scenario, outcome, latency=None, metric=None):
+        with self._lock:
+            counts = self.outcomes.setdefault(scenario, {})
+            counts[outcome] = counts.get(outcome, 0) + 1
+            if latency is not None:
+                self.latencies.setdefault(metric or scenario, []).append(latency)
+
+
+class LoadTest:
+    def __init__(self, args):
+        self.base_url = args.base_url.rstrip('/')
+        self.args = args
+        self.results = Results()
+        self.uploaded = []  # reference image URLs usable by crop/analyze
+        self._uploaded_lock = threading.Lock()
+        self.stop_at = None
+        self.mix = []
+        for item in args.mix.split(','):
+            name, _, weight = item.partition('=')
+            self.mix += [name.strip()] * int(weight or 1)
+
+    def _session(self):
+        session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=4)
+        session.mount('http://', adapter)
+        return session
+
+    def _client_headers(self, worker_id):
+        # Each simulated client gets its own address so per-client queue limits apply per worker.
+        # This stands in for a trusted proxy, so run against the app directly with TRUSTED_PROXY_COUNT=1
+        return {'X-Forwarded-For': f"10.{worker_id // 250}.{worker_id % 250}.1"}
+
+    def _jpeg(self, size=768):
+        image = Image.new('RGB', (size, size), tuple(random.randint(0, 255) for _ in range(3)))
+        for _ in range(20):
+            x, y = random.randint(0, size - 32), random.randint(0, size - 32)
+            image.paste(tuple(random.randint(0, 255) for _ in range(3)), (x, y, x + 32, y + 32))
+        buffer = io.BytesIO()
+        image.save(buffer, 'JPEG', quality=90)
+        return buffer.getvalue()
+
+    def run_upload(self, session, headers):
+        files = {'reference_image': (f"{uuid.uuid4().hex}.jpg", self._jpeg(), 'image/jpeg')}
+        start = time.perf_counter()
+        response = session.post(f"{self.base_url}/api/upload-reference", files=files, headers=headers, timeout=60)
+        if response.status_code == 200:
+            self.results.record('upload', 'ok', time.perf_counter() - start)
+            with self._uploaded_lock:
+                self.uploaded.append(response.json()['image_url'])
+                del self.uploaded[:-50]
+        else:
+            self.results.record('upload', f"http_{response.status_code}")
+
+    def _reference_url(self, session, headers):
+        with self._uploaded_lock:
+            if self.uploaded:
+                return random.choice(self.uploaded)
+        self.run_upload(session, headers)
+        with self._uploaded_lock:
+            return self.uploaded[-1] if self.uploaded else None
+
+    def run_crop(self, session, headers):
+        source_url = self._reference_url(session, headers)
+        if not source_url:
+            return self.results.record('crop', 'no_reference')
+        body = {
+            'source_url': source_url,
+            'offset_x': random.randint(-40, 40),
+            'offset_y': random.randint(-40, 40),
+            'scale': random.choice([1.0, 1.25, 1.5]),
+            'target_width': 512,
+            'target_height': 512
+        }
+        start = time.perf_counter()
+        response = session.post(f"{self.base_url}/api/crop-reference", json=body, headers=headers, timeout=60)
+        if response.status_code == 200:
+            self.results.record('crop', 'ok', time.perf_counter() - start)
+        else:
+            self.results.record('crop', f"http_{response.status_code}")
+
+    def run_analyze(self, session, headers):
+        image_url = self._reference_url(session, headers)
+        if not image_url:
+            return self.results.record('analyze', 'no_reference')
+        start = time.perf_counter()
+        response = session.post(f"{self.base_url}/api/analyze-image", json={'image_url': image_url},
+                                headers=headers, timeout=120)
+        if response.status_code == 200:
+            self.results.record('analyze', 'ok', time.perf_counter() - start)
+        else:
+            self.results.record('analyze', f"http_{response.status_code}")
+
+    def run_generate(self, session, headers):
+        body = {
+            'base_model': self.args.model,
+            'prompt': f"load test {uuid.uuid4().hex[:8]}",
+            'loras': [{'model': 'https://example.com/lora.safetensors', 'weight': 1.0}],
+            'resolution': '1024x1024'
+        }
+        if self.args.civitai:
+            body['loras'].append({'model': 'civitai', 'is_civitai': True, 'civitai_name': 'Natural Realism'})
+        start = time.perf_counter()
+        response = session.post(f"{self.base_url}/api/generate", json=body, headers=headers, timeout=30)
+        submitted = time.perf_counter()
+        if response.status_code == 429:
+            return self.results.record('generate', 'rejected_429')
+        if response.status_code != 200:
+            return self.results.record('generate', f"http_{response.status_code}")
+        self.results.record('generate', 'submitted', submitted - start, metric='generate.submit')
+
+        job_id = response.json()['job_id']
+        deadline = time.perf_counter() + self.args.job_timeout
+        while time.perf_counter() < deadline:
+            time.sleep(self.args.poll_interval)
+            status = session.get(f"{self.base_url}/api/job/{job_id}", headers=headers, timeout=30)
+            if status.status_code != 200:
+                continue
+            job = status.json()
+            if job['status'] in TERMINAL_JOB_STATUSES:
+                if job['status'] == 'completed':
+                    self.results.record('generate', 'ok', time.perf_counter() - start, metric='generate.end_to_end')
+                elif job['status'] == 'cancelled':
+                    # Cancelled from outside the load test (another client or an operator)
+                    self.results.record('generate', 'job_cancelled')
+                else:
+                    self.results.record('generate', 'job_failed')
+                return
+        self.results.record('generate', 'timeout')
+
+    def worker(self, worker_id):
+        session = self._session()
+        headers = self._client_headers(worker_id)
+        while time.monotonic() < self.stop_at:
+            scenario = random.choice(self.mix)
+            try:
+                getattr(self, f"run_{scenario}")(session, headers)
+            except requests.RequestException as e:
+                self.results.record(scenario, type(e).__name__)
+
+    def run(self):
+        rss_samples = []
+        self.stop_at = time.monotonic() + self.args.duration
+        threads = [threading.Thread(target=self.worker, args=(i,), daemon=True) for i in range(self.args.concurrency)]
+        started = time.monotonic()
+        for thread in threads:
+            thread.start()
+        while any(thread.is_alive() for thread in threads):
+            if self.args.app_pid:
+                rss = read_rss_bytes(self.args.app_pid)
+                if rss:
+                    rss_samples.append(rss)
+            time.sleep(1)
+        elapsed = time.monotonic() - started
+        return self.report(elapsed, rss_samples)
+
+    def report(self, elapsed, rss_samples):
+        summary = {'duration_seconds': round(elapsed, 1), 'concurrency': self.args.concurrency, 'scenarios': {}}
+        for scenario, counts in sorted(self.results.outcomes.items()):
+            summary['scenarios'][scenario] = {
+                'outcomes': counts,
+                'throughput_per_second': round(counts.get('ok', 0) / elapsed, 2)
+            }
+        summary['latency_seconds'] = {
+            metric: {
+                'count': len(values),
+                'p50': round(percentile(values, 0.50), 3),
+                'p90': round(percentile(values, 0.90), 3),
+                'p99': round(percentile(values, 0.99), 3),
+                'max': round(max(values), 3)
+            }
+            for metric, values in sorted(self.results.latencies.items()) if values
+        }
+        if rss_samples:
+            summary['rss_mb'] = {
+                'start': round(rss_samples[0] / 2**20, 1),
+                'max': round(max(rss_samples) / 2**20, 1),
+                'end': round(rss_samples[-1] / 2**20, 1)
+            }
+        return summary
+
+
+def print_report(summary):
+    print(f"\nDuration {summary['duration_seconds']}s, {summary['concurrency']} clients")
+    print(f"{'scenario':<12} {'ok/s':>8}  outcomes")
+    for scenario, data in summary['scenarios'].items():
+        outcomes = ', '.join(f"{key}={value}" for key, value in sorted(data['outcomes'].items()))
+        print(f"{scenario:<12} {data['throughput_per_second']:>8}  {outcomes}")
+    print(f"\n{'latency (s)':<22} {'count':>6} {'p50':>8} {'p90':>8} {'p99':>8} {'max':>8}")
+    for metric, data in summary['latency_seconds'].items():
+        print(f"{metric:<22} {data['count']:>6} {data['p50']:>8} {data['p90']:>8} {data['p99']:>8} {data['max']:>8}")
+    if 'rss_mb' in summary:
+        rss = summary['rss_mb']
+        print(f"\nApp RSS: start {rss['start']} MB, max {rss['max']} MB, end {rss['end']} MB")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--base-url', default='http://127.0.0.1:5000')
+    parser.add_argument('--duration', type=float, default=30, help='Seconds to generate load for')
+    parser.add_argument('--concurrency', type=int, default=16, help='Client threads')
+    parser.add_argument('--mix', default='generate=4,upload=1,crop=2,analyze=1',
+                        help='Scenario weights, e.g. generate=4,crop=2')
+    parser.add_argument('--model', default='fal-ai/flux-lora', help='base_model for generate requests')
+    parser.add_argument('--civitai', action='store_true', help='Add a Civitai LoRA to generate requests')
+    parser.add_argument('--poll-interval', type=float, default=0.5)
+    parser.add_argument('--job-timeout', type=float, default=300)
+    parser.add_argument('--app-pid', type=int, help='Sample RSS of this process (and its children)')
+    parser.add_argument('--json-out', help='Also write the report as JSON to this file')
+    parser.add_argument('--fail-on-errors', action='store_true',
+                        help='Exit with status 1 if any request failed (429 rejections and cancelled jobs excluded)')
+    args = parser.parse_args()
+
+    summary = LoadTest(args).run()
+    print_report(summary)
+    if args.json_out:
+        with open(args.json_out, 'w') as f:
+            json.dump(summary, f, indent=2)
+    failed = sum(
+        count for data in summary['scenarios'].values()
+        for outcome, count in data['outcomes'].items()
+        if outcome not in ('ok', 'submitted', 'rejected_429', 'job_cancelled')
+    )
+    if failed and args.fail_on_errors:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    main()
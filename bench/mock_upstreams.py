@@ -0,0 +1,296 @@
+"""Local stand-in for the fal.ai, z.ai and Civitai APIs used by app.py.
+
+Serves:
+  POST /fal/<model path>                     synchronous fal.run endpoints (FAL_RUN_BASE_URL=<mock>/fal)
+  POST /queue/<model path>                   fal.ai queue submit (FAL_QUEUE_BASE_URL=<mock>/queue)
+  GET  /queue/requests/<id>/status           queue status
+  GET  /queue/requests/<id>                  queue result
+  PUT  /queue/requests/<id>/cancel           queue cancel
+  POST /zai/chat/completions                 z.ai chat completions (Z_AI_BASE_URL=<mock>/zai)
+  GET  /civitai/api/download/models/<id>     Civitai LoRA download (CIVITAI_BASE_URL=<mock>/civitai)
+  GET  /media/<name>.jpg                     generated result images
+
+Latency distributions are given as "fixed:S", "uniform:MIN:MAX",
+"lognormal:MEDIAN:SIGMA" or "exp:MEAN" (seconds); errors as "CODE:RATE,..."
+e.g. "500:0.02,429:0.01".
+
+Usage:
+  python bench/mock_upstreams.py --port 8099 --fal-latency lognormal:2:0.4 --fal-errors 500:0.02
+"""
+import argparse
+import io
+import json
+import math
+import random
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse
+
+from PIL import Image
+
+
+def parse_latency(spec):
+    """Build a sampler returning a delay in seconds from a distribution spec"""
+    kind, _, params = spec.partition(':')
+    values = [float(v) for v in params.split(':') if v]
+    if kind == 'fixed':
+        return lambda: values[0]
+    if kind == 'uniform':
+        return lambda: random.uniform(values[0], values[1])
+    if kind == 'lognormal':
+        median, sigma = values
+        return lambda: random.lognormvariate(math.log(median), sigma)
+    if kind == 'exp':
+        return lambda: random.expovariate(1 / values[0])
+    raise argparse.ArgumentTypeError(f"Unknown latency distribution: {spec}")
+
+
+def parse_errors(spec):
+    """Parse "CODE:RATE,..." into a list of (status_code, probability)"""
+    errors = []
+    for item in filter(None, (part.strip() for part in spec.split(','))):
+        code, _, rate = item.partition(':')
+        errors.append((int(code), float(rate)))
+    return errors
+
+
+class Upstream:
+    """Latency and error behaviour of one mocked service"""
+
+    def __init__(self, name, latency, errors):
+        self.name = name
+        self.latency = parse_latency(latency)
+        self.errors = parse_errors(errors)
+
+    def delay(self):
+        return max(0.0, self.latency())
+
+    def pick_error(self):
+        roll = random.random()
+        for status_code, rate in self.errors:
+            if roll < rate:
+                return status_code
+            roll -= rate
+        return None
+
+
+class MockState:
+    def __init__(self, args):
+        self.fal = Upstream('fal', args.fal_latency, args.fal_errors)
+        self.zai = Upstream('zai', args.zai_latency, args.zai_errors)
+        self.civitai = Upstream('civitai', args.civitai_latency, args.civitai_errors)
+        self.image_size = args.image_size
+        self.lock = threading.Lock()
+        self.queue_requests = {}  # request_id -> {'ready_at', 'result', 'error', 'cancelled'}
+        self.counters = {}
+        self._image = None
+
+    def count(self, key):
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + 1
+
+    def image_bytes(self):
+        if self._image is None:
+            buffer = io.BytesIO()
+            Image.new('RGB', (self.image_size, self.image_size), (120, 90, 160)).save(buffer, 'JPEG', quality=85)
+            self._image = buffer.getvalue()
+        return self._image
+
+
+class MockHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    server_version = 'FalloraMock/1.0'
+
+    @property
+    def state(self):
+        return self.server.state
+
+    def log_message(self, format, *args):
+        if self.server.verbose:
+            super().log_message(format, *args)
+
+    def _read_json(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length) if length else b''
+        try:
+            return json.loads(body or b'{}')
+        except ValueError:
+            return {}
+
+    def _send_json(self, status_code, payload, headers=None):
+        body = json.dumps(payload).encode('utf-8')
+        self.send_response(status_code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def _send_error(self, upstream, status_code):
+        self.state.count(f"{upstream.name}.error.{status_code}")
+        headers = {'Retry-After': '1'} if status_code == 429 else None
+        if upstream.name == 'zai':
+            payload = {'error': {'message': f'mock error {status_code}'}}
+        else:
+            payload = {'detail': f'mock error {status_code}'}
+        self._send_json(status_code, payload, headers)
+
+    def _base_url(self):
+        return f"http://{self.headers.get('Host', '127.0.0.1')}"
+
+    def _generation_result(self, model_path, payload):
+        num_images = max(1, int(payload.get('num_images') or 1))
+        urls = [f"{self._base_url()}/media/{uuid.uuid4().hex}.jpg" for _ in range(num_images)]
+        width = payload.get('image_size', {}).get('width', 1024)
+        height = payload.get('image_size', {}).get('height', 1024)
+        images = [{'url': url, 'width': width, 'height': height, 'content_type': 'image/jpeg'} for url in urls]
+        result = {'seed': payload.get('seed') or random.randint(1, 2**31 - 1), 'timings': {}}
+        if 'wan' in model_path:
+            result['image'] = images[0]
+        else:
+            result['images'] = images
+        return result
+
+    def do_GET(self):
+        path = urlparse(self.path).path
+        if path.startswith('/media/'):
+            body = self.state.image_bytes()
+            self.send_response(200)
+            self.send_header('Content-Type', 'image/jpeg')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        match = re.match(r'^/civitai/api/download/models/(\d+)$', path)
+        if match:
+            upstream = self.state.civitai
+            time.sleep(upstream.delay())
+            error = upstream.pick_error()
+            if error:
+                return self._send_error(upstream, error)
+            self.state.count('civitai.download')
+            body = b'\0' * 1024  # stand-in for the safetensors file
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/octet-stream')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+            return
+
+        match = re.match(r'^/queue/requests/([0-9a-f]+)(/status)?$', path)
+        if match:
+            with self.state.lock:
+                entry = self.state.queue_requests.get(match.group(1))
+            if entry is None:
+                return self._send_json(404, {'detail': 'Unknown request'})
+            done = entry['cancelled'] or time.monotonic() >= entry['ready_at']
+            if match.group(2):
+                self.state.count('fal.queue.status')
+                return self._send_json(200, {'status': 'COMPLETED' if done else 'IN_PROGRESS'})
+            if not done:
+                return self._send_json(400, {'detail': 'Request is still in progress'})
+            if entry['cancelled']:
+                return self._send_json(400, {'detail': 'Request was cancelled'})
+            if entry['error']:
+                return self._send_error(self.state.fal, entry['error'])
+            return self._send_json(200, entry['result'])
+
+        if path == '/stats':
+            with self.state.lock:
+                return self._send_json(200, {'counters': self.state.counters, 'queued': len(self.state.queue_requests)})
+
+        self._send_json(404, {'detail': 'Not found'})
+
+    def do_PUT(self):
+        match = re.match(r'^/queue/requests/([0-9a-f]+)/cancel$', urlparse(self.path).path)
+        if not match:
+            return self._send_json(404, {'detail': 'Not found'})
+        with self.state.lock:
+            entry = self.state.queue_requests.get(match.group(1))
+            if entry is not None:
+                entry['cancelled'] = True
+        self.state.count('fal.queue.cancel')
+        self._send_json(200 if entry else 404, {'status': 'CANCELLATION_REQUESTED' if entry else 'NOT_FOUND'})
+
+    def do_POST(self):
+        path = urlparse(self.path).path
+        payload = self._read_json()
+
+        if path.startswith('/fal/'):
+            upstream = self.state.fal
+            time.sleep(upstream.delay())
+            error = upstream.pick_error()
+            if error:
+                return self._send_error(upstream, error)
+            self.state.count('fal.sync')
+            return self._send_json(200, self._generation_result(path, payload))
+
+        if path.startswith('/queue/'):
+            upstream = self.state.fal
+            request_id = uuid.uuid4().hex
+            base = f"{self._base_url()}/queue/requests/{request_id}"
+            with self.state.lock:
+                self.state.queue_requests[request_id] = {
+                    'ready_at': time.monotonic() + upstream.delay(),
+                    'result': self._generation_result(path, payload),
+                    'error': upstream.pick_error(),
+                    'cancelled': False
+                }
+            self.state.count('fal.queue.submit')
+            return self._send_json(200, {
+                'request_id': request_id,
+                'status_url': f"{base}/status",
+                'response_url': base,
+                'cancel_url': f"{base}/cancel"
+            })
+
+        if path == '/zai/chat/completions':
+            upstream = self.state.zai
+            time.sleep(upstream.delay())
+            error = upstream.pick_error()
+            if error:
+                return self._send_error(upstream, error)
+            self.state.count('zai.completion')
+            prompt = ("An ultrarealistic, cinematic photograph of a person at a seaside cafe. "
+                      "Shot on a Sony A7 IV with an 85mm lens, aperture f/1.8.")
+            return self._send_json(200, {
+                'id': uuid.uuid4().hex,
+                'model': payload.get('model'),
+                'choices': [{'index': 0, 'message': {'role': 'assistant', 'content': prompt}}]
+            })
+
+        self._send_json(404, {'detail': 'Not found'})
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8099)
+    parser.add_argument('--fal-latency', default='lognormal:2.0:0.4')
+    parser.add_argument('--fal-errors', default='')
+    parser.add_argument('--zai-latency', default='lognormal:1.5:0.3')
+    parser.add_argument('--zai-errors', default='')
+    parser.add_argument('--civitai-latency', default='fixed:0.05')
+    parser.add_argument('--civitai-errors', default='')
+    parser.add_argument('--image-size', type=int, default=256, help='Edge of the generated result JPEG')
+    parser.add_argument('--verbose', action='store_true', help='Log every request')
+    args = parser.parse_args()
+
+    server = ThreadingHTTPServer((args.host, args.port), MockHandler)
+    server.daemon_threads = True
+    server.state = MockState(args)
+    server.verbose = args.verbose
+    print(f"Mock upstreams listening on http://{args.host}:{args.port}", flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
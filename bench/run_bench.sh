@@ -0,0 +1,45 @@
+#!/bin/bash
+# Start the mock upstreams and the app (under gunicorn) pointed at them, run the
+# load test, then shut both down. Extra arguments are passed to loadtest.py.
+#
+#   MOCK_ARGS="--fal-latency lognormal:3:0.5 --fal-errors 500:0.02" ./bench/run_bench.sh --duration 60
+set -euo pipefail
+
+cd "$(dirname "$0")/.."
+
+MOCK_PORT=${MOCK_PORT:-8099}
+APP_PORT=${APP_PORT:-5055}
+MOCK_URL="http://127.0.0.1:${MOCK_PORT}"
+WORK_DIR=$(mktemp -d /tmp/fallora-bench.XXXXXX)
+
+python bench/mock_upstreams.py --port "$MOCK_PORT" ${MOCK_ARGS:-} &
+MOCK_PID=$!
+
+FAL_KEY=bench-key \
+Z_AI_API_KEY=bench-key \
+CIVITAI_TOKEN=bench-token \
+FAL_RUN_BASE_URL="${MOCK_URL}/fal" \
+FAL_QUEUE_BASE_URL="${MOCK_URL}/queue" \
+Z_AI_BASE_URL="${MOCK_URL}/zai" \
+CIVITAI_BASE_URL="${MOCK_URL}/civitai" \
+REFERENCE_IMAGE_DIR="${WORK_DIR}/uploads" \
+RESULT_MIRROR_DIR="${WORK_DIR}/results" \
+JOB_STORE_PATH="${WORK_DIR}/jobs.db" \
+PROMETHEUS_MULTIPROC_DIR="${WORK_DIR}/metrics" \
+LOG_LEVEL=${LOG_LEVEL:-WARNING} \
+GUNICORN_ACCESS_LOG="" \
+PORT="$APP_PORT" \
+gunicorn -c gunicorn.conf.py app:app &
+APP_PID=$!
+
+trap 'kill $APP_PID $MOCK_PID 2>/dev/null; wait 2>/dev/null; rm -rf "$WORK_DIR"' EXIT
+
+# Wait for both servers to accept connections
+for _ in $(seq 1 50); do
+    if curl -sf "${MOCK_URL}/stats" >/dev/null && curl -sf "http://127.0.0.1:${APP_PORT}/api/models" >/dev/null; then
+        break
+    fi
+    sleep 0.2
+done
+
+python bench/loadtest.py --base-url "http://127.0.0.1:${APP_PORT}" --app-pid "$APP_PID" "$@"
@@ -0,0 +1,75 @@
+"""Gunicorn configuration for running Fallora in production.
+
+Usage: gunicorn -c gunicorn.conf.py app:app
+"""
+import multiprocessing
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+
+# Generation, polling and SSE requests spend their time waiting on I/O, so each
+# worker process serves requests from a pool of threads
+workers = int(os.environ.get("GUNICORN_WORKERS", os.environ.get("WEB_CONCURRENCY", multiprocessing.cpu_count())))
+worker_class = "gthread"
+# An open SSE job stream holds its thread for up to SSE_MAX_STREAM_SECONDS. The app caps
+# streams per worker at SSE_MAX_STREAMS (503 beyond that) and gets that many extra threads,
+# so GUNICORN_THREADS always remain for the other routes
+os.environ.setdefault("SSE_MAX_STREAMS", "16")
+threads = int(os.environ.get("GUNICORN_THREADS", "8")) + int(os.environ["SSE_MAX_STREAMS"])
+
+# SSE streams stay open for up to SSE_MAX_STREAM_SECONDS and send keep-alives in
+# between, so the worker timeout only needs to cover a stuck request
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", "120"))
+graceful_timeout = int(os.environ.get("GUNICORN_GRACEFUL_TIMEOUT", "30"))
+keepalive = int(os.environ.get("GUNICORN_KEEPALIVE", "5"))
+
+# Load the app in each worker rather than in the master, so the background
+# threads (generation workers, fal.ai poller, janitor) are started per process
+preload_app = False
+
+# Set GUNICORN_ACCESS_LOG to an empty string to turn the access log off
+accesslog = os.environ.get("GUNICORN_ACCESS_LOG", "-") or None
+errorlog = "-"
+loglevel = os.environ.get("GUNICORN_LOG_LEVEL", "info")
+
+# Jobs must be visible to every worker: a status request can land on a different
+# process than the one that accepted the job
+if workers > 1:
+    os.environ.setdefault("JOB_STORE_BACKEND", "sqlite")
+
+# fal.ai and z.ai limits are per account, so each worker's upstream limiters get a share of them
+os.environ.setdefault("UPSTREAM_LIMIT_SHARDS", str(workers))
+
+# Prometheus metrics from every worker are aggregated through files in this directory
+if workers > 1:
+    os.environ.setdefault("PROMETHEUS_MULTIPROC_DIR", "/tmp/fallora_metrics")
+
+
+def on_starting(server):
+    if workers > 1 and os.environ["JOB_STORE_BACKEND"] == "memory":
+        server.log.warning("JOB_STORE_BACKEND=memory with %s workers; job status requests may hit "
+                           "a worker that does not know the job", workers)
+
+    # Values left over from a previous run would be added to the new ones
+    metrics_dir = os.environ.get("PROMETHEUS_MULTIPROC_DIR")
+    if metrics_dir:
+        os.makedirs(metrics_dir, exist_ok=True)
+        for name in os.listdir(metrics_dir):
+            if name.endswith(".db"):
+                os.remove(os.path.join(metrics_dir, name))
+
+
+def child_exit(server, worker):
+    if os.environ.get("PROMETHEUS_MULTIPROC_DIR"):
+        try:
+            from prometheus_client import multiprocess
+        except ImportError:
+            return
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def post_worker_init(worker):
+    # Start the job watchdog with the worker rather than on its first request, so
+    # jobs orphaned by an exited worker or the previous run are recovered promptly
+    from app import JOB_WATCHDOG
+    JOB_WATCHDOG.start()
@@ -752,6 +752,112 @@ function showSuccess(message) {
   window.dispatchEvent(event);
 }
 
+const JOB_WAIT_TIMEOUT_MS = 15 * 60 * 1000; // Same budget as 180 polls at 5 second intervals
+
+// Job of the generation currently being waited for; a newer submission cancels it
+let activeJobId = null;
+let generationCounter = 0;
+
+function jobCancelledError() {
+  return Object.assign(new Error('Job was cancelled'), { cancelled: true });
+}
+
+// keepalive lets the request go out even while the page is unloading
+function cancelJob(jobId) {
+  console.log(`Cancelling job ${jobId}`);
+  return fetch(`/api/job/${jobId}`, { method: 'DELETE', keepalive: true })
+    .catch(error => console.warn(`Failed to cancel job ${jobId}:`, error));
+}
+
+function logJobStatus(statusResult) {
+  console.log('Job status:', statusResult.status);
+  if (statusResult.status === 'pending' && statusResult.queue_position) {
+    console.log(`Job queued at position ${statusResult.queue_position}`);
+  }
+}
+
+// Wait for a job via Server-Sent Events. Rejects with error.sseUnavailable set when
+// the stream could not be opened, so the caller can fall back to polling.
+function waitForJobEvents(jobId) {
+  return new Promise((resolve, reject) => {
+    if (typeof EventSource === 'undefined') {
+      reject(Object.assign(new Error('EventSource not supported'), { sseUnavailable: true }));
+      return;
+    }
+
+    const source = new EventSource(`/api/job/${jobId}/events`);
+    let received = false;
+
+    const finish = (callback) => {
+      clearTimeout(timer);
+      source.close();
+      callback();
+    };
+
+    const timer = setTimeout(() => {
+      finish(() => reject(new Error('Job timed out - please try again')));
+    }, JOB_WAIT_TIMEOUT_MS);
+
+    source.onmessage = (event) => {
+      received = true;
+      const statusResult = JSON.parse(event.data);
+      logJobStatus(statusResult);
+
+      if (statusResult.status === 'completed') {
+        console.log('Job completed successfully');
+        finish(() => resolve(statusResult.result));
+      } else if (statusResult.status === 'failed') {
+        finish(() => reject(new Error(statusResult.error || 'Job failed')));
+      } else if (statusResult.status === 'cancelled') {
+        finish(() => reject(jobCancelledError()));
+      }
+    };
+
+    source.onerror = () => {
+      // After the first message EventSource reconnects on its own, unless the
+      // reconnect was refused (e.g. 503 when the server has too many open streams)
+      if (!received || source.readyState === EventSource.CLOSED) {
+        finish(() => reject(Object.assign(new Error('Job event stream failed'), { sseUnavailable: true })));
+      }
+    };
+  });
+}
+
+async function pollJobStatus(jobId) {
+  let attempts = 0;
+  const maxAttempts = 180; // 30 seconds * 6 = 3 minutes max wait time
+  const pollInterval = 5000; // Poll every 5 seconds
+  
+  while (attempts < maxAttempts) {
+    console.log(`Polling job status (attempt ${attempts + 1}/${maxAttempts})...`);
+    
+    const statusResponse = await fetch(`/api/job/${jobId}`);
+    
+    if (!statusResponse.ok) {
+      throw new Error(`Failed to check job status: ${statusResponse.status}`);
+    }
+    
+    const statusResult = await statusResponse.json();
+    logJobStatus(statusResult);
+    
+    if (statusResult.status === 'completed') {
+      console.log('Job completed successfully');
+      return statusResult.result;
+    } else if (statusResult.status === 'failed') {
+      throw new Error(statusResult.error || 'Job failed');
+    } else if (statusResult.status === 'cancelled') {
+      throw jobCancelledError();
+    }
+    
+    // Wait before next poll
+    await new Promise(resolve => setTimeout(resolve, pollInterval));
+    attempts++;
+  }
+  
+  // If we get here, the job timed out
+  throw new Error('Job timed out - please try again');
+}
+
 async function generateImage(baseModel, loras, prompt, resolution, seed, negativePrompt, referenceImageUrl = null) {
   try {
     console.log(`Generating image with base model: ${baseModel}`);
@@ -790,6 +896,12 @@ async function generateImage(baseModel, loras, prompt, resolution, seed, negativ
       console.log(`Reference image available but Enable checkbox is unchecked (${referenceMode}) - not adding to request`);
     }
 
+    // A new generation supersedes the one still running; stop paying for it
+    if (activeJobId) {
+      cancelJob(activeJobId);
+      activeJobId = null;
+    }
+
     // Submit job to generate endpoint
     const submitResponse = await fetch('/api/generate', {
       method: 'POST',
@@ -799,6 +911,12 @@ async function generateImage(baseModel, loras, prompt, resolution, seed, negativ
       body: JSON.stringify(requestBody)
     });
 
+    if (submitResponse.status === 429 || submitResponse.status === 503) {
+      const errorData = await submitResponse.json();
+      const retryAfter = submitResponse.headers.get('Retry-After');
+      throw new Error(`${errorData.error || 'Server is busy'}${retryAfter ? ` (retry in ${retryAfter}s)` : ''}`);
+    }
+
     if (!submitResponse.ok) {
       const errorData = await submitResponse.json();
       throw new Error(errorData.error || `HTTP error! status: ${submitResponse.status}`);
@@ -808,40 +926,30 @@ async function generateImage(baseModel, loras, prompt, resolution, seed, negativ
     const jobId = submitResult.job_id;
     
     console.log(`Job submitted with ID: ${jobId}`);
+    activeJobId = jobId;
     
-    // Poll for job completion
-    let attempts = 0;
-    const maxAttempts = 180; // 30 seconds * 6 = 3 minutes max wait time
-    const pollInterval = 5000; // Poll every 5 seconds
-    
-    while (attempts < maxAttempts) {
-      console.log(`Polling job status (attempt ${attempts + 1}/${maxAttempts})...`);
-      
-      const statusResponse = await fetch(`/api/job/${jobId}`);
-      
-      if (!statusResponse.ok) {
-        throw new Error(`Failed to check job status: ${statusResponse.status}`);
+    try {
+      // Prefer pushed status updates; fall back to polling if the stream is unavailable
+      try {
+        return await waitForJobEvents(jobId);
+      } catch (error) {
+        if (!error.sseUnavailable) {
+          throw error;
+        }
+        console.log('Job event stream unavailable, falling back to polling');
       }
-      
-      const statusResult = await statusResponse.json();
-      console.log('Job status:', statusResult.status);
-      
-      if (statusResult.status === 'completed') {
-        console.log('Job completed successfully');
-        return statusResult.result;
-      } else if (statusResult.status === 'failed') {
-        throw new Error(statusResult.error || 'Job failed');
+
+      return await pollJobStatus(jobId);
+    } finally {
+      if (activeJobId === jobId) {
+        activeJobId = null;
       }
-      
-      // Wait before next poll
-      await new Promise(resolve => setTimeout(resolve, pollInterval));
-      attempts++;
     }
     
-    // If we get here, the job timed out
-    throw new Error('Job timed out - please try again');
-    
   } catch (error) {
+    if (error.cancelled) {
+      throw error;
+    }
     console.error('API Error:', error);
     throw new Error(`Image generation failed: ${error.message}`);
   }
@@ -1024,6 +1132,7 @@ form.addEventListener('submit', async (e) => {
   console.log("Validation passed");
 
   // UI updates - show loading overlay
+  const generation = ++generationCounter;
   generateButton.disabled = true;
   loadingOverlay.classList.add('show');
 
@@ -1083,12 +1192,26 @@ form.addEventListener('submit', async (e) => {
     }
     
   } catch (error) {
+    if (error.cancelled) {
+      // Superseded by a newer submission, which now owns the loading state
+      console.log('Previous generation was cancelled');
+      return;
+    }
     console.error('Generation error:', error);
     showError(error.message);
   } finally {
     console.log("Finally block executed");
-    generateButton.disabled = false;
-    loadingOverlay.classList.remove('show');
+    if (generation === generationCounter) {
+      generateButton.disabled = false;
+      loadingOverlay.classList.remove('show');
+    }
+  }
+});
+
+// Nobody is left to receive the result of a job still running when the page goes away
+window.addEventListener('pagehide', () => {
+  if (activeJobId) {
+    cancelJob(activeJobId);
   }
 });
 
@@ -1563,11 +1686,8 @@ window.handleDownloadClick = function(button, imageUrl) {
     const cleanPrompt = prompt.replace(/[^a-zA-Z0-9\s]/g, '').substring(0, 30).trim() || 'fallora-image';
     const filename = `${cleanPrompt}-${Date.now()}.png`;
 
-    // Fetch and download
-    fetch(imageUrl, {
-      mode: 'cors',
-      cache: 'no-cache'
-    })
+    // Fetch through the backend, which serves a local mirror of generated images
+    fetch(`/api/download?url=${encodeURIComponent(imageUrl)}&filename=${encodeURIComponent(filename)}`)
     .then(response => {
       if (!response.ok) throw new Error(`HTTP ${response.status}`);
       return response.blob();
@@ -1620,10 +1740,8 @@ window.downloadImage = async function(imageUrl) {
         clickedBtn.disabled = false;
       };
 
-      // Fetch the image as a blob
-      const response = await fetch(imageUrl, {
-        mode: 'cors'
-      });
+      // Fetch the image as a blob (via the backend mirror)
+      const response = await fetch(`/api/download?url=${encodeURIComponent(imageUrl)}`);
 
       if (!response.ok) {
         throw new Error(`Failed to fetch image: ${response.status}`);